@@ -0,0 +1,253 @@
+from __future__ import unicode_literals, print_function, division
+
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+from binding_operations import SumFlattenedOuterProduct
+
+# Fitting a TensorProductEncoder with fixed roles by least squares instead of gradient
+# descent.
+#
+# With fixed roles, the encoding of a sequence only depends on how often each filler a
+# fills each role r in it. Writing C for that (n_fillers, n_roles) count matrix, F and R for
+# the filler and role embedding matrices, and W, b for the final linear layer, the encoder
+# computes
+#     y = W vec(F^T C R) + b
+# which is linear in each of F, R and (W, b) when the other two are fixed. fit_tpr_als
+# solves for each of them in turn, each time exactly, through the normal equations of that
+# linear regression (alternating least squares).
+#
+# When filler_dim >= n_fillers and role_dim >= n_roles, F and R can be taken to be one-hot
+# embeddings without losing anything, and the model is a linear regression on the counts
+# C that is solved exactly in a single pass.
+#
+# Every step works from the positions of the sequences rather than from dense count
+# matrices. The normal equations of the embeddings are assembled from the pairs of
+# positions within each sequence and from K = W^T W, so that their cost grows with the
+# number of position pairs and the number of unknowns (n_fillers * filler_dim or
+# n_roles * role_dim), not with the size of the vectors times the number of unknowns.
+# Each Gram matrix has (n_fillers * n_fillers) * (role_dim * role_dim) (or the same for
+# roles) entries, which limits this to moderate vocabularies and role sets.
+
+# The largest number of unknowns allowed in one least squares problem
+MAX_UNKNOWNS = 8000
+
+
+# A chunk of consecutive sequences of a TPDNDataset, as arrays over their positions:
+#   fillers, roles: the filler and role of every position
+#   sequence:       the index within the chunk of the sequence of every position
+#   first, second:  every ordered pair of positions of the same sequence
+#   targets:        the vectors of the sequences
+Chunk = namedtuple('Chunk', ['fillers', 'roles', 'sequence', 'first', 'second', 'targets'])
+
+
+# Split a TPDNDataset into Chunks of about max_pairs position pairs
+def _chunks(dataset, max_pairs=1 << 20):
+    lengths = dataset.lengths()
+    pair_ends = np.cumsum(lengths ** 2)
+    start = 0
+    while start < len(dataset):
+        pairs_before = pair_ends[start - 1] if start > 0 else 0
+        end = max(start + 1, int(np.searchsorted(pair_ends, pairs_before + max_pairs,
+                                                 side='right')))
+        chunk_lengths = lengths[start:end]
+        token_start, token_end = int(dataset.offsets[start]), int(dataset.offsets[end])
+
+        sequence = np.repeat(np.arange(end - start), chunk_lengths)
+        position_lengths = chunk_lengths[sequence]
+        sequence_starts = (dataset.offsets[start:end] - token_start)[sequence]
+        num_pairs = int(position_lengths.sum())
+        pair_starts = np.cumsum(position_lengths) - position_lengths
+        first = np.repeat(np.arange(len(sequence)), position_lengths)
+        second = np.repeat(sequence_starts - pair_starts, position_lengths) + np.arange(num_pairs)
+
+        yield Chunk(dataset.fillers[token_start:token_end],
+                    dataset.roles[token_start:token_end],
+                    torch.from_numpy(sequence),
+                    torch.from_numpy(first),
+                    torch.from_numpy(second),
+                    dataset.targets[start:end].double())
+        start = end
+
+
+# Solve the ridge regression (gram + ridge * I) x = rhs. The last unknown is left
+# unregularized when it is a bias.
+def _solve(gram, rhs, ridge, has_bias=False):
+    penalty = torch.full((len(gram),), ridge, dtype=gram.dtype)
+    if has_bias:
+        penalty[-1] = 0
+    return torch.linalg.solve(gram + torch.diag(penalty), rhs)
+
+
+def _check_size(num_unknowns, what):
+    if num_unknowns > MAX_UNKNOWNS:
+        raise ValueError('Solving for the {} by least squares needs {} unknowns, more than '
+                         'the {} allowed; train with gradient descent instead'.format(
+                             what, num_unknowns, MAX_UNKNOWNS))
+
+
+# The flattened sum of the filler/role outer products of every sequence of a chunk, which
+# is what the final layer is applied to
+def _bindings(chunk, F, R):
+    outer_products = F[chunk.fillers].unsqueeze(2) * R[chunk.roles].unsqueeze(1)
+    bindings = torch.zeros(len(chunk.targets), F.shape[1], R.shape[1], dtype=torch.float64)
+    return bindings.index_add_(0, chunk.sequence, outer_products).view(len(chunk.targets), -1)
+
+
+# Fit the final layer (W, b) with the embeddings F and R fixed
+def _fit_last_layer(dataset, F, R, ridge):
+    size = F.shape[1] * R.shape[1] + 1
+    gram = torch.zeros(size, size, dtype=torch.float64)
+    rhs = torch.zeros(size, dataset.targets.shape[1], dtype=torch.float64)
+    for chunk in _chunks(dataset):
+        features = _bindings(chunk, F, R)
+        features = torch.cat([features, torch.ones(len(features), 1, dtype=torch.float64)], 1)
+        gram += features.t() @ features
+        rhs += features.t() @ chunk.targets
+    solution = _solve(gram, rhs, ridge, has_bias=True)
+    return solution[:-1].t(), solution[-1]
+
+
+# Fit the filler embeddings F (fit_fillers=True) or the role embeddings R with everything
+# else fixed. W is the final layer's weight, of shape (hidden_size, filler_dim * role_dim).
+#
+# For the fillers, the encoding of a sequence is sum_t W[:, (i, j)] F[x_t, i] R[r_t, j], so
+# the Gram matrix of the unknowns F[a, i] is
+#     G[(a, i), (a', l)] = sum_{j, k} Q[a, a', j, k] K[i, j, l, k]
+# where Q sums R[r_t, j] R[r_t', k] over the pairs of positions t, t' of each sequence with
+# fillers a and a', and K = W^T W. The roles are the same with fillers and roles swapped.
+def _fit_embeddings(dataset, F, R, W, b, ridge, fit_fillers):
+    filler_dim, role_dim = F.shape[1], R.shape[1]
+    K = (W.t() @ W).view(filler_dim, role_dim, filler_dim, role_dim)
+    if fit_fillers:
+        unknowns, other = F, R
+    else:
+        unknowns, other = R, F
+        K = K.permute(1, 0, 3, 2)
+    num_rows, dim = unknowns.shape
+    other_dim = other.shape[1]
+
+    pair_sums = torch.zeros(num_rows * num_rows, other_dim * other_dim, dtype=torch.float64)
+    rhs = torch.zeros(num_rows, dim, dtype=torch.float64)
+    for chunk in _chunks(dataset):
+        rows, others = (chunk.fillers, chunk.roles) if fit_fillers else \
+            (chunk.roles, chunk.fillers)
+        other_embedded = other[others]
+        pair_products = other_embedded[chunk.first].unsqueeze(2) * \
+            other_embedded[chunk.second].unsqueeze(1)
+        pair_sums.index_add_(0, rows[chunk.first] * num_rows + rows[chunk.second],
+                             pair_products.view(len(pair_products), -1))
+
+        # W^T (y - b) for every sequence, as (dim, other_dim) matrices
+        residuals = ((chunk.targets - b) @ W).view(len(chunk.targets), filler_dim, role_dim)
+        if not fit_fillers:
+            residuals = residuals.transpose(1, 2)
+        rhs.index_add_(0, rows, torch.einsum('tij,tj->ti', residuals[chunk.sequence],
+                                             other_embedded))
+
+    gram = torch.einsum('abjk,ijlk->aibl',
+                        pair_sums.view(num_rows, num_rows, other_dim, other_dim), K)
+    gram = gram.reshape(num_rows * dim, num_rows * dim)
+    return _solve(gram, rhs.view(-1), ridge).view(num_rows, dim)
+
+
+# Copy the solution into the encoder
+def _set_parameters(tpr_encoder, F, R, W=None, b=None):
+    with torch.no_grad():
+        tpr_encoder.filler_embedding.weight.copy_(F.float())
+        tpr_encoder.role_embedding.weight.copy_(R.float())
+        if W is not None:
+            tpr_encoder.last_layer.weight.copy_(W.float())
+            tpr_encoder.last_layer.bias.copy_(b.float())
+
+
+# The mean squared error of the encoder on a TPDNDataset
+def tpr_mse(tpr_encoder, dataset, batch_size=256):
+    device = next(tpr_encoder.parameters()).device
+    total = 0.0
+    with torch.no_grad():
+        for start, end in dataset.padded_batch_ranges(batch_size):
+            fillers, roles, targets, lengths = dataset.padded_batch(start, end)
+            out = tpr_encoder(fillers.to(device), roles.to(device), lengths)
+            total += float(torch.sum(torch.pow(out - targets.to(device), 2)))
+    return total / max(len(dataset) * dataset.targets.shape[1], 1)
+
+
+# Fit a TensorProductEncoder to a TPDNDataset of training data by alternating least
+# squares, for at most max_sweeps sweeps over the final layer, the filler embeddings and
+# the role embeddings. The weights with the lowest MSE on dev_data are saved to
+# weight_file, as trainIters_tpr does, and training stops once patience sweeps in a row
+# have not improved it by a relative tolerance. Pretrained (frozen) filler embeddings are
+# kept fixed. Returns the best dev MSE.
+def fit_tpr_als(train_data, dev_data, tpr_encoder, weight_file, max_sweeps=100, patience=3,
+                ridge=1e-6, tolerance=1e-4):
+    if not isinstance(tpr_encoder.sum_layer, SumFlattenedOuterProduct):
+        raise ValueError('The least squares solver only supports the tpr binder')
+    if getattr(tpr_encoder, 'projection_rank', None) is not None:
+        raise ValueError('The least squares solver does not support a low-rank projection')
+    if tpr_encoder.embed_squeeze:
+        raise ValueError('The least squares solver does not support an embedding squeeze layer')
+
+    F = tpr_encoder.filler_embedding.weight.detach().double().cpu()
+    R = tpr_encoder.role_embedding.weight.detach().double().cpu()
+    n_fillers, filler_dim = F.shape
+    n_roles, role_dim = R.shape
+    hidden_size = train_data.targets.shape[1]
+    fit_fillers = tpr_encoder.filler_embedding.weight.requires_grad
+
+    if not tpr_encoder.has_last:
+        if hidden_size != filler_dim * role_dim:
+            raise ValueError('Without a final layer the vectors must have filler_dim * '
+                             'role_dim dimensions')
+        W = torch.eye(hidden_size, dtype=torch.float64)
+        b = torch.zeros(hidden_size, dtype=torch.float64)
+    elif fit_fillers and filler_dim >= n_fillers and role_dim >= n_roles:
+        # The exact path: one-hot embeddings and a linear regression on the counts
+        _check_size(filler_dim * role_dim + 1, 'final layer')
+        print('Fitting the TPDN exactly by linear regression on the filler/role counts')
+        F = torch.eye(n_fillers, filler_dim, dtype=torch.float64)
+        R = torch.eye(n_roles, role_dim, dtype=torch.float64)
+        W, b = _fit_last_layer(train_data, F, R, ridge)
+        _set_parameters(tpr_encoder, F, R, W, b)
+        best_loss = tpr_mse(tpr_encoder, dev_data)
+        print('Dev MSE: {}'.format(best_loss))
+        torch.save(tpr_encoder.state_dict(), weight_file)
+        return best_loss
+    else:
+        _check_size(filler_dim * role_dim + 1, 'final layer')
+        W, b = None, None
+
+    _check_size(n_fillers * max(filler_dim, role_dim) if fit_fillers else 0,
+                'filler embeddings')
+    _check_size(n_roles * max(filler_dim, role_dim), 'role embeddings')
+
+    best_loss = float('inf')
+    sweeps_not_improved = 0
+    for sweep in range(max_sweeps):
+        if tpr_encoder.has_last:
+            W, b = _fit_last_layer(train_data, F, R, ridge)
+        if fit_fillers:
+            F = _fit_embeddings(train_data, F, R, W, b, ridge, fit_fillers=True)
+        R = _fit_embeddings(train_data, F, R, W, b, ridge, fit_fillers=False)
+
+        if tpr_encoder.has_last:
+            _set_parameters(tpr_encoder, F, R, W, b)
+        else:
+            _set_parameters(tpr_encoder, F, R)
+        dev_loss = tpr_mse(tpr_encoder, dev_data)
+        print('ALS sweep {}\tdev MSE: {}'.format(sweep, dev_loss))
+        if dev_loss < best_loss * (1 - tolerance):
+            sweeps_not_improved = 0
+        else:
+            sweeps_not_improved += 1
+        if dev_loss < best_loss:
+            print('Saving model at sweep {}'.format(sweep))
+            best_loss = dev_loss
+            torch.save(tpr_encoder.state_dict(), weight_file)
+        if sweeps_not_improved == patience:
+            print('Finished fitting early')
+            break
+
+    return best_loss
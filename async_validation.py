@@ -0,0 +1,103 @@
+import copy
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+from metrics import EpochMetrics
+from rolelearner.role_learning_tensor_product_encoder import RoleLearningTensorProductEncoder
+
+# Validation in a separate process, so that training goes on while the dev set is
+# evaluated. Each validation round hands a copy of the weights (and the regularization
+# settings they are validated with) to the process, which sends back the round's
+# validation metrics; the trainer acts on the rounds in order as their results arrive.
+#
+# The process is forked and evaluates on the CPU, so it is only available for models on
+# the CPU.
+
+
+def _validate_rounds(tpr_encoder, dev_batches, requests, results):
+    # Imported here, as training imports this module
+    from training import validation_metrics
+
+    torch.set_num_threads(1)
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        round_id, model_state, regularize, temp = request
+        tpr_encoder.load_state_dict(model_state)
+        if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
+            tpr_encoder.use_regularization(regularize)
+            tpr_encoder.set_regularization_temp(temp)
+        dev_metrics = validation_metrics(tpr_encoder, dev_batches)
+        results.put((round_id, dev_metrics.num_batches, dev_metrics.num_examples,
+                     dev_metrics.host_totals()))
+
+
+class AsyncValidator(object):
+    def __init__(self, tpr_encoder, dev_batches):
+        if next(tpr_encoder.parameters()).is_cuda:
+            raise ValueError('Asynchronous validation runs on the CPU')
+        context = mp.get_context('fork')
+        self.requests = context.Queue()
+        self.result_queue = context.Queue()
+        self.process = context.Process(target=_validate_rounds, args=(
+            copy.deepcopy(tpr_encoder), dev_batches, self.requests, self.result_queue),
+            daemon=True)
+        self.process.start()
+        # The rounds sent to the process whose results have not been acted on, in order
+        self.pending = []
+        self.next_id = 0
+
+    def num_pending(self):
+        return len(self.pending)
+
+    # Send the current weights of tpr_encoder to be validated. round_info and may_save are
+    # given back with the round's metrics by results().
+    def submit(self, tpr_encoder, round_info, may_save):
+        model_state = {name: tensor.detach().clone()
+                       for name, tensor in tpr_encoder.state_dict().items()}
+        self.requests.put((self.next_id, model_state, getattr(tpr_encoder, 'regularize', False),
+                           getattr(tpr_encoder, 'regularization_temp', 1)))
+        self.pending.append((self.next_id, round_info, may_save, model_state))
+        self.next_id += 1
+
+    def _get(self, block):
+        while True:
+            try:
+                return self.result_queue.get(timeout=1 if block else 0.001)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('The validation process failed')
+                if not block:
+                    return None
+
+    # The results of the rounds, in order, as (*round_info, dev_metrics, may_save,
+    # model_state) tuples: those that have arrived, at least one with wait, or all of the
+    # outstanding rounds with wait_all
+    def results(self, wait=False, wait_all=False):
+        while self.pending:
+            result = self._get(block=wait or wait_all)
+            if result is None:
+                return
+            wait = False
+            round_id, num_batches, num_examples, totals = result
+            pending_id, round_info, may_save, model_state = self.pending.pop(0)
+            assert round_id == pending_id
+
+            dev_metrics = EpochMetrics()
+            dev_metrics.totals = totals
+            dev_metrics.num_batches = num_batches
+            dev_metrics.num_examples = num_examples
+            yield tuple(round_info) + (dev_metrics, may_save, model_state)
+
+    def close(self):
+        self.requests.put(None)
+        # Results that were not acted on are dropped
+        while self.process.is_alive():
+            try:
+                self.result_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.process.join()
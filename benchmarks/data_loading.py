@@ -0,0 +1,71 @@
+from __future__ import print_function, division
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tpdn_data import parse_sequence_file
+
+# Benchmark the bulk data file parser against the line-by-line loop that
+# decompose.py used to run for each split. The bundled example files are
+# concatenated and repeated --scale times to build a larger input.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--scale", help="how many times to repeat the example data", type=int,
+                    default=100)
+parser.add_argument("--data_path", help="the location of the example data files", type=str,
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+args = parser.parse_args()
+
+
+# The loader decompose.py used before tpdn_data.py
+def legacy_load(path):
+    examples = []
+    filler_to_index = {}
+    filler_counter = 0
+    for line in open(path, "r"):
+        sequence, vector = line.strip().split("\t")
+        examples.append(([value for value in sequence.split()], Variable(
+            torch.FloatTensor(np.array([float(value) for value in vector.split()])))))
+
+        for filler in sequence.split():
+            if filler not in filler_to_index:
+                filler_to_index[filler] = filler_counter
+                filler_counter += 1
+    return [([filler_to_index[filler] for filler in elt[0]], elt[1]) for elt in examples]
+
+
+temp_dir = tempfile.mkdtemp()
+try:
+    big_file = os.path.join(temp_dir, 'example.data_from_train')
+    with open(big_file, 'w') as out_file:
+        for _ in range(args.scale):
+            for split in ['dev', 'test']:
+                with open(os.path.join(args.data_path, 'example.data_from_' + split)) as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+    print('Input: {:.1f} MB'.format(os.path.getsize(big_file) / 1e6))
+
+    start = time.time()
+    legacy = legacy_load(big_file)
+    legacy_time = time.time() - start
+    print('line-by-line loader: {:.2f}s'.format(legacy_time))
+
+    start = time.time()
+    parsed = parse_sequence_file(big_file)
+    bulk_time = time.time() - start
+    print('bulk parser:         {:.2f}s ({:.1f}x faster)'.format(
+        bulk_time, legacy_time / bulk_time))
+
+    assert len(legacy) == len(parsed.offsets) - 1
+    assert np.array_equal(torch.stack([elt[1] for elt in legacy]).numpy(), parsed.vectors)
+finally:
+    shutil.rmtree(temp_dir)
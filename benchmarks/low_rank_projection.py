@@ -0,0 +1,94 @@
+from __future__ import print_function, division
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+from torch import optim
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from models import TensorProductEncoder
+
+# The accuracy/speed trade-off of --projection_rank. TPDNs with a dense final layer and with
+# CP and Tucker projections of several ranks are trained for the same number of steps on
+# random sequences, whose targets are the encodings of a TPDN with a dense final layer, and
+# their time per training step, final layer size and held-out MSE are printed, along with
+# the mean square of the targets (the MSE of predicting zero). The dense final layer needs
+# enough steps to converge; the sizes of 300-d fillers, 50-d roles and 768-d BERT targets
+# (--filler_dim 300 --role_dim 50 --hidden_size 768) show the time per step at that scale.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--filler_dim", type=int, default=50)
+parser.add_argument("--role_dim", type=int, default=20)
+parser.add_argument("--hidden_size", type=int, default=128)
+parser.add_argument("--n_fillers", type=int, default=200)
+parser.add_argument("--n_roles", type=int, default=10)
+parser.add_argument("--length", help="the length of the sequences", type=int, default=10)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--steps", help="the number of training steps", type=int, default=2000)
+parser.add_argument("--ranks", type=int, nargs="+", default=[4, 16, 64])
+args = parser.parse_args()
+
+
+def random_batch():
+    fillers = torch.randint(args.n_fillers, (args.batch_size, args.length))
+    roles = torch.randint(args.n_roles, (args.batch_size, args.length))
+    return fillers, roles
+
+
+def new_encoder(**kwargs):
+    return TensorProductEncoder(n_roles=args.n_roles, n_fillers=args.n_fillers,
+                                filler_dim=args.filler_dim, role_dim=args.role_dim,
+                                final_layer_width=args.hidden_size, **kwargs)
+
+
+torch.manual_seed(0)
+teacher = new_encoder()
+for param in teacher.parameters():
+    param.requires_grad = False
+test_batches = [random_batch() for _ in range(10)]
+
+settings = [('dense', {})]
+for rank in args.ranks:
+    settings.append(('cp rank {}'.format(rank), {'projection_rank': rank}))
+for rank in args.ranks:
+    if rank * rank <= args.filler_dim * args.role_dim:
+        settings.append(('tucker rank {}'.format(rank),
+                         {'projection_rank': rank, 'projection_type': 'tucker'}))
+
+with torch.no_grad():
+    target_square = sum(torch.mean(teacher(fillers, roles) ** 2).item()
+                        for fillers, roles in test_batches) / len(test_batches)
+print('Mean square of the targets: {:.5f}'.format(target_square))
+print('{:<16} {:>14} {:>10} {:>10}'.format('final layer', 'parameters', 'ms/step', 'test MSE'))
+for name, kwargs in settings:
+    torch.manual_seed(1)
+    student = new_encoder(**kwargs)
+    # The fillers and roles are those of the teacher, so only the final layer is compared
+    student.filler_embedding.load_state_dict(teacher.filler_embedding.state_dict())
+    student.role_embedding.load_state_dict(teacher.role_embedding.state_dict())
+    student.filler_embedding.weight.requires_grad = False
+    student.role_embedding.weight.requires_grad = False
+    optimizer = optim.Adam([param for param in student.parameters() if param.requires_grad],
+                           lr=0.001)
+    criterion = nn.MSELoss()
+
+    start = time.time()
+    for _ in range(args.steps):
+        fillers, roles = random_batch()
+        optimizer.zero_grad()
+        loss = criterion(student(fillers, roles), teacher(fillers, roles))
+        loss.backward()
+        optimizer.step()
+    step_time = (time.time() - start) / args.steps
+
+    with torch.no_grad():
+        test_loss = sum(criterion(student(fillers, roles), teacher(fillers, roles)).item()
+                        for fillers, roles in test_batches) / len(test_batches)
+    num_parameters = sum(param.numel() for param in student.last_layer.parameters())
+    print('{:<16} {:>14,} {:>10.2f} {:>10.5f}'.format(name, num_parameters, step_time * 1000,
+                                                     test_loss))
@@ -0,0 +1,82 @@
+from __future__ import print_function, division
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rolelearner.role_assigner import RoleAssignmentLSTM
+from rolelearner.role_assigner_transformer import RoleAssignmentTransformer
+
+# Benchmark the LSTM and transformer role assigners (--role_assigner_type) on random padded
+# batches of word-level lengths, unidirectional and bidirectional: the time of a forward pass
+# without gradients (validation and role prediction) and of a forward and backward pass
+# (training), on every available device. The LSTM steps through the positions one at a time,
+# the transformer handles them all at once. The filler embedding is frozen, as with
+# --embedding_file, unless --train_fillers is given. The transformer's width is --hidden_dim,
+# which must divide by its 4 heads.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", help="the number of sequences in a batch", type=int,
+                    default=32)
+parser.add_argument("--lengths", help="the sequence lengths to time", type=int, nargs="+",
+                    default=[20, 50, 100])
+parser.add_argument("--filler_dim", type=int, default=300)
+parser.add_argument("--hidden_dim", help="the role assigner's hidden size", type=int,
+                    default=20)
+parser.add_argument("--num_roles", type=int, default=50)
+parser.add_argument("--train_fillers", help="train the filler embedding as well",
+                    action="store_true")
+parser.add_argument("--steps", help="how many passes to time", type=int, default=20)
+args = parser.parse_args()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_passes(role_assigner, fillers, lengths, train):
+    device = fillers.device
+    for _ in range(2):
+        role_assigner(fillers, lengths)[1].sum().backward()
+    synchronize(device)
+    start = time.time()
+    for _ in range(args.steps):
+        if train:
+            role_assigner(fillers, lengths)[1].sum().backward()
+        else:
+            with torch.no_grad():
+                role_assigner(fillers, lengths)
+    synchronize(device)
+    return (time.time() - start) / args.steps
+
+
+devices = [torch.device('cpu')]
+if torch.cuda.is_available():
+    devices.append(torch.device('cuda'))
+
+torch.manual_seed(0)
+filler_embedding = torch.nn.Embedding(30000, args.filler_dim)
+filler_embedding.weight.requires_grad = args.train_fillers
+for device, bidirectional in [(device, bidirectional) for device in devices
+                              for bidirectional in [False, True]]:
+    role_assigners = [
+        role_assigner_class(args.num_roles, filler_embedding, args.hidden_dim, 20,
+                            bidirectional=bidirectional).to(device)
+        for role_assigner_class in [RoleAssignmentLSTM, RoleAssignmentTransformer]]
+    for length in args.lengths:
+        fillers = torch.randint(30000, (args.batch_size, length), device=device)
+        lengths = torch.randint(1, length + 1, (args.batch_size,))
+        print('{}, {}, length {}:'.format(
+            device.type, 'bidirectional' if bidirectional else 'unidirectional', length))
+        for train in [False, True]:
+            lstm_time, transformer_time = [time_passes(role_assigner, fillers, lengths, train)
+                                           for role_assigner in role_assigners]
+            print('    {:<10} LSTM: {:.2f}ms, transformer: {:.2f}ms ({:.2f}x speedup)'
+                  .format('training' if train else 'inference', lstm_time * 1000,
+                          transformer_time * 1000, lstm_time / transformer_time))
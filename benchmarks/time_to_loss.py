@@ -0,0 +1,150 @@
+from __future__ import print_function, division
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hogwild
+import training
+from models import TensorProductEncoder
+from tpdn_data import build_tpdn_dataset
+
+# The wall-clock time that the trainers of decompose.py take to reach a target validation
+# loss, against plain trainIters_tpr: Hogwild training with --hogwild_workers, and validation
+# every --validate_every_steps steps with and without --async_validation. The TPDNs are
+# fit to the encodings of a random TPDN of random sequences with left-to-right roles, and
+# the time of every validation report is recorded; a run stops at the first report that
+# reaches the target. The target is --target_loss, or by
+# default --target_ratio times the mean square of the dev targets (the MSE of predicting
+# zero). Hogwild needs a core per worker to take steps side by side, and asynchronous
+# validation a core for the validation process; with fewer cores, the processes take turns.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n_fillers", type=int, default=100)
+parser.add_argument("--max_length", type=int, default=10)
+parser.add_argument("--filler_dim", type=int, default=20)
+parser.add_argument("--role_dim", type=int, default=10)
+parser.add_argument("--hidden_size", type=int, default=60)
+parser.add_argument("--train_size", type=int, default=20000)
+parser.add_argument("--dev_size", type=int, default=5000)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--epochs", help="the most epochs of a run", type=int, default=40)
+parser.add_argument("--workers", help="the numbers of Hogwild workers to time", type=int,
+                    nargs="+", default=[2, 4])
+parser.add_argument("--validate_every_steps", type=int, default=50)
+parser.add_argument("--target_loss", type=float, default=None)
+parser.add_argument("--target_ratio", type=float, default=0.01)
+args = parser.parse_args()
+
+
+def new_encoder(seed):
+    torch.manual_seed(seed)
+    return TensorProductEncoder(n_roles=args.max_length, n_fillers=args.n_fillers,
+                                filler_dim=args.filler_dim, role_dim=args.role_dim,
+                                final_layer_width=args.hidden_size)
+
+
+def random_dataset(teacher, size):
+    lengths = np.random.randint(1, args.max_length + 1, size)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    fillers = np.random.randint(args.n_fillers, size=offsets[-1])
+    roles = np.concatenate([np.arange(length) for length in lengths])
+    dataset = build_tpdn_dataset(fillers, offsets, roles, offsets,
+                                 torch.zeros(size, args.hidden_size))
+    with torch.no_grad():
+        for start in range(0, size, 1000):
+            end = min(start + 1000, size)
+            fillers, roles, _, batch_lengths = dataset.padded_batch(start, end)
+            dataset.targets[start:end] = teacher(fillers, roles, batch_lengths)[0]
+    return dataset.sorted_by_length()
+
+
+# The times of the validation reports, and their losses
+reports = []
+
+
+class TargetReached(Exception):
+    pass
+
+
+def recording(report_validation):
+    def recorded_report_validation(*report_args):
+        loss = report_validation(*report_args)
+        reports.append((time.time(), loss))
+        if loss <= target:
+            raise TargetReached()
+        return loss
+    return recorded_report_validation
+
+
+training.report_validation = recording(training.report_validation)
+hogwild.report_validation = recording(hogwild.report_validation)
+
+
+# Train a new TPDN with train, and return the (seconds, loss) of every validation report
+def time_run(train):
+    del reports[:]
+    weight_file = os.path.join(output_dir, 'tpdn.weights')
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            train(new_encoder(1), weight_file)
+        except TargetReached:
+            pass
+    return [(report_time - start_time, loss) for report_time, loss in reports]
+
+
+def time_to_target(run, target):
+    return next((seconds for seconds, loss in run if loss <= target), None)
+
+
+np.random.seed(0)
+with contextlib.redirect_stdout(io.StringIO()):
+    teacher = new_encoder(0)
+train_data = random_dataset(teacher, args.train_size)
+dev_data = random_dataset(teacher, args.dev_size)
+target = args.target_loss
+if target is None:
+    target = args.target_ratio * torch.mean(dev_data.targets ** 2).item()
+output_dir = tempfile.mkdtemp()
+
+runs = [('plain trainIters_tpr', time_run(lambda encoder, weight_file: training.trainIters_tpr(
+    train_data, dev_data, encoder, args.epochs, batch_size=args.batch_size,
+    weight_file=weight_file, patience=args.epochs)))]
+for num_workers in args.workers:
+    runs.append(('hogwild, {} workers'.format(num_workers), time_run(
+        lambda encoder, weight_file: hogwild.trainIters_tpr_hogwild(
+            train_data, dev_data, encoder, args.epochs, num_workers, batch_size=args.batch_size,
+            weight_file=weight_file, patience=args.epochs, seed=0))))
+for async_validation in [False, True]:
+    runs.append(('{}validation every {} steps'.format(
+        'async ' if async_validation else '', args.validate_every_steps), time_run(
+        lambda encoder, weight_file: training.trainIters_tpr(
+            train_data, dev_data, encoder, args.epochs, batch_size=args.batch_size,
+            weight_file=weight_file, patience=args.epochs,
+            validate_every_steps=args.validate_every_steps,
+            async_validation=async_validation))))
+shutil.rmtree(output_dir)
+
+print('{} cores; time to a validation loss of {:.5f}:'.format(len(os.sched_getaffinity(0)),
+                                                               target))
+plain_seconds = time_to_target(runs[0][1], target)
+for name, run in runs:
+    seconds = time_to_target(run, target)
+    if seconds is None:
+        print('    {:<32} not reached (best {:.5f})'.format(name, min(loss for _, loss in run)))
+    elif plain_seconds is None:
+        print('    {:<32} {:.1f}s'.format(name, seconds))
+    else:
+        print('    {:<32} {:.1f}s ({:.2f}x speedup)'.format(name, seconds,
+                                                           plain_seconds / seconds))
@@ -9,6 +9,12 @@ import pickle
 
 # Defines various functions for binding fillers and roles
 
+# A (batch_size, max_length) mask that is 1 for the positions of a padded batch that hold a
+# filler and 0 for the padding, given the length of every sequence
+def sequence_mask(lengths, max_length):
+    positions = torch.arange(max_length, device=lengths.device)
+    return (positions.unsqueeze(0) < lengths.unsqueeze(1)).float()
+
 # Defines the tensor product, used in tensor product representations
 class SumFlattenedOuterProduct(nn.Module):
     def __init__(self):
@@ -20,6 +26,47 @@ class SumFlattenedOuterProduct(nn.Module):
         sum_flattened_outer_product = flattened_outer_product
         return sum_flattened_outer_product
 
+# The final linear layer applied to the sum of the filler/role outer products,
+#     last_layer(SumFlattenedOuterProduct(fillers, role_weights @ role_embeddings))
+# as a (batch_size, final_layer_width) tensor, for fillers of shape (batch_size, length,
+# filler_dim) and role_weights of shape (batch_size, length, n_roles) over the rows of
+# role_embeddings (one-hot weights for fixed roles). The sum can be contracted in two
+# orders, and the one with fewer multiply-adds is used:
+#   bind first:    the (batch_size, filler_dim, role_dim) tensor product, then the layer
+#   project first: the role embeddings through the layer, (width, filler_dim, n_roles),
+#                  then the fillers summed per role, (batch_size, filler_dim, n_roles)
+# Projecting first never builds the tensor product. It is cheaper when there are fewer roles
+# than role dimensions and the batch is large enough to pay for projecting the role
+# embeddings; otherwise the tensor product is the smallest intermediate there is.
+def tensor_product_projection(fillers, role_weights, role_embeddings, last_layer):
+    batch_size, length, filler_dim = fillers.shape
+    n_roles, role_dim = role_embeddings.shape
+    width = last_layer.out_features
+    bind_first_cost, project_first_cost = tensor_product_projection_costs(
+        batch_size, length, filler_dim, n_roles, role_dim, width)
+
+    if bind_first_cost <= project_first_cost:
+        roles = torch.matmul(role_weights, role_embeddings)
+        outer_product = torch.bmm(fillers.transpose(1, 2), roles)
+        return torch.addmm(last_layer.bias, outer_product.view(batch_size, -1),
+                           last_layer.weight.t())
+
+    # Laid out like the tensor product, with the roles in place of the role dimensions
+    role_projections = torch.mm(last_layer.weight.view(width * filler_dim, role_dim),
+                                role_embeddings.t())
+    role_fillers = torch.bmm(fillers.transpose(1, 2), role_weights)
+    return torch.addmm(last_layer.bias, role_fillers.view(batch_size, -1),
+                       role_projections.view(width, -1).t())
+
+# The multiply-adds of the two orders of tensor_product_projection for a batch of batch_size
+# sequences of the given length: returns (bind_first_cost, project_first_cost)
+def tensor_product_projection_costs(batch_size, length, filler_dim, n_roles, role_dim, width):
+    bind_first_cost = batch_size * (length * n_roles * role_dim + length * filler_dim * role_dim +
+                                    filler_dim * role_dim * width)
+    project_first_cost = n_roles * role_dim * filler_dim * width + \
+        batch_size * (length * n_roles * filler_dim + n_roles * filler_dim * width)
+    return bind_first_cost, project_first_cost
+
 # The next several functions define circular convolution, used in 
 # holographic reduced representations
 def permutation_matrix(dim, offset):
@@ -41,38 +88,21 @@ def permutation_tensor(dim):
     return tensor
 
 
-class CircularConvolutionHelper(nn.Module):
-    def __init__(self, dim):
-        super(CircularConvolutionHelper, self).__init__()
-        self.permuter = Variable(torch.FloatTensor(permutation_tensor(dim))).cuda()
-        
-           
-    def forward(self, input1, input2):
-        outer_product = torch.bmm(input1.unsqueeze(2), input2.unsqueeze(1))
-        permuted = torch.bmm(self.permuter, outer_product.transpose(0,2))
-        circular_conv = torch.sum(permuted, dim = 0)
-        sum_rep = torch.sum(circular_conv, dim = 1)
-        
-        return sum_rep.unsqueeze(0).unsqueeze(0)
-
-
+# The sum of the circular convolutions of the fillers and roles, computed with the FFT:
+# the circular convolution of two vectors is the inverse transform of the product of their
+# transforms, and as the transforms are linear the sum over the sequence is taken before the
+# inverse. This costs O(dim log dim) per filler, for the whole batch at once and on any
+# device, where multiplying the outer products by permutation_tensor(dim) costs O(dim^3).
 class CircularConvolution(nn.Module):
     def __init__(self, dim):
         super(CircularConvolution, self).__init__()
-        self.helper = CircularConvolutionHelper(dim) 
+        self.dim = dim
            
     def forward(self, input1, input2):
-        conv = None
-
-        for i in range(len(input1)):
-            this_conv = self.helper(input1[i], input2[i]) 
-            if conv is None:
-                conv = this_conv
-            else:
-                conv = torch.cat((conv, this_conv), 1)
-
+        spectrum = torch.fft.rfft(input1, dim=2) * torch.fft.rfft(input2, dim=2)
+        conv = torch.fft.irfft(torch.sum(spectrum, dim=1), n=self.dim, dim=1)
         
-        return conv
+        return conv.unsqueeze(0)
 
 # Elementwise product
 class EltWise(nn.Module):
@@ -89,7 +119,30 @@ class EltWise(nn.Module):
         return sum_rep.unsqueeze(0)
 
 
-
-
-
-
+# A low-rank replacement for last_layer(SumFlattenedOuterProduct(fillers, roles)), whose
+# weight, seen as a (width, filler_dim, role_dim) tensor, is factorized with a given rank:
+#   cp:     W[h, i, j] = sum_k output[h, k] filler_factors[k, i] role_factors[k, j]
+#   tucker: W[h, i, j] = sum_kl output[h, k * rank + l] filler_factors[k, i] role_factors[l, j]
+# The fillers and roles are projected to rank dimensions and then bound, by their
+# elementwise product (cp) or their tensor product (tucker), so neither the full tensor
+# product nor the dense weight is built. The rank limits which linear maps of the tensor
+# product can be represented.
+class LowRankTensorProductProjection(nn.Module):
+    def __init__(self, filler_dim, role_dim, width, rank, kind="cp"):
+        super(LowRankTensorProductProjection, self).__init__()
+        self.rank = rank
+        self.kind = kind
+        self.filler_factors = nn.Linear(filler_dim, rank, bias=False)
+        self.role_factors = nn.Linear(role_dim, rank, bias=False)
+        if kind == "cp":
+            self.sum_layer = EltWise()
+            self.output = nn.Linear(rank, width)
+        elif kind == "tucker":
+            self.sum_layer = SumFlattenedOuterProduct()
+            self.output = nn.Linear(rank * rank, width)
+        else:
+            raise ValueError('Unknown low-rank projection: {}'.format(kind))
+
+    def forward(self, fillers, roles):
+        bound = self.sum_layer(self.filler_factors(fillers), self.role_factors(roles))
+        return self.output(bound)
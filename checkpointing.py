@@ -0,0 +1,123 @@
+import os
+import random
+import signal
+import threading
+from queue import Queue
+
+import numpy as np
+import torch
+
+# Checkpoints that are written atomically and in the background. A checkpoint is first
+# written to a temporary file next to its destination and then renamed over it, so a run
+# that is killed while writing leaves the previous checkpoint intact. The tensors are copied
+# when a checkpoint is handed to the CheckpointWriter, and written to disk by its thread
+# while training goes on.
+
+
+# Raised by trainIters_tpr when it stops on SIGTERM, after saving its training state
+class TrainingInterrupted(Exception):
+    pass
+
+
+# Write obj to path with torch.save, atomically
+def atomic_save(obj, path):
+    directory = os.path.dirname(os.path.abspath(path))
+    temporary_path = os.path.join(directory, '.{}.tmp'.format(os.path.basename(path)))
+    torch.save(obj, temporary_path)
+    os.replace(temporary_path, path)
+
+
+# A copy of a checkpoint (nested dicts, lists and tensors) whose tensors are on the CPU and
+# no longer shared with the model or the optimizer
+def _detached_copy(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, _detached_copy(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_detached_copy(value) for value in obj)
+    return obj
+
+
+# Writes checkpoints on a background thread, one at a time and in order
+class CheckpointWriter(object):
+    def __init__(self):
+        self.queue = Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    atomic_save(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    # Queue obj to be written to path. The caller may change obj as soon as this returns.
+    def save(self, obj, path):
+        self._check()
+        self.queue.put((_detached_copy(obj), path))
+
+    # Wait until every queued checkpoint is on disk
+    def flush(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+
+# The states of the random number generators used in training
+def capture_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Handle SIGTERM (as sent by schedulers before preempting a job) by setting the returned
+# event instead of exiting, so that training can save its state and stop at the end of the
+# current step. Returns the event and the previous handler, for restore_sigterm_handler.
+def install_sigterm_handler():
+    terminated = threading.Event()
+
+    def handler(signum, frame):
+        print('Received SIGTERM, stopping after this step')
+        terminated.set()
+
+    try:
+        previous_handler = signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        # Signal handlers can only be installed from the main thread
+        previous_handler = None
+    return terminated, previous_handler
+
+
+def restore_sigterm_handler(previous_handler):
+    if previous_handler is not None:
+        signal.signal(signal.SIGTERM, previous_handler)
@@ -0,0 +1,103 @@
+import os
+import random
+
+import torch
+import torch.distributed as dist
+
+# Data-parallel training over several processes with torch.distributed. Every process (rank)
+# holds a full copy of the TPDN and trains it on its own share of each epoch's batches, and
+# the gradients of the ranks are averaged after every step, so that all copies take the
+# same steps. The processes are started by torchrun, which sets RANK, WORLD_SIZE,
+# MASTER_ADDR and MASTER_PORT:
+#     torchrun --nproc_per_node 8 decompose.py --distributed ...
+# or, over several machines, with --nnodes and --rdzv_endpoint. The gloo backend is used,
+# which runs on CPUs.
+
+# The seed shared by all ranks, which decides how the batches are shuffled and sharded
+_shared_seed = 0
+
+
+# Join the process group started by torchrun and agree on a shared seed. Without a seed,
+# rank 0 draws one. Returns the shared seed, which every rank should seed its random number
+# generators with so that they all initialize the same model.
+def init_data_parallel(seed=None):
+    global _shared_seed
+    dist.init_process_group('gloo')
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    seed = torch.tensor([seed], dtype=torch.long)
+    dist.broadcast(seed, 0)
+    _shared_seed = int(seed)
+    return _shared_seed
+
+
+def data_parallel_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def data_parallel_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+# The number of threads each rank should use, so that the ranks on a machine share its
+# cores instead of all using every core
+def threads_per_rank():
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', data_parallel_size()))
+    return max(1, (os.cpu_count() or 1) // local_world_size)
+
+
+# Copy the parameters and buffers of rank 0's module to every other rank
+def broadcast_parameters(module):
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, 0)
+
+
+# Replace the gradient of every parameter by its mean over the ranks, in a single
+# all-reduce of the concatenated gradients
+def all_reduce_gradients(module):
+    parameters = [param for param in module.parameters() if param.requires_grad]
+    if not parameters:
+        return
+    gradients = torch.cat([param.grad.reshape(-1) if param.grad is not None
+                           else torch.zeros(param.numel(), device=param.device)
+                           for param in parameters])
+    dist.all_reduce(gradients)
+    gradients /= data_parallel_size()
+
+    start = 0
+    for param in parameters:
+        gradient = gradients[start:start + param.numel()].view_as(param)
+        if param.grad is None:
+            param.grad = gradient.clone()
+        else:
+            param.grad.copy_(gradient)
+        start += param.numel()
+
+
+# This rank's share of a list of batches. With shuffle, the batches are first shuffled the
+# same way on every rank, differently for every epoch. With pad, the list is padded with
+# batches from its start (as torch's DistributedSampler does) so that every rank gets the
+# same number of batches and takes the same number of steps; without it, the ranks may
+# get one batch more or less than each other.
+def shard_batches(batches, epoch=0, shuffle=True, pad=True):
+    batches = list(batches)
+    if shuffle:
+        random.Random(_shared_seed * 1000003 + epoch).shuffle(batches)
+    world_size = data_parallel_size()
+    if pad and batches and len(batches) % world_size:
+        num_padded = world_size - len(batches) % world_size
+        batches += (batches * num_padded)[:num_padded]
+    return batches[data_parallel_rank()::world_size]
+
+
+# Wait for every rank to get here
+def barrier():
+    if data_parallel_size() > 1:
+        dist.barrier()
+
+
+# Leave the process group once training is over
+def finish_data_parallel():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
@@ -19,6 +19,7 @@ import time
 import math
 
 import pickle
+import shutil
 
 import argparse
 
@@ -29,7 +30,12 @@ from training import *
 from models import *
 from evaluation import *
 from role_assignment_functions import *
+from tpdn_data import *
+from als_solver import *
+from data_parallel import *
+from hogwild import trainIters_tpr_hogwild
 from rolelearner.role_learning_tensor_product_encoder import RoleLearningTensorProductEncoder
+from rolelearner.role_learning_ensemble import RoleLearningEnsemble
 
 import numpy as np
 
@@ -59,6 +65,9 @@ parser.add_argument("--decoder_task", help="task performed by the decoder", type
                     default="auto")
 parser.add_argument("--filler_dim", help="embedding dimension for fillers", type=int, default=10)
 parser.add_argument("--role_dim", help="embedding dimension for roles", type=int, default=6)
+parser.add_argument("--binder", help="how fillers are bound to roles: tpr (tensor product), hrr "
+                                     "(circular convolution) or eltwise (elementwise product)",
+                    choices=["tpr", "hrr", "eltwise"], default="tpr")
 parser.add_argument("--vocab_size", help="vocab size for the training language", type=int,
                     default=10)
 parser.add_argument("--hidden_size", help="size of the encodings", type=int, default=60)
@@ -106,6 +115,33 @@ parser.add_argument(
     default=1,
     type=int
 )
+parser.add_argument(
+    "--role_assigner_type",
+    help="The role assignment network: an LSTM, or a transformer encoder that assigns the roles "
+         "of all of the positions at once (causal unless --bidirectional). On CPU, with 300-d "
+         "word embeddings at lengths 20-100, the transformer's training steps are 1.5-3.6x "
+         "faster than the LSTM's, and its forward pass without gradients 1.1-2.3x faster; with "
+         "small fillers, unidirectional validation at length 100 is slower (see "
+         "benchmarks/role_assigner.py).",
+    choices=["lstm", "transformer"],
+    default="lstm"
+)
+parser.add_argument(
+    "--role_assigner_num_heads",
+    help="The number of attention heads of the transformer role assigner. It must divide the "
+         "role assigner's hidden size of 20.",
+    default=4,
+    type=int
+)
+parser.add_argument(
+    "--filler_gate_table",
+    help="With frozen filler embeddings (--pretrained_filler_embedding or --embedding_file), "
+         "look up the input part of the unidirectional role assignment LSTM's first layer in a "
+         "table with a row per filler when no gradients are needed (validation and role "
+         "prediction), which is kept until the LSTM's weights change. Training steps run the "
+         "LSTM as usual.",
+    action="store_true"
+)
 parser.add_argument(
     "--output_dir",
     help="An optional output folder where files can be saved to.",
@@ -179,6 +215,220 @@ parser.add_argument(
          "different tasks.",
     action="store_true"
 )
+parser.add_argument(
+    "--data_cache",
+    help="A directory in which to cache the parsed data and role files. Cached files are "
+         "memory-mapped on later runs instead of being parsed again.",
+    type=str,
+    default=None
+)
+parser.add_argument(
+    "--num_workers",
+    help="The number of processes used to parse the data and role files.",
+    type=int,
+    default=1
+)
+parser.add_argument(
+    "--stream",
+    help="Stream the training set from the memory-mapped data cache in shuffled, length-"
+         "bucketed chunks instead of loading it into memory. Uses --data_cache, which "
+         "defaults to a cache directory inside --data_path in this mode.",
+    action="store_true"
+)
+parser.add_argument(
+    "--stream_chunk_size",
+    help="The number of training sequences read into memory at a time with --stream.",
+    type=int,
+    default=100000
+)
+parser.add_argument(
+    "--pad_batches",
+    help="Batch sequences of different lengths together, padding them and masking the "
+         "padding, instead of only batching sequences of equal length. No training or dev "
+         "sequence is dropped in this mode.",
+    action="store_true"
+)
+parser.add_argument(
+    "--batch_tokens",
+    help="Make batches of up to this many filler tokens (padding included) instead of "
+         "--batch_size sequences, so that every batch costs about the same.",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "--batch_flops",
+    help="Make batches of up to this many estimated floating point operations instead of "
+         "--batch_size sequences.",
+    type=float,
+    default=None
+)
+parser.add_argument(
+    "--mega_bucket_size",
+    help="With --pad_batches and --batch_tokens or --batch_flops, sort random groups of this "
+         "many sequences by length every epoch before batching them, instead of batching the "
+         "whole length-sorted data set the same way every epoch.",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "--prefetch",
+    help="Build this many training and dev batches ahead of time on a background thread "
+         "while the model trains on the current batch. 0 builds every batch when it is used.",
+    type=int,
+    default=0
+)
+parser.add_argument(
+    "--pin_memory",
+    help="Keep batches in page-locked memory so that they are copied to the GPU "
+         "asynchronously. Only used with CUDA.",
+    action="store_true"
+)
+parser.add_argument(
+    "--seed",
+    help="The random seed, for reproducible batch orders and initializations.",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "--solver",
+    help="How to fit the TPDN: adam trains it by gradient descent, als fits a "
+         "TensorProductEncoder with fixed roles by alternating least squares.",
+    choices=["adam", "als"],
+    default="adam"
+)
+parser.add_argument(
+    "--als_sweeps",
+    help="The maximum number of alternating least squares sweeps with --solver als.",
+    type=int,
+    default=100
+)
+parser.add_argument(
+    "--validate_every_steps",
+    help="Validate every this many training steps instead of after every epoch. --patience "
+         "then counts validation rounds.",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "--validate_every_seconds",
+    help="Validate every this many seconds of training instead of after every epoch.",
+    type=float,
+    default=None
+)
+parser.add_argument(
+    "--dev_subsample",
+    help="Validate on a fixed random subset of the dev batches holding about this many "
+         "sequences instead of on the full dev set.",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "--confirm_full_dev",
+    help="With --dev_subsample, confirm an improvement on the subsample on the full dev set "
+         "before saving the model.",
+    action="store_true"
+)
+parser.add_argument(
+    "--time_budget",
+    help="Stop training after this many seconds, with a last validation round before the "
+         "deadline. Unless a validation cadence is given, about 20 validation rounds are "
+         "spread over the budget. The loss of every round, and the loss projected for the "
+         "deadline, are written to progress.tsv in the output folder (or next to the model).",
+    type=float,
+    default=None
+)
+parser.add_argument(
+    "--resume",
+    help="Resume training from the training state saved by an earlier run with the same "
+         "arguments (training_state.pt in the output folder, or next to the model). The state "
+         "is saved after every validation round and when the job gets SIGTERM.",
+    action="store_true"
+)
+parser.add_argument(
+    "--async_validation",
+    help="Validate in a separate process on a copy of the weights, so that training goes on "
+         "during validation. Early stopping acts on the results as they arrive. CPU only. The "
+         "validation process needs a core of its own; on one core it slows training down (see "
+         "benchmarks/time_to_loss.py).",
+    action="store_true"
+)
+parser.add_argument(
+    "--max_validation_lag",
+    help="With --async_validation, the number of validation rounds that may be outstanding "
+         "before training waits for their results.",
+    type=int,
+    default=1
+)
+parser.add_argument(
+    "--distributed",
+    help="Train data-parallel over the processes started by torchrun (gloo backend), e.g. "
+         "torchrun --nproc_per_node 8 decompose.py --distributed .... Each process trains on "
+         "a share of the batches and the gradients are averaged between them.",
+    action="store_true"
+)
+parser.add_argument(
+    "--hogwild_workers",
+    help="Train on the CPU with this many Hogwild worker processes, which update one shared "
+         "copy of the TPDN without locks, while the main process validates it. 0 trains in "
+         "the main process. The workers only take steps side by side with a core each; on "
+         "one core they reach a given validation loss no sooner than plain training (see "
+         "benchmarks/time_to_loss.py).",
+    type=int,
+    default=0
+)
+parser.add_argument(
+    "--ensemble_size",
+    help="With --role_learning, train this many role learning TPDNs side by side in one "
+         "batched model, each with its own initialization and regularization weights and its "
+         "own early stopping. The member with the lowest validation loss is used afterwards.",
+    type=int,
+    default=1
+)
+parser.add_argument(
+    "--ensemble_one_hot_regularization_weights",
+    help="The one hot regularization weight of each ensemble member (one value per member, or "
+         "a single value for all). Defaults to --one_hot_regularization_weight.",
+    type=float,
+    nargs="+",
+    default=None
+)
+parser.add_argument(
+    "--ensemble_l2_norm_regularization_weights",
+    help="The l2 norm regularization weight of each ensemble member. Defaults to "
+         "--l2_norm_regularization_weight.",
+    type=float,
+    nargs="+",
+    default=None
+)
+parser.add_argument(
+    "--ensemble_unique_role_regularization_weights",
+    help="The unique role regularization weight of each ensemble member. Defaults to "
+         "--unique_role_regularization_weight.",
+    type=float,
+    nargs="+",
+    default=None
+)
+parser.add_argument(
+    "--fused_binding",
+    help="Compute the bindings and the final linear layer together, without building the "
+         "tensor product when projecting the role embeddings first is cheaper.",
+    action="store_true"
+)
+parser.add_argument(
+    "--projection_rank",
+    help="If specified, the final linear layer is factorized with this rank (see "
+         "--projection_type) instead of being a dense filler_dim * role_dim x hidden_size "
+         "matrix.",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "--projection_type",
+    help="The factorization of the final linear layer with --projection_rank: cp (rank-r CP) "
+         "or tucker (rank-(r, r) Tucker).",
+    choices=["cp", "tucker"],
+    default="cp"
+)
 parser.add_argument(
     "--scan_checkpoint",
     help="The location of a SCAN checkpoint. Settings this argument enables the SCAN task.",
@@ -190,6 +440,126 @@ parser.add_argument(
 
 args = parser.parse_args()
 
+if args.stream:
+    if args.shuffle:
+        parser.error("--shuffle cannot be used with --stream")
+    if args.pad_batches:
+        parser.error("--pad_batches cannot be used with --stream")
+    if args.data_cache is None:
+        args.data_cache = os.path.join(args.data_path, "cache")
+if args.batch_tokens is not None and args.batch_flops is not None:
+    parser.error("--batch_tokens and --batch_flops cannot be used together")
+if args.stream and (args.batch_tokens is not None or args.batch_flops is not None):
+    parser.error("--batch_tokens and --batch_flops cannot be used with --stream")
+if args.mega_bucket_size is not None and not args.pad_batches:
+    parser.error("--mega_bucket_size requires --pad_batches")
+if args.solver == "als":
+    if args.role_learning:
+        parser.error("--solver als cannot be used with --role_learning")
+    if args.embed_squeeze is not None:
+        parser.error("--solver als cannot be used with --embed_squeeze")
+    if args.stream:
+        parser.error("--solver als cannot be used with --stream")
+if args.ensemble_size > 1:
+    if not args.role_learning:
+        parser.error("--ensemble_size requires --role_learning")
+    if args.role_assigner_type != "lstm":
+        parser.error("--ensemble_size requires --role_assigner_type lstm")
+    if args.stream:
+        parser.error("--ensemble_size cannot be used with --stream")
+if args.binder != "tpr":
+    if args.filler_dim != args.role_dim:
+        parser.error("--binder {} requires --filler_dim and --role_dim to be equal".format(
+            args.binder))
+    if args.solver == "als":
+        parser.error("--solver als requires --binder tpr")
+    if args.ensemble_size > 1:
+        parser.error("--ensemble_size requires --binder tpr")
+    if args.fused_binding:
+        parser.error("--fused_binding requires --binder tpr")
+if args.filler_gate_table:
+    if not args.role_learning or args.role_assigner_type != "lstm":
+        parser.error("--filler_gate_table requires --role_learning and the LSTM role assigner")
+    if args.bidirectional:
+        parser.error("--filler_gate_table cannot be used with --bidirectional")
+    if args.pretrained_filler_embedding is None and args.embedding_file is None:
+        parser.error("--filler_gate_table requires frozen filler embeddings, from "
+                     "--pretrained_filler_embedding or --embedding_file")
+if args.fused_binding and args.final_linear != "True":
+    parser.error("--fused_binding requires --final_linear True")
+if args.projection_rank is not None:
+    if args.final_linear != "True":
+        parser.error("--projection_rank requires --final_linear True")
+    if args.binder != "tpr":
+        parser.error("--projection_rank requires --binder tpr")
+    if args.fused_binding:
+        parser.error("--projection_rank cannot be used with --fused_binding")
+    if args.solver == "als":
+        parser.error("--projection_rank cannot be used with --solver als")
+    if args.ensemble_size > 1:
+        parser.error("--projection_rank cannot be used with --ensemble_size")
+if args.confirm_full_dev and args.dev_subsample is None:
+    parser.error("--confirm_full_dev requires --dev_subsample")
+if args.dev_subsample is not None and args.dev_subsample < 1:
+    parser.error("--dev_subsample must be at least 1, so that there is a dev batch to "
+                 "validate on")
+if args.time_budget is not None and (args.solver == "als" or args.hogwild_workers or
+                                     args.ensemble_size > 1 or args.distributed):
+    parser.error("--time_budget can only be used with single-process gradient descent")
+if args.resume and (args.solver == "als" or args.hogwild_workers or args.ensemble_size > 1 or
+                    args.distributed):
+    parser.error("--resume can only be used with single-process gradient descent")
+if args.async_validation and (args.solver == "als" or args.hogwild_workers or
+                              args.ensemble_size > 1 or args.distributed or args.resume or
+                              args.time_budget is not None):
+    parser.error("--async_validation cannot be used with --solver als, --hogwild_workers, "
+                 "--ensemble_size, --distributed, --resume or --time_budget")
+if args.distributed:
+    if args.validate_every_seconds is not None:
+        parser.error("--validate_every_seconds cannot be used with --distributed, whose ranks "
+                     "must validate at the same steps; use --validate_every_steps")
+    if args.stream:
+        parser.error("--distributed cannot be used with --stream")
+    if args.solver == "als":
+        parser.error("--distributed cannot be used with --solver als")
+    if args.ensemble_size > 1:
+        parser.error("--distributed cannot be used with --ensemble_size")
+if args.hogwild_workers:
+    if args.stream:
+        parser.error("--hogwild_workers cannot be used with --stream")
+    if args.solver == "als":
+        parser.error("--hogwild_workers cannot be used with --solver als")
+    if args.ensemble_size > 1:
+        parser.error("--hogwild_workers cannot be used with --ensemble_size")
+    if args.distributed:
+        parser.error("--hogwild_workers cannot be used with --distributed")
+    if args.validate_every_steps is not None or args.validate_every_seconds is not None or \
+            args.dev_subsample is not None:
+        parser.error("--hogwild_workers validates after every epoch on the full dev set")
+for regularization in ["one_hot", "l2_norm", "unique_role"]:
+    name = "ensemble_{}_regularization_weights".format(regularization)
+    weights = getattr(args, name)
+    if weights is None:
+        weights = [getattr(args, "{}_regularization_weight".format(regularization))]
+    if len(weights) == 1:
+        weights = weights * args.ensemble_size
+    if len(weights) != args.ensemble_size:
+        parser.error("--{} needs one value or --ensemble_size values".format(name))
+    setattr(args, name, weights)
+
+if args.distributed:
+    # Every rank seeds its generators with the same seed, and so builds the same model
+    args.seed = init_data_parallel(args.seed)
+    torch.set_num_threads(threads_per_rank())
+    # Only rank 0 reports progress
+    if data_parallel_rank() != 0:
+        sys.stdout = open(os.devnull, 'w')
+
+if args.seed is not None:
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
 output_dir = None
 if args.output_dir:
     output_dir = os.path.join('output/', args.output_dir)
@@ -267,258 +637,96 @@ elif args.test_decoder == "True" and args.scan_checkpoint:
     output_lang = checkpoint['output_lang']
 
 
-# Prepare the train, dev, and test data
-unindexed_train = []
-unindexed_dev = []
-unindexed_test = []
-unindexed_extra = []
+# Prepare the train, dev, and test data. Fillers are indexed in the order they are first
+# seen across the train, dev, test and extra files. Each split is kept as a flat array of
+# filler ids with per-sequence offsets. When streaming, the training sequences are read
+# chunk by chunk during training instead.
+sequence_files, filler_to_index, index_to_filler, max_length, filler_arrays = load_tpdn_splits(
+    args.data_path, args.data_prefix, extra_test_set=args.extra_test_set,
+    digits=args.digits == "True", cache_dir=args.data_cache, num_workers=args.num_workers,
+    skip_splits=[0] if args.stream else [])
+filler_counter = len(filler_to_index)
 
-filler_to_index = {}
-index_to_filler = {}
 role_to_index = {}
 index_to_role = {}
-
-filler_counter = 0
 role_counter = 0
-max_length = 0
-
-train_file = open(os.path.join(args.data_path, args.data_prefix + ".data_from_train"), "r")
-for line in train_file:
-    sequence, vector = line.strip().split("\t")
-    unindexed_train.append(([value for value in sequence.split()], Variable(
-        torch.FloatTensor(np.array([float(value) for value in vector.split()])))))
-
-    if len(sequence.split()) > max_length:
-        max_length = len(sequence.split())
-
-    for filler in sequence.split():
-        if filler not in filler_to_index:
-            filler_to_index[filler] = filler_counter
-            index_to_filler[filler_counter] = filler
-            filler_counter += 1
-
-dev_file = open(os.path.join(args.data_path, args.data_prefix + ".data_from_dev"), "r")
-for line in dev_file:
-    sequence, vector = line.strip().split("\t")
-    unindexed_dev.append(([value for value in sequence.split()], Variable(
-        torch.FloatTensor(np.array([float(value) for value in vector.split()])))))
-
-    if len(sequence.split()) > max_length:
-        max_length = len(sequence.split())
-
-    for filler in sequence.split():
-        if filler not in filler_to_index:
-            filler_to_index[filler] = filler_counter
-            index_to_filler[filler_counter] = filler
-            filler_counter += 1
 
 if args.shuffle:
     print("Shuffling the input sequences and corresponding embeddings")
-    sequences = []
-    embeddings = []
-    for sequence, embedding in unindexed_train:
-        sequences.append(sequence)
-        embeddings.append(embedding)
-    shuffle(sequences)
-    unindexed_train = []
-    for i in range(len(sequences)):
-        unindexed_train.append((sequences[i], embeddings[i]))
-
-    sequences = []
-    embeddings = []
-    for sequence, embedding in unindexed_dev:
-        sequences.append(sequence)
-        embeddings.append(embedding)
-    shuffle(sequences)
-    unindexed_dev = []
-    for i in range(len(sequences)):
-        unindexed_dev.append((sequences[i], embeddings[i]))
-
-test_file = open(os.path.join(args.data_path, args.data_prefix + ".data_from_test"), "r")
-for line in test_file:
-    sequence, vector = line.strip().split("\t")
-    unindexed_test.append(([value for value in sequence.split()], Variable(
-        torch.FloatTensor(np.array([float(value) for value in vector.split()])))))
-
-    if len(sequence.split()) > max_length:
-        max_length = len(sequence.split())
-
-    for filler in sequence.split():
-        if filler not in filler_to_index:
-            filler_to_index[filler] = filler_counter
-            index_to_filler[filler_counter] = filler
-            filler_counter += 1
-
-if args.extra_test_set is not None:
-    extra_file = open(os.path.join(args.data_path, args.extra_test_set), "r")
-    for line in extra_file:
-        sequence, vector = line.strip().split("\t")
-        unindexed_extra.append(([value for value in sequence.split()], Variable(
-            torch.FloatTensor(np.array([float(value) for value in vector.split()]))).cuda()))
-
-        if len(sequence.split()) > max_length:
-            max_length = len(sequence.split())
-
-        for filler in sequence.split():
-            if filler not in filler_to_index:
-                filler_to_index[filler] = filler_counter
-                index_to_filler[filler_counter] = filler
-                filler_counter += 1
-
-if args.digits == "True":
-    for i in range(10):
-        filler_to_index[str(i)] = i
-        index_to_filler[i] = str(i)
-
-indexed_train = [([filler_to_index[filler] for filler in elt[0]], elt[1]) for elt in
-                 unindexed_train]
-indexed_dev = [([filler_to_index[filler] for filler in elt[0]], elt[1]) for elt in unindexed_dev]
-indexed_test = [([filler_to_index[filler] for filler in elt[0]], elt[1]) for elt in unindexed_test]
-indexed_extra = [([filler_to_index[filler] for filler in elt[0]], elt[1]) for elt in
-                 unindexed_extra]
-
-unindexed_train_roles = []
-unindexed_dev_roles = []
-unindexed_test_roles = []
-unindexed_extra_roles = []
+    for split in [0, 1]:
+        order = list(range(len(filler_arrays[split][1]) - 1))
+        shuffle(order)
+        filler_arrays[split] = gather_sequences(filler_arrays[split][0],
+                                                filler_arrays[split][1], order)
+
+# Until a role file or a role scheme provides them, every split has no roles
+role_arrays = [None if arrays is None else
+               (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+               for arrays in filler_arrays]
 
 n_r = -1
 
 # If there is a file of roles for the fillers, load those roles
 if args.role_prefix is not None:
-    train_role_file = open(
-        os.path.join(args.data_path, args.role_prefix + ".data_from_train.roles"), "r")
-    for line in train_role_file:
-        unindexed_train_roles.append(line.strip().split())
-        for role in line.strip().split():
-            if role not in role_to_index:
-                role_to_index[role] = role_counter
-                index_to_role[role_counter] = role
-                role_counter += 1
-
-    dev_role_file = open(
-        os.path.join(args.data_path, args.role_prefix + ".data_from_dev.roles"), "r")
-    for line in dev_role_file:
-        unindexed_dev_roles.append(line.strip().split())
-        for role in line.strip().split():
-            if role not in role_to_index:
-                role_to_index[role] = role_counter
-                index_to_role[role_counter] = role
-                role_counter += 1
-
-    test_role_file = open(
-        os.path.join(args.data_path, args.role_prefix + ".data_from_test.roles"), "r")
-    for line in test_role_file:
-        unindexed_test_roles.append(line.strip().split())
-        for role in line.strip().split():
-            if role not in role_to_index:
-                role_to_index[role] = role_counter
-                index_to_role[role_counter] = role
-                role_counter += 1
-
+    role_files = [
+        os.path.join(args.data_path, args.role_prefix + ".data_from_train.roles"),
+        os.path.join(args.data_path, args.role_prefix + ".data_from_dev.roles"),
+        os.path.join(args.data_path, args.role_prefix + ".data_from_test.roles")
+    ]
     if args.extra_test_set is not None:
-        extra_role_file = open(os.path.join(args.data_path, args.extra_test_set + ".roles"), "r")
-        for line in extra_role_file:
-            unindexed_extra_roles.append(line.strip().split())
-            for role in line.strip().split():
-                if role not in role_to_index:
-                    role_to_index[role] = role_counter
-                    index_to_role[role_counter] = role
-                    role_counter += 1
+        role_files.append(os.path.join(args.data_path, args.extra_test_set + ".roles"))
 
+    role_sequence_files = load_sequence_files(role_files, has_vectors=False,
+                                              cache_dir=args.data_cache,
+                                              num_workers=args.num_workers)
+    role_to_index, index_to_role = merge_vocabularies([f.vocab for f in role_sequence_files])
+    role_counter = len(role_to_index)
 
+    role_arrays = [None if args.stream and i == 0 else
+                   (index_tokens(f, role_to_index), np.asarray(f.offsets))
+                   for i, f in enumerate(role_sequence_files)]
 
 # Or, if a predefined role scheme is being used, prepare it
 elif args.role_scheme is not None:
-    if args.role_scheme == "bow":
-        n_r, seq_to_roles = create_bow_roles(max_length, len(filler_to_index.keys()))
-    elif args.role_scheme == "ltr":
-        n_r, seq_to_roles = create_ltr_roles(max_length, len(filler_to_index.keys()))
-    elif args.role_scheme == "rtl":
-        n_r, seq_to_roles = create_rtl_roles(max_length, len(filler_to_index.keys()))
-    elif args.role_scheme == "bi":
-        n_r, seq_to_roles = create_bidirectional_roles(max_length, len(filler_to_index.keys()))
-    elif args.role_scheme == "wickel":
-        n_r, seq_to_roles = create_wickel_roles(max_length, len(filler_to_index.keys()))
-    elif args.role_scheme == "tree":
-        n_r, seq_to_roles = create_tree_roles(max_length, len(filler_to_index.keys()))
-    elif args.role_scheme == "interleave":
-        n_r, seq_to_roles = create_interleaving_tree_roles(max_length, len(filler_to_index.keys()))
-    else:
-        print("Invalid role scheme")
-
-    for pair in indexed_train:
-        these_roles = seq_to_roles(pair[0])
-        unindexed_train_roles.append(these_roles)
-        for role in these_roles:
-            if role not in role_to_index:
-                role_to_index[role] = role
-                index_to_role[role] = role
-                role_counter += 1
-
-    for pair in indexed_dev:
-        these_roles = seq_to_roles(pair[0])
-        unindexed_dev_roles.append(these_roles)
-        for role in these_roles:
-            if role not in role_to_index:
-                role_to_index[role] = role
-                index_to_role[role] = role
-                role_counter += 1
-
-    for pair in indexed_test:
-        these_roles = seq_to_roles(pair[0])
-        unindexed_test_roles.append(these_roles)
-        for role in these_roles:
-            if role not in role_to_index:
-                role_to_index[role] = role
-                index_to_role[role] = role
-                role_counter += 1
-
-    for pair in indexed_extra:
-        these_roles = seq_to_roles(pair[0])
-        unindexed_extra_roles.append(these_roles)
-        for role in these_roles:
-            if role not in role_to_index:
-                role_to_index[role] = role
-                index_to_role[role] = role
-                role_counter += 1
+    n_r, seq_to_roles = create_role_scheme(args.role_scheme, max_length,
+                                           len(filler_to_index.keys()))
+
+    role_arrays = [None if arrays is None else sequence_roles(seq_to_roles, *arrays)
+                   for arrays in filler_arrays]
+
+    # The roles produced by a role scheme are already indices
+    for role in np.unique(np.concatenate([roles for roles, _ in
+                                          filter(None, role_arrays)])).tolist():
+        role_to_index[role] = role
+        index_to_role[role] = role
+        role_counter += 1
 else:
     print("No role scheme specified")
 
-indexed_train_roles = [[role_to_index[role] for role in roles] for roles in unindexed_train_roles]
-indexed_dev_roles = [[role_to_index[role] for role in roles] for roles in unindexed_dev_roles]
-indexed_test_roles = [[role_to_index[role] for role in roles] for roles in unindexed_test_roles]
-indexed_extra_roles = [[role_to_index[role] for role in roles] for roles in unindexed_extra_roles]
-
-all_train_data = []
-all_dev_data = []
-all_test_data = []
-all_extra_data = []
-
 # Make sure the number of fillers and the number of roles always matches
-for index, element in enumerate(indexed_train):
-    if len(element[0]) != len(indexed_train_roles[index]):
-        print(index, "ERROR!!!", element[0], indexed_train_roles[index])
-    else:
-        all_train_data.append((element[0], indexed_train_roles[index], element[1]))
-
-for index, element in enumerate(indexed_dev):
-    if len(element[0]) != len(indexed_dev_roles[index]):
-        print(index, "ERROR!!!", element[0], indexed_dev_roles[index])
-    else:
-        all_dev_data.append((element[0], indexed_dev_roles[index], element[1]))
-
-for index, element in enumerate(indexed_test):
-    if len(element[0]) != len(indexed_test_roles[index]):
-        print(index, "ERROR!!!", element[0], indexed_test_roles[index])
-    else:
-        all_test_data.append((element[0], indexed_test_roles[index], element[1]))
-
-for index, element in enumerate(indexed_extra):
-    if len(element[0]) != len(indexed_extra_roles[index]):
-        print(index, "ERROR!!!", element[0], indexed_extra_roles[index])
-    else:
-        all_extra_data.append((element[0], indexed_extra_roles[index], element[1]))
+datasets = build_tpdn_datasets(filler_arrays, role_arrays,
+                               [vectors_to_tensor(f.vectors) for f in sequence_files])
+
+# Store the training and dev sets sorted by length, so that every batch is a view of them
+all_train_data = datasets[0].sorted_by_length() if datasets[0] is not None else None
+all_dev_data = datasets[1].sorted_by_length()
+all_test_data = datasets[2]
+all_extra_data = datasets[3] if args.extra_test_set is not None else None
+del datasets, filler_arrays, role_arrays
+
+if args.stream:
+    train_stream = TPDNStream(
+        sequence_files[0],
+        token_remap(sequence_files[0], filler_to_index),
+        args.batch_size,
+        chunk_size=args.stream_chunk_size,
+        role_file=role_sequence_files[0] if args.role_prefix is not None else None,
+        role_remap=token_remap(role_sequence_files[0], role_to_index)
+        if args.role_prefix is not None else None,
+        seq_to_roles=seq_to_roles if args.role_prefix is None else None,
+        seed=args.seed
+    )
+del sequence_files
 
 weights_matrix = None
 
@@ -564,23 +772,35 @@ if args.role_learning:
     if args.num_roles:
         role_counter = args.num_roles
     print("Using RoleLearningTensorProductEncoder with {} roles".format(role_counter))
-    tpr_encoder = RoleLearningTensorProductEncoder(
-        n_roles=role_counter,
-        n_fillers=filler_counter,
-        final_layer_width=final_layer_width,
-        filler_dim=args.filler_dim,
-        role_dim=args.role_dim,
-        pretrained_filler_embeddings=args.pretrained_filler_embedding,
-        embedder_squeeze=args.embed_squeeze,
-        role_assignment_shrink_filler_dim=args.role_assignment_shrink_filler_dim,
-        bidirectional=args.bidirectional,
-        num_layers=args.role_assigner_num_layers,
-        softmax_roles=args.softmax_roles,
-        pretrained_embeddings=weights_matrix,
-        one_hot_regularization_weight=args.one_hot_regularization_weight,
-        l2_norm_regularization_weight=args.l2_norm_regularization_weight,
-        unique_role_regularization_weight=args.unique_role_regularization_weight,
-    )
+
+    # Ensemble member k (the only member without --ensemble_size)
+    def role_learning_encoder(k):
+        return RoleLearningTensorProductEncoder(
+            n_roles=role_counter,
+            n_fillers=filler_counter,
+            final_layer_width=final_layer_width,
+            filler_dim=args.filler_dim,
+            role_dim=args.role_dim,
+            binder=args.binder,
+            pretrained_filler_embeddings=args.pretrained_filler_embedding,
+            embedder_squeeze=args.embed_squeeze,
+            role_assignment_shrink_filler_dim=args.role_assignment_shrink_filler_dim,
+            bidirectional=args.bidirectional,
+            num_layers=args.role_assigner_num_layers,
+            softmax_roles=args.softmax_roles,
+            pretrained_embeddings=weights_matrix,
+            one_hot_regularization_weight=args.ensemble_one_hot_regularization_weights[k],
+            l2_norm_regularization_weight=args.ensemble_l2_norm_regularization_weights[k],
+            unique_role_regularization_weight=args.ensemble_unique_role_regularization_weights[k],
+            fused_binding=args.fused_binding,
+            projection_rank=args.projection_rank,
+            projection_type=args.projection_type,
+            role_assigner_type=args.role_assigner_type,
+            role_assigner_num_heads=args.role_assigner_num_heads,
+            filler_gate_table=args.filler_gate_table,
+        )
+
+    tpr_encoder = role_learning_encoder(0)
 else:
     print("Using TensorProductEncoder")
     tpr_encoder = TensorProductEncoder(
@@ -589,11 +809,21 @@ else:
         final_layer_width=final_layer_width,
         filler_dim=args.filler_dim,
         role_dim=args.role_dim,
+        binder=args.binder,
         pretrained_embeddings=weights_matrix,
         embedder_squeeze=args.embed_squeeze,
-        pretrained_filler_embeddings=args.pretrained_filler_embedding
+        pretrained_filler_embeddings=args.pretrained_filler_embedding,
+        fused_binding=args.fused_binding,
+        projection_rank=args.projection_rank,
+        projection_type=args.projection_type
     )
 
+if args.projection_rank is not None:
+    print("Final layer: {} projection of rank {}, {} parameters instead of {}".format(
+        args.projection_type, args.projection_rank,
+        sum(param.numel() for param in tpr_encoder.last_layer.parameters()),
+        (args.filler_dim * args.role_dim + 1) * final_layer_width))
+
 if use_cuda:
     tpr_encoder = tpr_encoder.cuda()
 
@@ -610,31 +840,137 @@ if args.train == "True":
     else:
         weight_file = "models/" + args.data_prefix + str(
                                   args.role_prefix) + str(args.role_scheme) + ".tpr"
-    end_loss = trainIters_tpr(
-        all_train_data,
-        all_dev_data,
-        tpr_encoder,
-        n_epochs=1000,
-        learning_rate=0.001,
-        weight_file=weight_file,
-        batch_size=args.batch_size,
-        use_one_hot_temperature=args.use_one_hot_temperature,
-        patience=args.patience,
-        burn_in=args.burn_in
-    )
+    if args.solver == "als":
+        end_loss = fit_tpr_als(
+            all_train_data,
+            all_dev_data,
+            tpr_encoder,
+            weight_file,
+            max_sweeps=args.als_sweeps,
+            patience=args.patience
+        )
+    else:
+        train_data = train_stream if args.stream else all_train_data
+        dev_data = all_dev_data
+        if args.batch_tokens is not None or args.batch_flops is not None:
+            if args.batch_flops is not None:
+                max_cost = args.batch_flops
+                # The typical batch of the budget, for the cost of the fused binding
+                token_cost, sequence_cost = tpr_flop_costs(
+                    tpr_encoder, max_cost, int(round(all_train_data.lengths().mean())))
+            else:
+                max_cost, token_cost, sequence_cost = args.batch_tokens, 1, 0
+            train_data = TokenBudgetSampler(
+                all_train_data, max_cost, pad=args.pad_batches,
+                mega_bucket_size=args.mega_bucket_size, token_cost=token_cost,
+                sequence_cost=sequence_cost, seed=args.seed
+            )
+            dev_data = TokenBudgetSampler(
+                all_dev_data, max_cost, pad=args.pad_batches, token_cost=token_cost,
+                sequence_cost=sequence_cost
+            )
+            print("Batching up to {} per batch: {} training batches".format(
+                max_cost, len(train_data)))
+
+        if args.ensemble_size > 1:
+            members = [tpr_encoder] + [role_learning_encoder(k).to(device)
+                                       for k in range(1, args.ensemble_size)]
+            member_weight_files = [weight_file[:-len(".tpr")] + ".member{}.tpr".format(k)
+                                   for k in range(args.ensemble_size)]
+            member_losses = trainIters_tpr_ensemble(
+                train_data,
+                dev_data,
+                RoleLearningEnsemble(members).to(device),
+                tpr_encoder,
+                n_epochs=1000,
+                learning_rate=0.001,
+                weight_files=member_weight_files,
+                batch_size=args.batch_size,
+                patience=args.patience,
+                burn_in=args.burn_in,
+                pad_batches=args.pad_batches
+            )
+            # Continue with the best member
+            best_member = int(np.argmin(member_losses))
+            for k, member_loss in enumerate(member_losses):
+                print("Ensemble member {}: best validation loss {}".format(k, member_loss))
+            print("Using ensemble member {}".format(best_member))
+            tpr_encoder = members[best_member]
+            shutil.copyfile(member_weight_files[best_member], weight_file)
+            end_loss = member_losses[best_member]
+        elif args.hogwild_workers:
+            end_loss = trainIters_tpr_hogwild(
+                train_data,
+                dev_data,
+                tpr_encoder,
+                n_epochs=1000,
+                num_workers=args.hogwild_workers,
+                learning_rate=0.001,
+                weight_file=weight_file,
+                batch_size=args.batch_size,
+                patience=args.patience,
+                burn_in=args.burn_in,
+                pad_batches=args.pad_batches,
+                seed=args.seed
+            )
+        else:
+            progress_file = None
+            if args.time_budget is not None:
+                progress_file = os.path.join(output_dir, 'progress.tsv') if output_dir else \
+                    weight_file[:-len(".tpr")] + ".progress.tsv"
+            # The full training state, for --resume. Data-parallel ranks, and runs that
+            # validate asynchronously, do not save it.
+            state_file = None
+            if not args.distributed and not args.async_validation:
+                state_file = os.path.join(output_dir, 'training_state.pt') if output_dir else \
+                    weight_file[:-len(".tpr")] + ".state"
+            try:
+                end_loss = trainIters_tpr(
+                    train_data,
+                    dev_data,
+                    tpr_encoder,
+                    n_epochs=1000,
+                    learning_rate=0.001,
+                    weight_file=weight_file,
+                    batch_size=args.batch_size,
+                    use_one_hot_temperature=args.use_one_hot_temperature,
+                    patience=args.patience,
+                    burn_in=args.burn_in,
+                    pad_batches=args.pad_batches,
+                    prefetch=args.prefetch,
+                    pin_memory=args.pin_memory,
+                    distributed=args.distributed,
+                    validate_every_steps=args.validate_every_steps,
+                    validate_every_seconds=args.validate_every_seconds,
+                    dev_subsample=args.dev_subsample,
+                    confirm_full_dev=args.confirm_full_dev,
+                    time_budget=args.time_budget,
+                    progress_file=progress_file,
+                    state_file=state_file,
+                    resume=args.resume,
+                    async_validation=args.async_validation,
+                    max_validation_lag=args.max_validation_lag
+                )
+            except TrainingInterrupted as interruption:
+                # Exit without evaluating; the run can be continued with --resume
+                sys.exit(str(interruption))
 print("Finished training")
 
+# Only rank 0 of a data-parallel run goes on to evaluate the TPDN
+if args.distributed:
+    rank = data_parallel_rank()
+    finish_data_parallel()
+    if rank != 0:
+        sys.exit(0)
+
 # Load the trained TPDN
 tpr_encoder.load_state_dict(torch.load(weight_file, map_location=device))
 
-# Prepare test data
-all_test_data_orig = all_test_data
-all_test_data = batchify_tpr(all_test_data, 1)
-
-test_data_sets = [(Variable(torch.LongTensor([item[0] for item in batch])),
-                   Variable(torch.LongTensor([item[1] for item in batch])),
-                   torch.cat([item[2].unsqueeze(0).unsqueeze(0) for item in batch], 1)) for
-                  batch in all_test_data]
+# Prepare test data: one batch per example, and the matching one-example batches that the
+# decoder scoring functions expect
+test_dataset = all_test_data
+test_data_sets = [test_dataset.batch(i, i + 1) for i in range(len(test_dataset))]
+all_test_data = [[test_dataset[i]] for i in range(len(test_dataset))]
 
 neighbor_counter = 0
 neighbor_total_rank = 0
@@ -799,47 +1135,29 @@ if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
     test_role_file = open(
         os.path.join(output_dir, args.data_prefix + '.' + basename + '.data_from_test.roles'), 'w')
 
-    for line in train_data_file:
-        sequence, embedding = line.strip().split('\t')
-        sequence = sequence.split()
-        sequence = list(map(lambda filler: filler_to_index[filler], sequence))
-        sequence = torch.LongTensor([sequence])
-        if use_cuda:
-            sequence = sequence.cuda()
-        role_emb, role_weights = role_assigner(sequence)
-        roles = []
-        for i in range(len(role_weights)):
-            roles.append(str(np.argmax(role_weights[i].cpu().detach().numpy())))
-        train_role_file.write(' '.join(roles) + '\n')
-    train_role_file.close()
-
-    for line in dev_data_file:
-        sequence, embedding = line.strip().split("\t")
-        sequence = sequence.split()
-        sequence = list(map(lambda filler: filler_to_index[filler], sequence))
-        sequence = torch.LongTensor([sequence])
-        if use_cuda:
-            sequence = sequence.cuda()
-        role_emb, role_weights = role_assigner(sequence)
-        roles = []
-        for i in range(len(role_weights)):
-            roles.append(str(np.argmax(role_weights[i].cpu().detach().numpy())))
-        dev_role_file.write(' '.join(roles) + '\n')
-    dev_role_file.close()
-
-    for line in test_data_file:
-        sequence, embedding = line.strip().split("\t")
-        sequence = sequence.split()
-        sequence = list(map(lambda filler: filler_to_index[filler], sequence))
-        sequence = torch.LongTensor([sequence])
-        if use_cuda:
-            sequence = sequence.cuda()
-        role_emb, role_weights = role_assigner(sequence)
-        roles = []
-        for i in range(len(role_weights)):
-            roles.append(str(np.argmax(role_weights[i].cpu().detach().numpy())))
-        test_role_file.write(' '.join(roles) + '\n')
-    test_role_file.close()
+    # Write the predicted role of every filler in data_file to role_file, running the role
+    # assigner on padded batches of sequences with their lengths
+    def write_role_predictions(data_file, role_file):
+        sequences = [[filler_to_index[filler] for filler in line.strip().split('\t')[0].split()]
+                     for line in data_file]
+        for start in range(0, len(sequences), args.batch_size):
+            batch = sequences[start:start + args.batch_size]
+            lengths = torch.LongTensor([len(sequence) for sequence in batch])
+            max_length = max(1, int(lengths.max()))
+            fillers = torch.LongTensor([sequence + [0] * (max_length - len(sequence))
+                                        for sequence in batch])
+            if use_cuda:
+                fillers = fillers.cuda()
+            with torch.no_grad():
+                role_emb, role_weights = role_assigner(fillers, lengths)
+            predicted_roles = torch.argmax(role_weights, 2).t().cpu().tolist()
+            for sequence_roles, length in zip(predicted_roles, lengths.tolist()):
+                role_file.write(' '.join(str(role) for role in sequence_roles[:length]) + '\n')
+        role_file.close()
+
+    write_role_predictions(train_data_file, train_role_file)
+    write_role_predictions(dev_data_file, dev_role_file)
+    write_role_predictions(test_data_file, test_role_file)
 
 # Save the test set predictions, if desired
 if args.save_vectors == "True":
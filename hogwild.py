@@ -0,0 +1,151 @@
+import copy
+import os
+import queue
+import random
+import time
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch import optim
+
+from metrics import EpochMetrics
+from training import tpr_batches, train_tpr, validation_metrics, report_validation
+from rolelearner.role_learning_tensor_product_encoder import RoleLearningTensorProductEncoder
+
+# Hogwild training: several worker processes train one TPDN whose parameters are in shared
+# memory, each on its own share of the batches, and each updates the shared parameters
+# after every batch without any locking. For the small TPDNs used here a step is too cheap
+# for synchronous data parallelism to pay off, while lock-free updates let every core take
+# steps of its own. Each worker has its own Adam state.
+#
+# The main process is the coordinator: once every worker has finished an epoch, it copies
+# the shared parameters (which the workers keep updating meanwhile), validates the copy,
+# saves the best one and decides when to stop, as trainIters_tpr does.
+
+
+# The regularization of trainIters_tpr for an epoch: whether it is on, its temperature, and
+# whether the model of this epoch may be saved
+def regularization_schedule(epoch, burn_in):
+    if epoch < burn_in:
+        return False, 1.0, False
+    if burn_in == 0 or epoch >= 2 * burn_in:
+        return True, 1.0, True
+    return True, min(1.0, float(epoch - burn_in + 1) / burn_in), epoch == burn_in
+
+
+def _hogwild_worker(worker, num_workers, tpr_encoder, training_sets, n_epochs, learning_rate,
+                    burn_in, seed, num_threads, reports, stop):
+    torch.set_num_threads(num_threads)
+    tpr_optimizer = optim.Adam(tpr_encoder.parameters(), lr=learning_rate)
+    criterion = nn.MSELoss()
+    batches = training_sets[worker::num_workers]
+    batch_order = random.Random(seed * 1000003 + worker)
+    role_learning = isinstance(tpr_encoder, RoleLearningTensorProductEncoder)
+
+    for epoch in range(n_epochs):
+        if role_learning:
+            use_regularization, temp, _ = regularization_schedule(epoch, burn_in)
+            tpr_encoder.use_regularization(use_regularization)
+            tpr_encoder.set_regularization_temp(temp)
+            tpr_encoder.train()
+
+        train_metrics = EpochMetrics()
+        batch_order.shuffle(batches)
+        for batch in batches:
+            if stop.is_set():
+                return
+            loss, mse_loss, one_hot_loss, unique_role_loss, l2_norm_loss = \
+                train_tpr(batch, tpr_encoder, tpr_optimizer, criterion)
+            train_metrics.add(len(batch[0]), loss=loss, mse=mse_loss, one_hot=one_hot_loss,
+                              unique_role=unique_role_loss, l2_norm=l2_norm_loss)
+        reports.put((worker, epoch, train_metrics.num_batches, train_metrics.num_examples,
+                     train_metrics.host_totals()))
+
+
+# Train a TPDN with num_workers Hogwild worker processes, on the CPU. The arguments and the
+# return value are those of trainIters_tpr.
+def trainIters_tpr_hogwild(train_data, dev_data, tpr_encoder, n_epochs, num_workers,
+                           learning_rate=0.001, batch_size=5, weight_file=None, patience=3,
+                           burn_in=0, pad_batches=False, seed=None):
+    if next(tpr_encoder.parameters()).is_cuda:
+        raise ValueError('Hogwild training runs on the CPU')
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+
+    training_sets = tpr_batches(train_data, batch_size, pad_batches)
+    dev_data_sets = tpr_batches(dev_data, batch_size, pad_batches)
+
+    # The coordinator validates a copy, so that the shared weights do not change under it
+    validation_encoder = copy.deepcopy(tpr_encoder)
+    tpr_encoder.share_memory()
+
+    # The workers are forked, so they share the batches and the model without copying them
+    context = mp.get_context('fork')
+    reports = context.Queue()
+    stop = context.Event()
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    workers = [context.Process(target=_hogwild_worker, args=(
+        worker, num_workers, tpr_encoder, training_sets, n_epochs, learning_rate, burn_in,
+        seed, num_threads, reports, stop)) for worker in range(num_workers)]
+    for process in workers:
+        process.start()
+
+    best_loss = 1000000
+    count_epochs_not_improved = 0
+    epoch_reports = {}
+    try:
+        for epoch in range(n_epochs):
+            # Wait until every worker has finished the epoch
+            start_time = time.time()
+            while len(epoch_reports.get(epoch, [])) < num_workers:
+                try:
+                    worker, worker_epoch, num_batches, num_examples, totals = \
+                        reports.get(timeout=1)
+                except queue.Empty:
+                    if any(process.exitcode not in (None, 0) for process in workers):
+                        raise RuntimeError('A Hogwild worker process failed')
+                    continue
+                epoch_reports.setdefault(worker_epoch, []).append(
+                    (num_batches, num_examples, totals))
+
+            train_metrics = EpochMetrics()
+            train_metrics.start_time = start_time
+            for num_batches, num_examples, totals in epoch_reports.pop(epoch):
+                for name, total in totals.items():
+                    train_metrics.totals[name] = train_metrics.totals.get(name, 0) + total
+                train_metrics.num_batches += num_batches
+                train_metrics.num_examples += num_examples
+
+            validation_encoder.load_state_dict(tpr_encoder.state_dict())
+            use_regularization, temp, may_save = regularization_schedule(epoch, burn_in)
+            if isinstance(validation_encoder, RoleLearningTensorProductEncoder):
+                validation_encoder.use_regularization(use_regularization)
+                validation_encoder.set_regularization_temp(temp)
+            dev_metrics = validation_metrics(validation_encoder, dev_data_sets)
+            total_val_loss = report_validation('Epoch {}'.format(epoch), train_metrics.summary(),
+                                               dev_metrics)
+
+            if may_save:
+                if total_val_loss < best_loss:
+                    print('Saving model at epoch {}'.format(epoch))
+                    count_epochs_not_improved = 0
+                    best_loss = total_val_loss
+                    torch.save(validation_encoder.state_dict(), weight_file)
+                else:
+                    count_epochs_not_improved += 1
+                    if count_epochs_not_improved == patience:
+                        print('Finished training early')
+                        break
+    finally:
+        stop.set()
+        # A worker only exits once the reports it has queued are read
+        while any(process.is_alive() for process in workers):
+            try:
+                reports.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in workers:
+            process.join()
+
+    return best_loss
@@ -0,0 +1,141 @@
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# Accumulates the loss terms of the batches of an epoch. The terms are detached from the
+# autograd graph as they are added, so no batch's graph outlives its training step, and
+# tensor terms are summed where they live (on the GPU when training on the GPU) so that
+# reading the totals back is a single host transfer, in host_totals(), means() or summary(),
+# rather than one per batch. Tensor terms may be vectors, such as counts per role. Terms may
+# also be plain numbers, such as the 0 regularization loss of a TensorProductEncoder.
+class EpochMetrics(object):
+    def __init__(self):
+        self.reset()
+
+    # Start a new epoch
+    def reset(self):
+        self.totals = {}
+        self.num_batches = 0
+        self.num_examples = 0
+        self.start_time = time.time()
+
+    # Add the loss terms of one batch of num_examples examples, as keyword arguments
+    def add(self, num_examples, **terms):
+        for name, value in terms.items():
+            if torch.is_tensor(value):
+                value = value.detach()
+            self.totals[name] = self.totals.get(name, 0) + value
+        self.num_batches += 1
+        self.num_examples += num_examples
+
+    # Sum the totals, batch counts and example counts over the ranks of a torch.distributed
+    # process group, in a single all-reduce. Every rank must have added the same terms.
+    def all_reduce(self):
+        names = sorted(self.totals)
+        values = [torch.as_tensor(self.totals[name], dtype=torch.float64).reshape(-1).cpu()
+                  for name in names]
+        values.append(torch.tensor([self.num_batches, self.num_examples], dtype=torch.float64))
+        values = torch.cat(values)
+        dist.all_reduce(values)
+
+        start = 0
+        for name in names:
+            total = self.totals[name]
+            if torch.is_tensor(total):
+                self.totals[name] = values[start:start + total.numel()].view(total.shape)
+                start += total.numel()
+            else:
+                self.totals[name] = float(values[start])
+                start += 1
+        self.num_batches, self.num_examples = int(values[-2]), int(values[-1])
+
+    # A dict with the total of every term, read back from the device in a single transfer.
+    # Terms that are vectors, such as counts per role, give lists.
+    def host_totals(self):
+        names = [name for name, total in self.totals.items() if torch.is_tensor(total)]
+        totals = {name: total for name, total in self.totals.items() if name not in names}
+        if names:
+            values = torch.cat([self.totals[name].double().reshape(-1) for name in names]).tolist()
+            start = 0
+            for name in names:
+                total = self.totals[name]
+                totals[name] = values[start] if total.dim() == 0 else \
+                    values[start:start + total.numel()]
+                start += total.numel()
+        return totals
+
+    # A dict with the mean of every term over the batches added so far
+    def means(self):
+        num_batches = max(self.num_batches, 1)
+        return {name: [value / num_batches for value in total] if isinstance(total, list)
+                else total / num_batches for name, total in self.host_totals().items()}
+
+    # The totals, counts and elapsed time so far, for a training state that is resumed with
+    # load_state_dict, so that the first summary after resuming covers the whole epoch
+    def state_dict(self):
+        return {'totals': dict(self.totals), 'num_batches': self.num_batches,
+                'num_examples': self.num_examples, 'elapsed': self.elapsed()}
+
+    def load_state_dict(self, state):
+        self.totals = dict(state['totals'])
+        self.num_batches = state['num_batches']
+        self.num_examples = state['num_examples']
+        self.start_time = time.time() - state['elapsed']
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def examples_per_second(self):
+        return self.num_examples / max(self.elapsed(), 1e-9)
+
+    # One line with the mean of every scalar term and the throughput
+    def summary(self):
+        terms = ', '.join('{} {:.6g}'.format(name, value) for name, value in self.means().items()
+                          if not isinstance(value, list))
+        return '{} ({} examples, {:.1f} examples/sec)'.format(
+            terms, self.num_examples, self.examples_per_second())
+
+
+# Project the validation loss at a later time from the last fit_rounds (time, loss) points,
+# by fitting a power law loss = a * time^b to them. Returns None with fewer than two points.
+def project_loss(times, losses, at_time, fit_rounds=5):
+    points = [(t, loss) for t, loss in zip(times[-fit_rounds:], losses[-fit_rounds:])
+              if t > 0 and loss > 0]
+    if len(points) < 2:
+        return None
+    log_times, log_losses = np.log(np.array(points)).T
+    slope, intercept = np.polyfit(log_times, log_losses, 1)
+    return float(np.exp(intercept + slope * np.log(at_time)))
+
+
+# Writes the validation loss of every round against the training time to a tab-separated
+# file, flushed after every round so that the file holds the results so far if the run is
+# stopped. With a deadline, every round also reports the loss projected for the deadline.
+class TrainingProgress(object):
+    def __init__(self, path, start_time, deadline=None):
+        self.start_time = start_time
+        self.deadline = deadline
+        self.times = []
+        self.losses = []
+        self.file = open(path, 'w')
+        self.file.write('seconds\tepoch\tstep\tvalidation_loss\tbest_loss\tprojected_loss\n')
+        self.file.flush()
+
+    def record(self, epoch, step, loss, best_loss):
+        seconds = time.time() - self.start_time
+        self.times.append(seconds)
+        self.losses.append(loss)
+        projected = None
+        if self.deadline is not None:
+            projected = project_loss(self.times, self.losses, self.deadline - self.start_time)
+            if projected is not None:
+                print('Projected validation loss at the end of the time budget: {}'.format(
+                    projected))
+        self.file.write('{:.1f}\t{}\t{}\t{}\t{}\t{}\n'.format(
+            seconds, epoch, step, loss, best_loss, '' if projected is None else projected))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -340,7 +340,8 @@ else:
 class TensorProductEncoder(nn.Module):
     def __init__(self, n_roles=2, n_fillers=2, filler_dim=3, role_dim=4, 
                  final_layer_width=None, pretrained_embeddings=None, embedder_squeeze=None,
-                 binder="tpr", pretrained_filler_embeddings=None):
+                 binder="tpr", pretrained_filler_embeddings=None, fused_binding=False,
+                 projection_rank=None, projection_type="cp"):
 
         super(TensorProductEncoder, self).__init__()
         
@@ -399,23 +400,56 @@ class TensorProductEncoder(nn.Module):
             self.has_last = 0
         else:
             self.has_last = 1
-            if binder == "tpr":
+            if binder == "tpr" and projection_rank is not None:
+                self.last_layer = LowRankTensorProductProjection(
+                    self.filler_dim, self.role_dim, self.final_layer_width, projection_rank,
+                    projection_type)
+            elif binder == "tpr":
                 self.last_layer = nn.Linear(self.filler_dim * self.role_dim, self.final_layer_width)
             else:
                 self.last_layer = nn.Linear(self.filler_dim, self.final_layer_width)
+
+        # With fused_binding, the bindings and the final linear layer are computed together
+        # by tensor_product_projection, which can skip building the tensor product
+        self.fused_binding = fused_binding
+        if fused_binding and (binder != "tpr" or not self.has_last):
+            raise ValueError('fused_binding needs the tpr binder and a final linear layer')
+
+        # With projection_rank, the final linear layer is a LowRankTensorProductProjection,
+        # which is applied to the fillers and roles instead of their tensor product
+        self.projection_rank = projection_rank
+        if projection_rank is not None and (binder != "tpr" or not self.has_last or
+                                            fused_binding):
+            raise ValueError('projection_rank needs the tpr binder and a final linear layer, '
+                             'without fused_binding')
       
     # Function for a forward pass through this layer. Takes a list of fillers and 
-    # a list of roles and returns an single vector encoding it.
-    def forward(self, filler_list, role_list):
+    # a list of roles and returns an single vector encoding it. For a padded batch,
+    # lengths holds the length of each sequence and the padding is left out of the encoding.
+    def forward(self, filler_list, role_list, lengths=None):
         # Embed the fillers
         fillers_embedded = self.filler_embedding(filler_list)
 
         if self.embed_squeeze:
             fillers_embedded = self.embedding_squeeze_layer(fillers_embedded)
 
+        # Zeroing the padded fillers removes their bindings from the sum
+        if lengths is not None:
+            mask = sequence_mask(lengths.to(fillers_embedded.device), filler_list.shape[1])
+            fillers_embedded = fillers_embedded * mask.unsqueeze(2)
+
+        if self.fused_binding:
+            role_weights = F.one_hot(role_list, self.n_roles).to(fillers_embedded.dtype)
+            output = tensor_product_projection(fillers_embedded, role_weights,
+                                               self.role_embedding.weight, self.last_layer)
+            return output.unsqueeze(0)
+
         # Embed the roles
         roles_embedded = self.role_embedding(role_list)
 
+        if self.projection_rank is not None:
+            return self.last_layer(fillers_embedded, roles_embedded)
+
         # Create the sum of the flattened tensor products of the
         # filler and role embeddings
         output = self.sum_layer(fillers_embedded, roles_embedded)
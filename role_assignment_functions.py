@@ -222,3 +222,21 @@ def create_tree_roles(max_length, vocab_size):
 
 
 
+
+# The pre-coded role schemes, by the names used for --role_scheme
+ROLE_SCHEMES = {
+	"bow": create_bow_roles,
+	"ltr": create_ltr_roles,
+	"rtl": create_rtl_roles,
+	"bi": create_bidirectional_roles,
+	"wickel": create_wickel_roles,
+	"tree": create_tree_roles,
+	"interleave": create_interleaving_tree_roles
+}
+
+# Create the pre-coded role scheme called name. Returns the number of roles
+# and the function mapping a sequence of fillers to its roles.
+def create_role_scheme(name, max_length, vocab_size):
+	if name not in ROLE_SCHEMES:
+		raise ValueError("Invalid role scheme: {}".format(name))
+	return ROLE_SCHEMES[name](max_length, vocab_size)
@@ -1,12 +1,68 @@
 import torch
 import torch.nn as nn
 
+from binding_operations import sequence_mask
+
 if torch.cuda.is_available():
     device = torch.device('cuda')
 else:
     device = torch.device('cpu')
 
 
+# The roles of a role assigner's role_predictions, of size (sequence_length, batch_size,
+# num_roles): returns the roles, of size (sequence_length, batch_size, role_embedding_dim),
+# and the predictions. With filler_lengths, both are zero at the padding.
+def embed_role_predictions(role_assigner, role_predictions, filler_lengths=None):
+    padding_mask = None
+    if filler_lengths is not None:
+        padding_mask = sequence_mask(filler_lengths.to(role_predictions.device),
+                                     role_predictions.shape[0]).t().unsqueeze(2)
+        role_predictions = role_predictions * padding_mask
+
+    role_embeddings = role_assigner.role_embedding(role_assigner.role_indices)
+
+    # Normalize the embeddings. This is important so that role attention is not overruled by
+    # embeddings with different orders of magnitude.
+    role_embeddings = role_embeddings / torch.norm(role_embeddings, dim=1).unsqueeze(1)
+    # role_embeddings is size (num_roles, role_embedding_dim)
+
+    # During evaluation, we want to snap the role predictions to a one-hot vector
+    if role_assigner.snap_one_hot_predictions:
+        one_hot_predictions = role_assigner.one_hot_embedding(torch.argmax(role_predictions, 2),
+                                                              role_assigner.num_roles)
+        roles = torch.matmul(one_hot_predictions, role_embeddings)
+    else:
+        roles = torch.matmul(role_predictions, role_embeddings)
+    # roles is size (sequence_length, batch_size, role_embedding_dim)
+
+    # A padding position snaps to a role like any other, so its role is zeroed again
+    if padding_mask is not None and role_assigner.snap_one_hot_predictions:
+        roles = roles * padding_mask
+
+    return roles, role_predictions
+
+
+# One direction of an LSTM layer, stepping through the input part of its gates, of shape
+# (sequence_length, batch_size, 4 * hidden_dim), with the hidden-to-hidden weights of shape
+# (4 * hidden_dim, hidden_dim). Both can have a leading dimension for stacked LSTMs, as in
+# RoleLearningEnsemble. Returns the hidden state of every position.
+def lstm_recurrence(gate_inputs, weight_hh):
+    multiply_add = torch.addmm if weight_hh.dim() == 2 else torch.baddbmm
+    hidden = gate_inputs.new_zeros(gate_inputs.shape[:-3] + gate_inputs.shape[-2:-1] +
+                                   weight_hh.shape[-1:])
+    cell = torch.zeros_like(hidden)
+    weight_hh = weight_hh.transpose(-1, -2)
+    outputs = []
+    for position in range(gate_inputs.shape[-3]):
+        gates = multiply_add(gate_inputs.select(-3, position), hidden, weight_hh)
+        input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, -1)
+        cell = torch.sigmoid(forget_gate) * cell + \
+            torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+        hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+        outputs.append(hidden)
+    return torch.stack(outputs, -3)
+
+
 class RoleAssignmentLSTM(nn.Module):
     def __init__(
             self,
@@ -17,7 +73,8 @@ class RoleAssignmentLSTM(nn.Module):
             num_layers=1,
             role_assignment_shrink_filler_dim=None,
             bidirectional=False,
-            softmax_roles=False
+            softmax_roles=False,
+            filler_gate_table=False
     ):
         super(RoleAssignmentLSTM, self).__init__()
         # TODO: when we move to language models, we will need to use pre-trained word embeddings.
@@ -63,17 +120,38 @@ class RoleAssignmentLSTM(nn.Module):
         self.role_embedding = nn.Embedding(num_roles, role_embedding_dim)
         self.role_indices = torch.tensor([x for x in range(num_roles)], device=device)
 
-    def forward(self, filler_tensor):
+        # With filler_gate_table, the input part of the first layer's gates is looked up in a
+        # table with a row per filler (see filler_gate_inputs) instead of being computed for
+        # every filler of a batch, when no gradients are needed. Only the first layer is then
+        # run as an explicit recurrence, which the backward direction would have to reverse
+        # within every sequence length, so the table is only for a unidirectional LSTM.
+        if filler_gate_table and bidirectional:
+            raise ValueError('filler_gate_table needs a unidirectional LSTM')
+        self.filler_gate_table = filler_gate_table
+        self.gate_table = None
+        self.gate_table_key = None
+
+    def forward(self, filler_tensor, filler_lengths=None):
         """
         :param filler_tensor: This input tensor should be of shape (batch_size, sequence_length)
-        :param filler_lengths: A list of the length of each sequence in the batch. This is used
-            for padding the sequences.
+        :param filler_lengths: An optional tensor with the length of each sequence in the batch.
+            When it is given, the padding after each sequence is skipped by the LSTM (in both
+            directions when it is bidirectional), and the role predictions and role embeddings
+            of the padding are zero.
         :return: A tensor of size (sequence_length, batch_size, role_embedding_dim) with the role
             embeddings for the input filler_tensor.
         """
         batch_size = len(filler_tensor)
         hidden = self.init_hidden(batch_size)
 
+        gate_table = self.filler_gate_inputs() if self.filler_gate_table else None
+        if gate_table is not None:
+            lstm_out = self.lstm_from_gate_inputs(gate_table[torch.transpose(filler_tensor, 0, 1)])
+            role_predictions = self.role_weight_predictions(lstm_out)
+            if self.softmax_roles:
+                role_predictions = self.softmax(role_predictions)
+            return embed_role_predictions(self, role_predictions, filler_lengths)
+
         fillers_embedded = self.filler_embedding(filler_tensor)
         if self.shrink_filler:
             fillers_embedded = self.filler_shrink_layer(fillers_embedded)
@@ -82,40 +160,65 @@ class RoleAssignmentLSTM(nn.Module):
         # Pytorch LSTM expects data in the shape (sequence_length, batch_size, feature_dim)
         fillers_embedded = torch.transpose(fillers_embedded, 0, 1)
 
-        '''
-        fillers_embedded = torch.nn.utils.rnn.pack_padded_sequence(
-            fillers_embedded,
-            filler_lengths,
-            batch_first=False
-        )
-
-        lstm_out, hidden = self.lstm(fillers_embedded, hidden)
-        lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out)
-        '''
-        lstm_out, hidden = self.lstm(fillers_embedded, hidden)
+        if filler_lengths is not None:
+            sequence_length = fillers_embedded.shape[0]
+            fillers_embedded = torch.nn.utils.rnn.pack_padded_sequence(
+                fillers_embedded,
+                # pack_padded_sequence does not accept empty sequences
+                filler_lengths.cpu().clamp(min=1),
+                batch_first=False,
+                enforce_sorted=False
+            )
+
+            lstm_out, hidden = self.lstm(fillers_embedded, hidden)
+            lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(
+                lstm_out, total_length=sequence_length)
+        else:
+            lstm_out, hidden = self.lstm(fillers_embedded, hidden)
         role_predictions = self.role_weight_predictions(lstm_out)
 
         if self.softmax_roles:
             role_predictions = self.softmax(role_predictions)
         # role_predictions is size (sequence_length, batch_size, num_roles)
 
-        role_embeddings = self.role_embedding(self.role_indices)
-
-        # Normalize the embeddings. This is important so that role attention is not overruled by
-        # embeddings with different orders of magnitude.
-        role_embeddings = role_embeddings / torch.norm(role_embeddings, dim=1).unsqueeze(1)
-        # role_embeddings is size (num_roles, role_embedding_dim)
+        return embed_role_predictions(self, role_predictions, filler_lengths)
 
-        # During evaluation, we want to snap the role predictions to a one-hot vector
-        if self.snap_one_hot_predictions:
-            one_hot_predictions = self.one_hot_embedding(torch.argmax(role_predictions, 2),
-                                                        self.num_roles)
-            roles = torch.matmul(one_hot_predictions, role_embeddings)
-        else:
-            roles = torch.matmul(role_predictions, role_embeddings)
-        # roles is size (sequence_length, batch_size, role_embedding_dim)
+    # The input part of the gates of the first LSTM layer for every filler, as a table of
+    # shape (num_fillers, 4 * hidden_dim). It is only used while no gradients are needed,
+    # and it is kept until a weight it is computed from changes; otherwise None is returned,
+    # and the LSTM embeds the fillers as usual.
+    def filler_gate_inputs(self):
+        weights = [self.filler_embedding.weight, self.lstm.weight_ih_l0, self.lstm.bias_ih_l0,
+                   self.lstm.bias_hh_l0]
+        if self.shrink_filler:
+            weights += list(self.filler_shrink_layer.parameters())
+        if torch.is_grad_enabled() and any(weight.requires_grad for weight in weights):
+            return None
+        key = tuple((weight.data_ptr(), weight._version) for weight in weights)
+        if self.gate_table is None or self.gate_table_key != key:
+            fillers_embedded = self.filler_embedding.weight
+            if self.shrink_filler:
+                fillers_embedded = self.filler_shrink_layer(fillers_embedded)
+            self.gate_table = torch.nn.functional.linear(
+                fillers_embedded, self.lstm.weight_ih_l0,
+                self.lstm.bias_ih_l0 + self.lstm.bias_hh_l0)
+            self.gate_table_key = key
+        return self.gate_table
 
-        return roles, role_predictions
+    # The output of the LSTM, of shape (sequence_length, batch_size, hidden_dim), from the
+    # input part of the gates of its first layer: the first layer steps through them, and
+    # the layers after it are run by the fused LSTM kernel. The LSTM is unidirectional, so
+    # the output of each filler is that of forward whether or not its sequence is padded.
+    def lstm_from_gate_inputs(self, gate_inputs):
+        lstm_out = lstm_recurrence(gate_inputs, self.lstm.weight_hh_l0)
+        if self.num_layers > 1:
+            weights = [getattr(self.lstm, name.format(layer))
+                       for layer in range(1, self.num_layers)
+                       for name in ['weight_ih_l{}', 'weight_hh_l{}', 'bias_ih_l{}', 'bias_hh_l{}']]
+            hidden = lstm_out.new_zeros(self.num_layers - 1, lstm_out.shape[1], self.hidden_dim)
+            lstm_out, _, _ = torch.lstm(lstm_out, (hidden, hidden), weights, True,
+                                        self.num_layers - 1, 0.0, False, False, False)
+        return lstm_out
 
     def init_hidden(self, batch_size):
         layer_multiplier = 1
@@ -169,10 +272,10 @@ if __name__ == "__main__":
     #data = [[1, 2, 3, 4], [1, 8, 1, 0]]
     data = [[2, 3], [1, 10]]
     data_tensor = torch.tensor(data)
-    out = lstm(data_tensor, [2, 1])
+    out = lstm(data_tensor, torch.tensor([2, 1]))
     print(out)
     print('experiment 2')
     data2 = [[1]]
     data_tensor2 = torch.tensor(data2)
-    out2 = lstm(data_tensor2, [1])
+    out2 = lstm(data_tensor2, torch.tensor([1]))
     print(out2)
@@ -0,0 +1,120 @@
+import math
+
+import torch
+import torch.nn as nn
+
+from binding_operations import sequence_mask
+from .role_assigner import embed_role_predictions
+
+if torch.cuda.is_available():
+    device = torch.device('cuda')
+else:
+    device = torch.device('cpu')
+
+
+# A role assigner that predicts the role weights of every position at once with a small
+# transformer encoder, instead of stepping through the positions like RoleAssignmentLSTM.
+# It takes the same arguments (hidden_dim is the width of the transformer) and returns the
+# same roles and role predictions. Without bidirectional, the attention is causal, so the
+# role of a filler depends only on the fillers up to it, as with a unidirectional LSTM.
+class RoleAssignmentTransformer(nn.Module):
+    def __init__(
+            self,
+            num_roles,
+            filler_embedding,
+            hidden_dim,
+            role_embedding_dim,
+            num_layers=1,
+            role_assignment_shrink_filler_dim=None,
+            bidirectional=False,
+            softmax_roles=False,
+            num_heads=4
+    ):
+        super(RoleAssignmentTransformer, self).__init__()
+
+        self.snap_one_hot_predictions = False
+
+        self.filler_embedding = filler_embedding
+        filler_embedding_dim = filler_embedding.embedding_dim
+
+        self.shrink_filler = False
+        if role_assignment_shrink_filler_dim:
+            self.shrink_filler = True
+            self.filler_shrink_layer = nn.Linear(filler_embedding.embedding_dim,
+                                                 role_assignment_shrink_filler_dim)
+            filler_embedding_dim = role_assignment_shrink_filler_dim
+
+        self.num_layers = num_layers
+        self.hidden_dim = hidden_dim
+        self.num_roles = num_roles
+        self.bidirectional = bidirectional
+
+        self.input_layer = nn.Linear(filler_embedding_dim, hidden_dim)
+        encoder_layer = nn.TransformerEncoderLayer(hidden_dim, num_heads,
+                                                   dim_feedforward=4 * hidden_dim, dropout=0.0)
+        self.transformer = nn.TransformerEncoder(encoder_layer, num_layers,
+                                                 enable_nested_tensor=False)
+        if bidirectional:
+            print("The role assignment transformer is bidirectional")
+        self.role_weight_predictions = nn.Linear(hidden_dim, num_roles)
+
+        self.softmax_roles = softmax_roles
+        if softmax_roles:
+            print("Use softmax for role predictions")
+            self.softmax = nn.Softmax(dim=2)
+
+        self.role_embedding = nn.Embedding(num_roles, role_embedding_dim)
+        self.role_indices = torch.tensor([x for x in range(num_roles)], device=device)
+
+    # Sinusoidal position encodings, of size (sequence_length, 1, hidden_dim)
+    def position_encodings(self, sequence_length, device):
+        positions = torch.arange(sequence_length, dtype=torch.float, device=device).unsqueeze(1)
+        dims = torch.arange(0, self.hidden_dim, 2, dtype=torch.float, device=device)
+        frequencies = torch.exp(dims * (-math.log(10000.0) / self.hidden_dim))
+        encodings = torch.zeros(sequence_length, self.hidden_dim, device=device)
+        encodings[:, 0::2] = torch.sin(positions * frequencies)
+        encodings[:, 1::2] = torch.cos(positions * frequencies)[:, :self.hidden_dim // 2]
+        return encodings.unsqueeze(1)
+
+    def forward(self, filler_tensor, filler_lengths=None):
+        """
+        :param filler_tensor: This input tensor should be of shape (batch_size, sequence_length)
+        :param filler_lengths: An optional tensor with the length of each sequence in the batch.
+            When it is given, the padding after each sequence is not attended to, and the role
+            predictions and role embeddings of the padding are zero.
+        :return: A tensor of size (sequence_length, batch_size, role_embedding_dim) with the role
+            embeddings for the input filler_tensor, and the role predictions.
+        """
+        fillers_embedded = self.filler_embedding(filler_tensor)
+        if self.shrink_filler:
+            fillers_embedded = self.filler_shrink_layer(fillers_embedded)
+        # (sequence_length, batch_size, hidden_dim), as for the LSTM
+        inputs = torch.transpose(self.input_layer(fillers_embedded), 0, 1)
+        sequence_length = inputs.shape[0]
+        inputs = inputs + self.position_encodings(sequence_length, inputs.device)
+
+        attention_mask = None
+        if not self.bidirectional:
+            attention_mask = torch.triu(torch.ones(sequence_length, sequence_length,
+                                                   dtype=torch.bool, device=inputs.device), 1)
+        padding_mask = None
+        if filler_lengths is not None:
+            # Empty sequences attend to their first position, so that no row is all masked
+            padding_mask = sequence_mask(filler_lengths.to(inputs.device).clamp(min=1),
+                                         sequence_length) == 0
+
+        # is_causal tells attention that the mask is the causal one, which it applies faster
+        transformer_out = self.transformer(inputs, mask=attention_mask,
+                                           src_key_padding_mask=padding_mask,
+                                           is_causal=not self.bidirectional)
+        role_predictions = self.role_weight_predictions(transformer_out)
+
+        if self.softmax_roles:
+            role_predictions = self.softmax(role_predictions)
+        # role_predictions is size (sequence_length, batch_size, num_roles)
+
+        return embed_role_predictions(self, role_predictions, filler_lengths)
+
+    def one_hot_embedding(self, labels, num_classes):
+        y = torch.eye(num_classes, device=device)
+        return y[labels]
@@ -0,0 +1,213 @@
+from __future__ import division
+
+import torch
+import torch.nn as nn
+
+from binding_operations import SumFlattenedOuterProduct, sequence_mask
+from .role_assigner import RoleAssignmentLSTM, lstm_recurrence
+
+
+# K RoleLearningTensorProductEncoders with the same architecture, trained side by side. The
+# parameters of the members are stacked along a new first dimension, and every layer is
+# applied to all members at once with batched matrix products, so a training step costs
+# one set of tensor operations instead of K.
+#
+# torch.func.vmap cannot batch nn.LSTM, so the role assignment LSTM is run here as an
+# explicit recurrence over the stacked weights. For a padded batch, it gives the same
+# results as the packed sequences of RoleAssignmentLSTM: the backward direction starts
+# from the last filler of each sequence, and the outputs at the padding are zero.
+#
+# The members can have different initializations and regularization weights. Only the tpr
+# binder with a dense final layer and the LSTM role assigner is supported.
+class RoleLearningEnsemble(nn.Module):
+    def __init__(self, members):
+        super(RoleLearningEnsemble, self).__init__()
+        template = members[0]
+        if not isinstance(template.sum_layer, SumFlattenedOuterProduct):
+            raise ValueError('RoleLearningEnsemble only supports the tpr binder')
+        if not isinstance(template.role_assigner, RoleAssignmentLSTM):
+            raise ValueError('RoleLearningEnsemble only supports the LSTM role assigner')
+        if template.projection_rank is not None:
+            raise ValueError('RoleLearningEnsemble does not support a low-rank projection')
+
+        self.num_members = len(members)
+        self.num_layers = template.role_assigner.num_layers
+        self.bidirectional = template.role_assigner.bidirectional
+        self.shrink_filler = template.role_assigner.shrink_filler
+        self.softmax_roles = template.role_assigner.softmax_roles
+        self.has_last = template.has_last
+        self.embed_squeeze = template.embed_squeeze
+        self.n_roles = template.n_roles
+        self.snap_one_hot_predictions = False
+        self.regularize = False
+        self.regularization_temp = 1
+
+        # Stacked parameters, stored under the member's parameter names with '.' replaced
+        self.parameter_names = [name for name, _ in template.named_parameters()]
+        self.stacked = nn.ParameterDict()
+        for name in self.parameter_names:
+            values = torch.stack([dict(member.named_parameters())[name].detach()
+                                  for member in members])
+            self.stacked[name.replace('.', '__')] = nn.Parameter(
+                values.clone(), requires_grad=dict(template.named_parameters())[name].requires_grad)
+
+        self.register_buffer('one_hot_regularization_weight', torch.tensor(
+            [member.one_hot_regularization_weight for member in members], dtype=torch.float))
+        self.register_buffer('l2_norm_regularization_weight', torch.tensor(
+            [member.l2_norm_regularization_weight for member in members], dtype=torch.float))
+        self.register_buffer('unique_role_regularization_weight', torch.tensor(
+            [member.unique_role_regularization_weight for member in members], dtype=torch.float))
+
+    def _parameter(self, name):
+        return self.stacked[name.replace('.', '__')]
+
+    # A batched linear layer: inputs (K, ..., in_features) and a member Linear's name
+    def _linear(self, name, inputs):
+        weight = self._parameter(name + '.weight')
+        bias = self._parameter(name + '.bias')
+        shape = inputs.shape
+        outputs = torch.bmm(inputs.reshape(shape[0], -1, shape[-1]), weight.transpose(1, 2))
+        outputs = outputs + bias.unsqueeze(1)
+        return outputs.view(shape[:-1] + (weight.shape[1],))
+
+    # One direction of one LSTM layer over inputs of shape (K, length, batch, features)
+    def _lstm_direction(self, inputs, suffix):
+        # The input part of the gates of every position at once
+        gate_inputs = self._linear_lstm_inputs(inputs, suffix)
+        return lstm_recurrence(gate_inputs,
+                               self._parameter('role_assigner.lstm.weight_hh_' + suffix))
+
+    def _linear_lstm_inputs(self, inputs, suffix):
+        weight_ih = self._parameter('role_assigner.lstm.weight_ih_' + suffix)
+        bias = self._parameter('role_assigner.lstm.bias_ih_' + suffix) + \
+            self._parameter('role_assigner.lstm.bias_hh_' + suffix)
+        shape = inputs.shape
+        gate_inputs = torch.bmm(inputs.reshape(shape[0], -1, shape[-1]), weight_ih.transpose(1, 2))
+        return (gate_inputs + bias.unsqueeze(1)).view(shape[:-1] + (weight_ih.shape[1],))
+
+    # The role assignment LSTM on (K, length, batch, features) inputs
+    def _lstm(self, inputs, lengths):
+        length = inputs.shape[1]
+        mask = None
+        reverse_index = None
+        if lengths is not None:
+            # Like pack_padded_sequence in RoleAssignmentLSTM, empty sequences get one step
+            lengths = lengths.to(inputs.device).clamp(min=1)
+            mask = sequence_mask(lengths, length).t()
+            # Reverse every sequence within its own length; the padding stays at the end
+            positions = torch.arange(length, device=inputs.device).unsqueeze(1)
+            sequence_lengths = lengths.unsqueeze(0)
+            reverse_index = torch.where(positions < sequence_lengths,
+                                        sequence_lengths - 1 - positions, positions)
+
+        for layer in range(self.num_layers):
+            outputs = [self._lstm_direction(inputs, 'l{}'.format(layer))]
+            if self.bidirectional:
+                if reverse_index is None:
+                    reversed_outputs = self._lstm_direction(
+                        inputs.flip(1), 'l{}_reverse'.format(layer)).flip(1)
+                else:
+                    index = reverse_index.view(1, length, -1, 1)
+                    reversed_inputs = torch.gather(
+                        inputs, 1, index.expand(inputs.shape[0], -1, -1, inputs.shape[3]))
+                    reversed_outputs = self._lstm_direction(reversed_inputs,
+                                                            'l{}_reverse'.format(layer))
+                    reversed_outputs = torch.gather(reversed_outputs, 1, index.expand(
+                        reversed_outputs.shape[0], -1, -1, reversed_outputs.shape[3]))
+                outputs.append(reversed_outputs)
+            inputs = torch.cat(outputs, 3)
+            if mask is not None:
+                inputs = inputs * mask.unsqueeze(0).unsqueeze(3)
+        return inputs
+
+    # Returns the encodings, of shape (K, 1, batch_size, final_layer_width), and the role
+    # predictions, of shape (K, sequence_length, batch_size, n_roles)
+    def forward(self, filler_list, role_list_not_used, lengths=None):
+        filler_weights = self._parameter('filler_embedding.weight')
+        num_members = filler_weights.shape[0]
+        member_index = torch.arange(num_members, device=filler_list.device).view(-1, 1, 1)
+        fillers_embedded = filler_weights[member_index, filler_list.unsqueeze(0)]
+
+        # The role assigner embeds the fillers without the squeeze layer
+        assigner_inputs = fillers_embedded.transpose(1, 2)
+        if self.shrink_filler:
+            assigner_inputs = self._linear('role_assigner.filler_shrink_layer', assigner_inputs)
+
+        if self.embed_squeeze:
+            fillers_embedded = self._linear('embedding_squeeze_layer', fillers_embedded)
+        if lengths is not None:
+            mask = sequence_mask(lengths.to(fillers_embedded.device), filler_list.shape[1])
+            fillers_embedded = fillers_embedded * mask.unsqueeze(0).unsqueeze(3)
+
+        lstm_out = self._lstm(assigner_inputs, lengths)
+        role_predictions = self._linear('role_assigner.role_weight_predictions', lstm_out)
+        if self.softmax_roles:
+            role_predictions = torch.softmax(role_predictions, 3)
+        if lengths is not None:
+            # As in RoleAssignmentLSTM, the predictions for the padding are zero
+            role_predictions = role_predictions * mask.t().unsqueeze(0).unsqueeze(3)
+
+        role_embeddings = self._parameter('role_assigner.role_embedding.weight')
+        role_embeddings = role_embeddings / torch.norm(role_embeddings, dim=2).unsqueeze(2)
+        if self.snap_one_hot_predictions:
+            weights = torch.nn.functional.one_hot(torch.argmax(role_predictions, 3),
+                                                  self.n_roles).float()
+        else:
+            weights = role_predictions
+        roles_embedded = torch.einsum('klbr,krd->kbld', weights, role_embeddings)
+
+        output = torch.einsum('kbli,kblj->kbij', fillers_embedded, roles_embedded)
+        output = output.reshape(num_members, 1, output.shape[1], -1)
+        if self.has_last:
+            output = self._linear('last_layer', output)
+
+        return output, role_predictions
+
+    def use_regularization(self, use_regularization):
+        self.regularize = use_regularization
+
+    def set_regularization_temp(self, temp):
+        self.regularization_temp = temp
+
+    # The regularization terms of RoleLearningTensorProductEncoder.get_regularization_loss,
+    # as (K,) tensors with every member's own weights
+    def get_regularization_loss(self, role_predictions, lengths=None):
+        if not self.regularize:
+            zeros = role_predictions.new_zeros(role_predictions.shape[0])
+            return zeros, zeros, zeros
+
+        batch_size = role_predictions.shape[2]
+        if lengths is not None:
+            mask = sequence_mask(lengths.to(role_predictions.device), role_predictions.shape[1])
+            role_predictions = role_predictions * mask.t().unsqueeze(0).unsqueeze(3)
+
+        if self.softmax_roles:
+            one_hot_reg = torch.sum(role_predictions * (1 - role_predictions), (1, 2, 3))
+            l2_norm = -torch.sum(role_predictions * role_predictions, (1, 2, 3))
+        else:
+            one_hot_reg = torch.sum((role_predictions ** 2) * (1 - role_predictions) ** 2,
+                                    (1, 2, 3))
+            l2_norm = (torch.sum(role_predictions ** 2, (1, 2, 3)) - 1) ** 2
+        exclusive_role_vector = torch.sum(role_predictions, 1)
+        unique_role = torch.sum((exclusive_role_vector * (1 - exclusive_role_vector)) ** 2, (1, 2))
+
+        scale = self.regularization_temp / batch_size
+        return self.one_hot_regularization_weight * scale * one_hot_reg, \
+            self.l2_norm_regularization_weight * scale * l2_norm, \
+            self.unique_role_regularization_weight * scale * unique_role
+
+    # Copy the weights of member k into a RoleLearningTensorProductEncoder with the same
+    # architecture, such as the template the ensemble was built from
+    def load_member(self, k, tpr_encoder):
+        parameters = dict(tpr_encoder.named_parameters())
+        with torch.no_grad():
+            for name in self.parameter_names:
+                parameters[name].copy_(self._parameter(name)[k])
+        return tpr_encoder
+
+    def train(self, mode=True):
+        self.snap_one_hot_predictions = not mode
+        return self
+
+    def eval(self):
+        return self.train(False)
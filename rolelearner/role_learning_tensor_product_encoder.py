@@ -3,8 +3,10 @@ from __future__ import division
 import torch
 import torch.nn as nn
 
-from binding_operations import CircularConvolution, EltWise, SumFlattenedOuterProduct
+from binding_operations import CircularConvolution, EltWise, LowRankTensorProductProjection, \
+    SumFlattenedOuterProduct, sequence_mask, tensor_product_projection
 from .role_assigner import RoleAssignmentLSTM
+from .role_assigner_transformer import RoleAssignmentTransformer
 
 if torch.cuda.is_available():
     device = torch.device('cuda')
@@ -34,6 +36,12 @@ class RoleLearningTensorProductEncoder(nn.Module):
             one_hot_regularization_weight=1.0,
             l2_norm_regularization_weight=1.0,
             unique_role_regularization_weight=1.0,
+            fused_binding=False,
+            projection_rank=None,
+            projection_type="cp",
+            role_assigner_type="lstm",
+            role_assigner_num_heads=4,
+            filler_gate_table=False,
     ):
 
         super(RoleLearningTensorProductEncoder, self).__init__()
@@ -81,16 +89,36 @@ class RoleLearningTensorProductEncoder(nn.Module):
             )
             self.filler_embedding.weight.requires_grad = False
 
-        self.role_assigner = RoleAssignmentLSTM(
-            self.n_roles,
-            self.filler_embedding,
-            role_learner_hidden_dim,
-            self.role_dim,
-            role_assignment_shrink_filler_dim=role_assignment_shrink_filler_dim,
-            bidirectional=bidirectional,
-            num_layers=num_layers,
-            softmax_roles=softmax_roles
-        )
+        # The role assigner is an LSTM, or a transformer that assigns the roles of all of
+        # the positions at once
+        if role_assigner_type == "lstm":
+            self.role_assigner = RoleAssignmentLSTM(
+                self.n_roles,
+                self.filler_embedding,
+                role_learner_hidden_dim,
+                self.role_dim,
+                role_assignment_shrink_filler_dim=role_assignment_shrink_filler_dim,
+                bidirectional=bidirectional,
+                num_layers=num_layers,
+                softmax_roles=softmax_roles,
+                filler_gate_table=filler_gate_table
+            )
+        elif role_assigner_type == "transformer":
+            if filler_gate_table:
+                raise ValueError('filler_gate_table needs the LSTM role assigner')
+            self.role_assigner = RoleAssignmentTransformer(
+                self.n_roles,
+                self.filler_embedding,
+                role_learner_hidden_dim,
+                self.role_dim,
+                role_assignment_shrink_filler_dim=role_assignment_shrink_filler_dim,
+                bidirectional=bidirectional,
+                num_layers=num_layers,
+                softmax_roles=softmax_roles,
+                num_heads=role_assigner_num_heads
+            )
+        else:
+            raise ValueError('Unknown role assigner: {}'.format(role_assigner_type))
 
         # Create a SumFlattenedOuterProduct layer that will
         # take the sum flattened outer product of the filler
@@ -113,23 +141,62 @@ class RoleLearningTensorProductEncoder(nn.Module):
             self.has_last = 0
         else:
             self.has_last = 1
-            if binder == "tpr":
+            if binder == "tpr" and projection_rank is not None:
+                self.last_layer = LowRankTensorProductProjection(
+                    self.filler_dim, self.role_dim, self.final_layer_width, projection_rank,
+                    projection_type)
+            elif binder == "tpr":
                 self.last_layer = nn.Linear(self.filler_dim * self.role_dim, self.final_layer_width)
             else:
                 self.last_layer = nn.Linear(self.filler_dim, self.final_layer_width)
 
+        # With fused_binding, the bindings and the final linear layer are computed together
+        # by tensor_product_projection, which can skip building the tensor product
+        self.fused_binding = fused_binding
+        if fused_binding and (binder != "tpr" or not self.has_last):
+            raise ValueError('fused_binding needs the tpr binder and a final linear layer')
+
+        # With projection_rank, the final linear layer is a LowRankTensorProductProjection,
+        # which is applied to the fillers and roles instead of their tensor product
+        self.projection_rank = projection_rank
+        if projection_rank is not None and (binder != "tpr" or not self.has_last or
+                                            fused_binding):
+            raise ValueError('projection_rank needs the tpr binder and a final linear layer, '
+                             'without fused_binding')
+
     # Function for a forward pass through this layer. Takes a list of fillers and
-    # a list of roles and returns an single vector encoding it.
-    def forward(self, filler_list, role_list_not_used):
+    # a list of roles and returns an single vector encoding it. For a padded batch,
+    # lengths holds the length of each sequence and the padding is left out of the encoding.
+    def forward(self, filler_list, role_list_not_used, lengths=None):
         # Embed the fillers
         fillers_embedded = self.filler_embedding(filler_list)
 
         if self.embed_squeeze:
             fillers_embedded = self.embedding_squeeze_layer(fillers_embedded)
 
-        roles_embedded, role_predictions = self.role_assigner(filler_list)
+        # Zeroing the padded fillers removes their bindings from the sum
+        if lengths is not None:
+            mask = sequence_mask(lengths.to(fillers_embedded.device), filler_list.shape[1])
+            fillers_embedded = fillers_embedded * mask.unsqueeze(2)
+
+        roles_embedded, role_predictions = self.role_assigner(filler_list, lengths)
+
+        if self.fused_binding:
+            role_weights = role_predictions
+            if self.role_assigner.snap_one_hot_predictions:
+                role_weights = self.role_assigner.one_hot_embedding(
+                    torch.argmax(role_predictions, 2), self.n_roles)
+            role_embeddings = self.role_assigner.role_embedding.weight
+            role_embeddings = role_embeddings / torch.norm(role_embeddings, dim=1).unsqueeze(1)
+            output = tensor_product_projection(fillers_embedded, role_weights.transpose(0, 1),
+                                               role_embeddings, self.last_layer)
+            return output.unsqueeze(0), role_predictions
+
         roles_embedded = roles_embedded.transpose(0, 1)
 
+        if self.projection_rank is not None:
+            return self.last_layer(fillers_embedded, roles_embedded), role_predictions
+
         # Create the sum of the flattened tensor products of the
         # filler and role embeddings
         output = self.sum_layer(fillers_embedded, roles_embedded)
@@ -146,13 +213,19 @@ class RoleLearningTensorProductEncoder(nn.Module):
     def set_regularization_temp(self, temp):
         self.regularization_temp = temp
 
-    def get_regularization_loss(self, role_predictions):
+    def get_regularization_loss(self, role_predictions, lengths=None):
         if not self.regularize:
             return 0, 0, 0
 
         one_hot_temperature = self.regularization_temp
         batch_size = role_predictions.shape[1]
 
+        # Padding positions of a padded batch do not hold fillers, so their predictions are
+        # zeroed and contribute nothing to any of the terms below
+        if lengths is not None:
+            mask = sequence_mask(lengths.to(role_predictions.device), role_predictions.shape[0])
+            role_predictions = role_predictions * mask.t().unsqueeze(2)
+
         softmax_roles = self.role_assigner.softmax_roles
 
         if softmax_roles:
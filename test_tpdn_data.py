@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from tpdn_data import _file_chunks, concatenate_sequence_files, load_sequence_file, \
+    load_sequence_files, parse_sequence_file
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATA_FILES = [os.path.join(DATA_PATH, 'example.data_from_dev'),
+              os.path.join(DATA_PATH, 'example.data_from_test')]
+
+
+# The line-by-line parse that decompose.py did before the bulk parser, kept as flat arrays
+def parse_line_by_line(path):
+    vocab = []
+    token_to_local = {}
+    tokens = []
+    offsets = [0]
+    vectors = []
+    with open(path) as data_file:
+        for line in data_file:
+            sequence, vector = line.strip().split("\t")
+            for filler in sequence.split():
+                if filler not in token_to_local:
+                    token_to_local[filler] = len(vocab)
+                    vocab.append(filler)
+                tokens.append(token_to_local[filler])
+            offsets.append(len(tokens))
+            vectors.append([float(value) for value in vector.split()])
+    return vocab, np.array(tokens), np.array(offsets), np.array(vectors, dtype=np.float32)
+
+
+def assert_same_arrays(sequence_file, expected):
+    vocab, tokens, offsets, vectors = expected
+    assert list(sequence_file.vocab) == list(vocab)
+    np.testing.assert_array_equal(sequence_file.tokens, tokens)
+    np.testing.assert_array_equal(sequence_file.offsets, offsets)
+    np.testing.assert_array_equal(sequence_file.vectors, vectors)
+
+
+def as_expected(sequence_file):
+    return (sequence_file.vocab, np.array(sequence_file.tokens), np.array(sequence_file.offsets),
+            np.array(sequence_file.vectors))
+
+
+@pytest.mark.parametrize('path', DATA_FILES)
+def test_bulk_parse_matches_line_loop(path):
+    assert_same_arrays(parse_sequence_file(path), parse_line_by_line(path))
+
+
+@pytest.mark.parametrize('path', DATA_FILES)
+def test_chunked_parse_matches_whole_file(path):
+    chunks = [parse_sequence_file(path, True, start, end) for start, end in _file_chunks(path, 4)]
+    assert len(chunks) > 1
+    assert_same_arrays(concatenate_sequence_files(chunks), parse_line_by_line(path))
+
+
+def test_worker_pool_matches_serial_load():
+    serial = load_sequence_files(DATA_FILES)
+    pooled = load_sequence_files(DATA_FILES, num_workers=2)
+    for serial_file, pooled_file in zip(serial, pooled):
+        assert_same_arrays(pooled_file, as_expected(serial_file))
+
+
+def test_cache_reloads_the_same_arrays(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    path = DATA_FILES[0]
+    parsed = load_sequence_file(path, cache_dir=cache_dir)
+    entries = sorted(os.listdir(cache_dir))
+    cached = load_sequence_file(path, cache_dir=cache_dir)
+
+    assert sorted(os.listdir(cache_dir)) == entries
+    assert isinstance(cached.vectors, np.memmap)
+    assert_same_arrays(cached, as_expected(parsed))
+    assert_same_arrays(cached, parse_line_by_line(path))
+
+
+def test_changed_file_invalidates_cache(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    path = str(tmp_path / 'example.data_from_dev')
+    shutil.copyfile(DATA_FILES[0], path)
+    load_sequence_file(path, cache_dir=cache_dir)
+    entries = set(os.listdir(cache_dir))
+
+    # Change the first filler and vector of the file
+    with open(path) as data_file:
+        lines = data_file.readlines()
+    sequence, vector = lines[0].rstrip('\n').split('\t')
+    lines[0] = 'new ' + sequence + '\t' + ' '.join(['2.5'] * len(vector.split())) + '\n'
+    with open(path, 'w') as data_file:
+        data_file.writelines(lines)
+
+    reloaded = load_sequence_file(path, cache_dir=cache_dir)
+    assert set(os.listdir(cache_dir)) > entries
+    assert reloaded.vocab[0] == 'new'
+    np.testing.assert_array_equal(reloaded.vectors[0], 2.5)
+    assert_same_arrays(reloaded, parse_line_by_line(path))
@@ -0,0 +1,101 @@
+import os
+import random
+import re
+import signal
+
+import numpy as np
+import pytest
+import torch
+
+import training
+from checkpointing import TrainingInterrupted
+from models import TensorProductEncoder
+from tpdn_data import build_tpdn_dataset
+
+N_FILLERS = 20
+MAX_LENGTH = 6
+HIDDEN_SIZE = 12
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def new_encoder():
+    return TensorProductEncoder(n_roles=MAX_LENGTH, n_fillers=N_FILLERS, filler_dim=8,
+                                role_dim=4, final_layer_width=HIDDEN_SIZE)
+
+
+# Random sequences with left-to-right roles and random targets
+def random_dataset(size):
+    lengths = np.random.randint(1, MAX_LENGTH + 1, size)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    fillers = np.random.randint(N_FILLERS, size=offsets[-1])
+    roles = np.concatenate([np.arange(length) for length in lengths])
+    return build_tpdn_dataset(fillers, offsets, roles, offsets, torch.randn(size, HIDDEN_SIZE))
+
+
+# The training summaries of the validation rounds, without their throughput
+@pytest.fixture
+def train_summaries(monkeypatch):
+    summaries = []
+    report_validation = training.report_validation
+
+    def recorded_report_validation(label, train_summary, dev_metrics):
+        summaries.append(re.sub(r', [\d.]+ examples/sec', '', train_summary))
+        return report_validation(label, train_summary, dev_metrics)
+    monkeypatch.setattr(training, 'report_validation', recorded_report_validation)
+    return summaries
+
+
+# Train a new TPDN for 3 epochs in output_dir, and return its final weights
+def train(output_dir, **kwargs):
+    output_dir.mkdir(exist_ok=True)
+    seed_everything(0)
+    train_data, dev_data = random_dataset(50), random_dataset(20)
+    encoder = new_encoder()
+    training.trainIters_tpr(train_data, dev_data, encoder, 3, batch_size=5,
+                            weight_file=str(output_dir / 'tpdn.weights'), patience=3, **kwargs)
+    return encoder.state_dict()
+
+
+# Interrupt training with SIGTERM during step interrupt_step (counted from 1) of the runs
+# in the test, so training stops after it; no step is interrupted by default
+@pytest.fixture
+def steps(monkeypatch):
+    steps = {'count': 0, 'interrupt_step': None}
+    train_tpr = training.train_tpr
+
+    def interrupted_train_tpr(*args):
+        steps['count'] += 1
+        if steps['count'] == steps['interrupt_step']:
+            os.kill(os.getpid(), signal.SIGTERM)
+        return train_tpr(*args)
+    monkeypatch.setattr(training, 'train_tpr', interrupted_train_tpr)
+    return steps
+
+
+# Steps in the middle of the first epoch, at the end of an epoch and in the last epoch
+@pytest.mark.parametrize('interrupt_step', [3, 8, 20])
+def test_resumed_run_matches_uninterrupted_run(tmp_path, steps, train_summaries,
+                                               interrupt_step):
+    expected = train(tmp_path / 'uninterrupted', state_file=str(tmp_path / 'unused.pt'))
+    expected_summaries = list(train_summaries)
+    total_steps = steps['count']
+    assert interrupt_step < total_steps
+    del train_summaries[:]
+
+    state_file = str(tmp_path / 'training_state.pt')
+    steps.update(count=0, interrupt_step=interrupt_step)
+    with pytest.raises(TrainingInterrupted):
+        train(tmp_path / 'interrupted', state_file=state_file)
+    assert steps['count'] == interrupt_step
+
+    # The resumed run builds the same data, and restores the random number generators
+    resumed = train(tmp_path / 'interrupted', state_file=state_file, resume=True)
+    assert steps['count'] == total_steps
+    assert train_summaries == expected_summaries
+    for name, weights in expected.items():
+        torch.testing.assert_close(resumed[name], weights, rtol=0, atol=0)
@@ -0,0 +1,176 @@
+from __future__ import unicode_literals, print_function, division
+from io import open
+
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+import torch
+
+from evaluation import *
+from models import *
+from role_assignment_functions import *
+from tasks import *
+from tpdn_data import *
+from training import *
+from als_solver import fit_tpr_als, tpr_mse
+
+# Fit a TPDN with every pre-coded role scheme to the same set of vectors, and rank the role
+# schemes by how well their TPDNs approximate the vectors. The data is parsed once, and the
+# schemes are fit in parallel worker processes that share it.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data_prefix", help="prefix for the vectors", type=str, default=None)
+parser.add_argument("--data_path", help="The location of the data files.", type=str,
+                    default="data")
+parser.add_argument("--role_schemes", help="the pre-coded role schemes to compare", nargs="+",
+                    choices=sorted(ROLE_SCHEMES), default=sorted(ROLE_SCHEMES))
+parser.add_argument("--test_decoder", help="whether to test the decoder (in addition to MSE",
+                    type=str, default="False")
+parser.add_argument("--decoder", help="decoder type", type=str, default="ltr")
+parser.add_argument("--decoder_prefix", help="prefix for the decoder to test", type=str,
+                    default=None)
+parser.add_argument("--decoder_embedding_size", help="embedding size for decoder", type=int,
+                    default=20)
+parser.add_argument("--decoder_task", help="task performed by the decoder", type=str,
+                    default="auto")
+parser.add_argument("--filler_dim", help="embedding dimension for fillers", type=int, default=10)
+parser.add_argument("--role_dim", help="embedding dimension for roles", type=int, default=6)
+parser.add_argument("--vocab_size", help="vocab size for the training language", type=int,
+                    default=10)
+parser.add_argument("--hidden_size", help="size of the encodings", type=int, default=60)
+parser.add_argument("--digits", help="whether this is one of the digit task", type=str,
+                    default="True")
+parser.add_argument("--final_linear", help="whether to have a final linear layer", type=str,
+                    default="True")
+parser.add_argument("--batch_size", help="The batch size.", type=int, default=32)
+parser.add_argument("--patience", help="The number of epochs (or least squares sweeps) to "
+                                       "train without improvement", type=int, default=10)
+parser.add_argument("--solver", help="How to fit the TPDNs: adam or als (see decompose.py)",
+                    choices=["adam", "als"], default="adam")
+parser.add_argument("--data_cache", help="A directory in which to cache the parsed data files.",
+                    type=str, default=None)
+parser.add_argument("--num_workers", help="The number of processes used to fit the schemes "
+                                          "(and to parse the data files).",
+                    type=int, default=os.cpu_count())
+parser.add_argument("--output_dir", help="An optional output folder where the weights of each "
+                                         "scheme's TPDN and the ranking are saved",
+                    type=str, default=None)
+parser.add_argument("--seed", help="The random seed.", type=int, default=None)
+args = parser.parse_args()
+
+use_cuda = torch.cuda.is_available()
+
+if use_cuda:
+    device = torch.device('cuda')
+else:
+    device = torch.device('cpu')
+
+output_dir = os.path.join('output/', args.output_dir) if args.output_dir else 'models'
+if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+# Prepare the train, dev, and test data, as decompose.py does
+sequence_files, filler_to_index, index_to_filler, max_length, filler_arrays = load_tpdn_splits(
+    args.data_path, args.data_prefix, digits=args.digits == "True", cache_dir=args.data_cache,
+    num_workers=args.num_workers)
+targets = [vectors_to_tensor(f.vectors) for f in sequence_files]
+del sequence_files
+
+
+# Load the decoder for computing swapping accuracy
+def load_decoder():
+    if args.decoder == "ltr":
+        decoder = DecoderRNN(args.vocab_size, args.decoder_embedding_size, args.hidden_size)
+    elif args.decoder == "bi":
+        decoder = DecoderBiRNN(args.vocab_size, args.decoder_embedding_size, args.hidden_size)
+    elif args.decoder == "tree":
+        decoder = DecoderTreeRNN(args.vocab_size, args.decoder_embedding_size, args.hidden_size)
+    else:
+        raise ValueError("Invalid decoder type: {}".format(args.decoder))
+
+    decoder.load_state_dict(torch.load("models/decoder_" + args.decoder_prefix + ".weights",
+                                       map_location=device))
+    return decoder.to(device)
+
+
+# Fit and evaluate a TPDN with one role scheme. Runs in a worker process, which has the
+# data loaded above.
+def evaluate_scheme(role_scheme):
+    start_time = time.time()
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    n_roles, seq_to_roles = create_role_scheme(role_scheme, max_length, len(filler_to_index))
+    datasets = build_tpdn_datasets(
+        filler_arrays, [sequence_roles(seq_to_roles, *arrays) for arrays in filler_arrays],
+        targets)
+    train_data, dev_data, test_data = datasets
+    n_roles = max(n_roles, max(int(dataset.roles.max()) + 1 for dataset in datasets))
+
+    tpr_encoder = TensorProductEncoder(
+        n_roles=n_roles,
+        n_fillers=len(filler_to_index),
+        final_layer_width=args.hidden_size if args.final_linear == "True" else None,
+        filler_dim=args.filler_dim,
+        role_dim=args.role_dim
+    ).to(device)
+
+    weight_file = os.path.join(output_dir, '{}.{}.tpr'.format(args.data_prefix, role_scheme))
+    if args.solver == "als":
+        fit_tpr_als(train_data.sorted_by_length(), dev_data, tpr_encoder, weight_file,
+                    patience=args.patience)
+    else:
+        trainIters_tpr(train_data.sorted_by_length(), dev_data.sorted_by_length(), tpr_encoder,
+                       n_epochs=1000, learning_rate=0.001, weight_file=weight_file,
+                       batch_size=args.batch_size, patience=args.patience)
+    tpr_encoder.load_state_dict(torch.load(weight_file, map_location=device))
+
+    result = {
+        'scheme': role_scheme,
+        'roles': n_roles,
+        'dev_mse': tpr_mse(tpr_encoder, dev_data),
+        'test_mse': tpr_mse(tpr_encoder, test_data),
+        'swap_accuracy': None
+    }
+    if args.test_decoder == "True":
+        input_to_output = lambda seq: transform(seq, args.decoder_task)
+        all_test_data = [[test_data[i]] for i in range(len(test_data))]
+        correct, total = score2(tpr_encoder, load_decoder(), input_to_output,
+                                batchify(all_test_data, 1), index_to_filler)
+        result['swap_accuracy'] = correct / max(total, 1)
+    result['seconds'] = time.time() - start_time
+    return result
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+if __name__ == "__main__":
+    num_processes = max(1, min(args.num_workers, len(args.role_schemes)))
+    # The workers are forked, so they share the parsed data instead of loading it again
+    context = multiprocessing.get_context('fork')
+    with context.Pool(num_processes, _init_worker,
+                      (max(1, os.cpu_count() // num_processes),)) as pool:
+        results = pool.map(evaluate_scheme, args.role_schemes, chunksize=1)
+
+    results.sort(key=lambda result: result['test_mse'])
+    lines = ['{:<5}{:<12}{:>7}{:>14}{:>14}{:>15}{:>10}'.format(
+        'rank', 'scheme', 'roles', 'dev MSE', 'test MSE', 'swap accuracy', 'seconds')]
+    for rank, result in enumerate(results):
+        swap_accuracy = '-' if result['swap_accuracy'] is None else \
+            '{:.4f}'.format(result['swap_accuracy'])
+        lines.append('{:<5}{:<12}{:>7}{:>14.6g}{:>14.6g}{:>15}{:>10.1f}'.format(
+            rank + 1, result['scheme'], result['roles'], result['dev_mse'],
+            result['test_mse'], swap_accuracy, result['seconds']))
+
+    print('\n'.join(lines))
+    with open(os.path.join(output_dir, args.data_prefix + '.tournament.txt'), 'w') as \
+            results_file:
+        results_file.write('\n'.join(lines) + '\n')
@@ -0,0 +1,762 @@
+from __future__ import unicode_literals, print_function, division
+from io import open
+
+from collections import namedtuple
+from multiprocessing import Pool
+
+import hashlib
+import os
+import pickle
+import threading
+from queue import Queue, Full
+
+import numpy as np
+import torch
+
+# Functions for loading the sequence/vector files that a TPDN is fit to.
+#
+# Each line of a data file holds a sequence of fillers, a tab, and the vector
+# that the encoder being decomposed produced for that sequence. Role files hold
+# one sequence of roles per line. A parsed file is kept as flat arrays:
+#   vocab:   the distinct tokens in the order they were first seen
+#   tokens:  the vocab index of every token in the file, concatenated
+#   offsets: sequence i is tokens[offsets[i]:offsets[i + 1]]
+#   vectors: a (num_sequences, vector_dim) float32 matrix (None for role files)
+#
+# Parsing large embedding dumps dominates startup, so a parsed file can be
+# cached on disk. Cache entries are keyed by a hash of the file's contents and
+# are memory-mapped when they are loaded, so the vectors are never copied into
+# RAM.
+
+# Bump this whenever the layout of the cache files changes
+CACHE_VERSION = 1
+
+SequenceFile = namedtuple('SequenceFile', ['vocab', 'tokens', 'offsets', 'vectors'])
+
+
+# Hash the contents of a file, reading it in chunks
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as data_file:
+        chunk = data_file.read(chunk_size)
+        while chunk:
+            sha1.update(chunk)
+            chunk = data_file.read(chunk_size)
+    return sha1.hexdigest()
+
+
+# Parse a block of lines from a data or role file. The vector column of the whole
+# block goes through a single np.loadtxt call and fillers are indexed with one
+# dictionary pass over the block's distinct tokens, rather than converting every
+# value with its own Python call.
+def _parse_block(lines, has_vectors, token_to_local, vocab):
+    lines = [line.strip() for line in lines]
+
+    vectors = None
+    if has_vectors:
+        fields = '\n'.join(lines).replace('\t', '\n').split('\n')
+        if len(fields) != 2 * len(lines):
+            raise ValueError('Every line of a data file must be a sequence and a vector '
+                             'separated by a single tab')
+        sequences = fields[0::2]
+        vectors = np.loadtxt(fields[1::2], dtype=np.float64, ndmin=2).astype(np.float32)
+    else:
+        sequences = lines
+
+    block_tokens = ' '.join(sequences).split()
+    lengths = np.fromiter(map(len, map(str.split, sequences)), dtype=np.int64,
+                          count=len(sequences))
+
+    # dict.fromkeys keeps the first-seen order of the block's distinct tokens
+    for token in dict.fromkeys(block_tokens):
+        if token not in token_to_local:
+            token_to_local[token] = len(vocab)
+            vocab.append(token)
+    tokens = np.fromiter(map(token_to_local.__getitem__, block_tokens), dtype=np.int32,
+                         count=len(block_tokens))
+
+    return tokens, lengths, vectors
+
+
+# Read the lines of path between the byte offsets start and end (end=None reads to the
+# end of the file), about block_bytes at a time
+def _read_line_blocks(path, start=0, end=None, block_bytes=1 << 26):
+    with open(path, 'rb') as data_file:
+        data_file.seek(start)
+        remaining = (os.path.getsize(path) if end is None else end) - start
+        carry = b''
+        while remaining > 0:
+            data = data_file.read(min(block_bytes, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            data = carry + data
+
+            # Only hand over complete lines; the rest is carried into the next block
+            cut = data.rfind(b'\n') + 1 if remaining > 0 else len(data)
+            carry = data[cut:]
+            if cut > 0:
+                lines = data[:cut].decode('utf-8').split('\n')
+                if lines[-1] == '':
+                    lines.pop()
+                yield lines
+        if carry:
+            yield carry.decode('utf-8').split('\n')
+
+
+# Parse a data file (has_vectors=True) or a role file (has_vectors=False), or the part of
+# it between the byte offsets start and end. The file is read in blocks so that the text
+# of a large file is never held in memory all at once.
+def parse_sequence_file(path, has_vectors=True, start=0, end=None):
+    token_to_local = {}
+    vocab = []
+    tokens = []
+    lengths = []
+    vectors = []
+
+    for lines in _read_line_blocks(path, start, end):
+        block_tokens, block_lengths, block_vectors = \
+            _parse_block(lines, has_vectors, token_to_local, vocab)
+        tokens.append(block_tokens)
+        lengths.append(block_lengths)
+        vectors.append(block_vectors)
+
+    return _assemble_sequence_file(vocab, tokens, lengths, vectors if has_vectors else None)
+
+
+def _assemble_sequence_file(vocab, tokens, lengths, vectors):
+    offsets = np.zeros(sum(len(block) for block in lengths) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+
+    if vectors is not None:
+        if vectors:
+            vectors = np.concatenate(vectors)
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+
+    return SequenceFile(
+        vocab,
+        np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int32),
+        offsets,
+        vectors
+    )
+
+
+# Join SequenceFiles parsed from consecutive parts of one file. The vocab keeps the
+# first-seen order of the whole file.
+def concatenate_sequence_files(parts):
+    token_to_local, _ = merge_vocabularies([part.vocab for part in parts])
+    return _assemble_sequence_file(
+        list(token_to_local),
+        [index_tokens(part, token_to_local).astype(np.int32) for part in parts],
+        [sequence_lengths(part.offsets) for part in parts],
+        None if parts[0].vectors is None else [part.vectors for part in parts]
+    )
+
+
+# Split a file into about num_chunks byte ranges that each start at the beginning of a line
+def _file_chunks(path, num_chunks):
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as data_file:
+        for chunk in range(1, num_chunks):
+            data_file.seek(max(size * chunk // num_chunks, boundaries[-1]))
+            data_file.readline()
+            if data_file.tell() >= size:
+                break
+            if data_file.tell() > boundaries[-1]:
+                boundaries.append(data_file.tell())
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _parse_chunk(task):
+    path, has_vectors, start, end = task
+    return parse_sequence_file(path, has_vectors, start, end)
+
+
+def _cache_prefix(cache_dir, path, has_vectors):
+    key = '{}.v{}.{}'.format(file_hash(path), CACHE_VERSION, 'data' if has_vectors else 'roles')
+    return os.path.join(cache_dir, key)
+
+
+def _save_array(filename, array):
+    # Write to a temporary file first so that an interrupted run never leaves
+    # a truncated array behind
+    temp_filename = filename + '.tmp.npy'
+    np.save(temp_filename, array)
+    os.replace(temp_filename, filename)
+
+
+def save_cached_sequence_file(prefix, sequence_file):
+    _save_array(prefix + '.tokens.npy', sequence_file.tokens)
+    _save_array(prefix + '.offsets.npy', sequence_file.offsets)
+    if sequence_file.vectors is not None:
+        _save_array(prefix + '.vectors.npy', sequence_file.vectors)
+
+    # The vocab is written last; its presence marks the cache entry as complete
+    temp_filename = prefix + '.vocab.pickle.tmp'
+    with open(temp_filename, 'wb') as handle:
+        pickle.dump(sequence_file.vocab, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, prefix + '.vocab.pickle')
+
+
+# Load a cache entry. The arrays are memory-mapped copy-on-write, so nothing is
+# read until it is used and the file on disk is never modified.
+def load_cached_sequence_file(prefix):
+    with open(prefix + '.vocab.pickle', 'rb') as handle:
+        vocab = pickle.load(handle)
+
+    vectors = None
+    if os.path.exists(prefix + '.vectors.npy'):
+        vectors = np.load(prefix + '.vectors.npy', mmap_mode='c')
+
+    return SequenceFile(
+        vocab,
+        np.load(prefix + '.tokens.npy', mmap_mode='c'),
+        np.load(prefix + '.offsets.npy', mmap_mode='c'),
+        vectors
+    )
+
+
+# Load a data or role file, going through the cache in cache_dir if one is given
+def load_sequence_file(path, has_vectors=True, cache_dir=None):
+    if cache_dir is None:
+        return parse_sequence_file(path, has_vectors)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    prefix = _cache_prefix(cache_dir, path, has_vectors)
+    if os.path.exists(prefix + '.vocab.pickle'):
+        print('Loading {} from cache {}'.format(path, prefix))
+        return load_cached_sequence_file(prefix)
+
+    print('Parsing {} and caching it to {}'.format(path, prefix))
+    save_cached_sequence_file(prefix, parse_sequence_file(path, has_vectors))
+    return load_cached_sequence_file(prefix)
+
+
+# Load several data or role files using num_workers processes. Every file that is not
+# already cached is cut into line-aligned chunks, and the chunks of all files are parsed
+# concurrently. Each worker sends back compact arrays, which are then joined per file.
+def load_sequence_files(paths, has_vectors=True, cache_dir=None, num_workers=1):
+    if num_workers <= 1:
+        return [load_sequence_file(path, has_vectors, cache_dir) for path in paths]
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    loaded = {}
+    prefixes = {}
+    for path in set(paths):
+        if cache_dir is not None:
+            prefixes[path] = _cache_prefix(cache_dir, path, has_vectors)
+            if os.path.exists(prefixes[path] + '.vocab.pickle'):
+                print('Loading {} from cache {}'.format(path, prefixes[path]))
+                loaded[path] = load_cached_sequence_file(prefixes[path])
+
+    to_parse = sorted(set(paths) - set(loaded))
+    if to_parse:
+        # Give each worker a few chunks so that files of different sizes balance out
+        total_size = sum(os.path.getsize(path) for path in to_parse)
+        chunk_size = max(total_size // (4 * num_workers), 1 << 20)
+        tasks = []
+        for path in to_parse:
+            num_chunks = max(os.path.getsize(path) // chunk_size, 1)
+            tasks.extend((path, has_vectors, start, end)
+                         for start, end in _file_chunks(path, num_chunks))
+
+        print('Parsing {} files in {} chunks with {} workers'.format(
+            len(to_parse), len(tasks), num_workers))
+        pool = Pool(num_workers)
+        try:
+            parsed_chunks = pool.map(_parse_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for path in to_parse:
+            sequence_file = concatenate_sequence_files(
+                [chunk for task, chunk in zip(tasks, parsed_chunks) if task[0] == path])
+            if cache_dir is not None:
+                print('Caching {} to {}'.format(path, prefixes[path]))
+                save_cached_sequence_file(prefixes[path], sequence_file)
+                sequence_file = load_cached_sequence_file(prefixes[path])
+            loaded[path] = sequence_file
+
+    return [loaded[path] for path in paths]
+
+
+# Build a single token index over several files. Tokens are numbered in the
+# order they are first seen when reading the files one after another, which is
+# the same as walking each file's own vocab (already in first-seen order).
+def merge_vocabularies(vocabs):
+    token_to_index = {}
+    index_to_token = {}
+
+    for vocab in vocabs:
+        for token in vocab:
+            if token not in token_to_index:
+                token_to_index[token] = len(token_to_index)
+                index_to_token[token_to_index[token]] = token
+
+    return token_to_index, index_to_token
+
+
+# An array mapping the file-local token ids of a SequenceFile to the ids of token_to_index
+def token_remap(sequence_file, token_to_index):
+    return np.array([token_to_index[token] for token in sequence_file.vocab], dtype=np.int64)
+
+
+# Map the file-local token ids of a SequenceFile to the ids of token_to_index
+def index_tokens(sequence_file, token_to_index):
+    return token_remap(sequence_file, token_to_index)[sequence_file.tokens]
+
+
+def sequence_lengths(offsets):
+    return np.diff(offsets)
+
+
+# Split flat token ids back into one list per sequence
+def split_sequences(token_ids, offsets):
+    token_ids = token_ids.tolist()
+    offsets = offsets.tolist()
+    return [token_ids[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+# Wrap a vector matrix as a tensor without copying it
+def vectors_to_tensor(vectors):
+    return torch.from_numpy(vectors)
+
+
+# Iterates over the training batches of a (usually memory-mapped) data file without
+# materializing the training set. Every pass visits chunks of chunk_size consecutive
+# sequences in a random order. Within a chunk the sequences are shuffled and grouped by
+# length into batches of batch_size, in the format built by trainIters_tpr. Sequences
+# left over in a length bucket are carried into the next chunk, and only the leftovers
+# of the last chunk are dropped, as batchify_tpr drops the remainder of each bucket.
+# Only one chunk of vectors is read into memory at a time, so memory use is bounded by
+# chunk_size whatever the size of the data file.
+#
+# Roles come either from a role file (role_file and role_remap) or from a role scheme
+# function (seq_to_roles). Sequences whose number of roles does not match their number
+# of fillers are skipped.
+class TPDNStream(object):
+    def __init__(self, sequence_file, filler_remap, batch_size, chunk_size=100000,
+                 role_file=None, role_remap=None, seq_to_roles=None, seed=None):
+        self.sequence_file = sequence_file
+        self.filler_remap = filler_remap
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.role_file = role_file
+        self.role_remap = role_remap
+        self.seq_to_roles = seq_to_roles
+        self.random_state = np.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self.sequence_file.offsets) - 1
+
+    # Read sequences start to end and return {length: (fillers, roles, vectors)}
+    def _load_chunk(self, start, end):
+        offsets = np.asarray(self.sequence_file.offsets[start:end + 1])
+        lengths = np.diff(offsets)
+        fillers = self.filler_remap[self.sequence_file.tokens[offsets[0]:offsets[-1]]]
+        filler_starts = offsets[:-1] - offsets[0]
+
+        if self.role_file is not None:
+            role_offsets = np.asarray(self.role_file.offsets[start:end + 1])
+            roles = self.role_remap[self.role_file.tokens[role_offsets[0]:role_offsets[-1]]]
+            role_starts = role_offsets[:-1] - role_offsets[0]
+            keep = np.diff(role_offsets) == lengths
+        else:
+            sequences = split_sequences(fillers, np.append(filler_starts, len(fillers)))
+            role_lists = [list(self.seq_to_roles(sequence)) for sequence in sequences]
+            role_lengths = np.array([len(role_list) for role_list in role_lists], dtype=np.int64)
+            roles = np.array([role for role_list in role_lists for role in role_list],
+                             dtype=np.int64)
+            role_starts = np.cumsum(role_lengths) - role_lengths
+            keep = role_lengths == lengths
+
+        if not keep.all():
+            print('Skipping {} sequences whose roles do not match their fillers'.format(
+                int((~keep).sum())))
+
+        vectors = np.asarray(self.sequence_file.vectors[start:end])
+        buckets = {}
+        for length in np.unique(lengths[keep]):
+            indices = np.nonzero(keep & (lengths == length))[0]
+            positions = np.arange(length)
+            buckets[int(length)] = (
+                fillers[filler_starts[indices][:, None] + positions],
+                roles[role_starts[indices][:, None] + positions],
+                vectors[indices]
+            )
+        return buckets
+
+    def __iter__(self):
+        num_sequences = len(self)
+        chunk_starts = np.arange(0, num_sequences, self.chunk_size)
+        self.random_state.shuffle(chunk_starts)
+
+        leftovers = {}
+        for start in chunk_starts:
+            batches = []
+            buckets = self._load_chunk(start, min(start + self.chunk_size, num_sequences))
+            for length, bucket in buckets.items():
+                if length in leftovers:
+                    bucket = tuple(np.concatenate(pair) for pair in zip(leftovers[length], bucket))
+                order = self.random_state.permutation(len(bucket[0]))
+                bucket = tuple(array[order] for array in bucket)
+
+                num_batches = len(order) // self.batch_size
+                for batch_num in range(num_batches):
+                    batch = slice(batch_num * self.batch_size, (batch_num + 1) * self.batch_size)
+                    batches.append(tuple(array[batch] for array in bucket))
+                leftovers[length] = tuple(array[num_batches * self.batch_size:]
+                                          for array in bucket)
+
+            for index in self.random_state.permutation(len(batches)):
+                fillers, roles, vectors = batches[index]
+                yield (torch.from_numpy(fillers).long(),
+                       torch.from_numpy(roles).long(),
+                       torch.from_numpy(vectors).unsqueeze(0))
+
+
+# Reorder the sequences of a flat token array. Returns the tokens and offsets of the
+# sequences order[0], order[1], ...
+def gather_sequences(token_ids, offsets, order):
+    order = np.asarray(order, dtype=np.int64)
+    lengths = np.diff(offsets)[order]
+    new_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(offsets[:-1][order] - new_offsets[:-1], lengths) + \
+        np.arange(new_offsets[-1])
+    return token_ids[positions], new_offsets
+
+
+# Apply a role scheme function to every sequence of a flat token array. Returns the role
+# ids and their offsets.
+def sequence_roles(seq_to_roles, token_ids, offsets):
+    role_lists = [list(seq_to_roles(sequence)) for sequence in split_sequences(token_ids, offsets)]
+    role_offsets = np.zeros(len(role_lists) + 1, dtype=np.int64)
+    np.cumsum([len(role_list) for role_list in role_lists], out=role_offsets[1:])
+    roles = np.array([role for role_list in role_lists for role in role_list], dtype=np.int64)
+    return roles, role_offsets
+
+
+# A TPDN data set stored as columns rather than one tuple per example:
+#   fillers: a LongTensor with the filler ids of all sequences, concatenated
+#   roles:   a LongTensor with the role ids of all sequences, concatenated
+#   offsets: sequence i is fillers[offsets[i]:offsets[i + 1]] (and the same for roles)
+#   targets: a (num_sequences, vector_dim) FloatTensor
+# When the sequences are stored sorted by length (see sorted_by_length), every batch of
+# equal-length sequences is a contiguous range, and batch() returns views of the columns
+# without copying anything.
+class TPDNDataset(object):
+    def __init__(self, fillers, roles, offsets, targets):
+        self.fillers = fillers
+        self.roles = roles
+        self.offsets = offsets
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # The (fillers, roles, target) tuple of one example, as used by the evaluation code
+    def __getitem__(self, index):
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return (self.fillers[start:end].tolist(), self.roles[start:end].tolist(),
+                self.targets[index])
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # A dict mapping each sequence length to the indices of the sequences of that length
+    def length_buckets(self):
+        lengths = self.lengths()
+        return {int(length): np.nonzero(lengths == length)[0] for length in np.unique(lengths)}
+
+    # A new data set holding the examples at indices, in that order
+    def take(self, indices):
+        fillers, offsets = gather_sequences(self.fillers.numpy(), self.offsets, indices)
+        roles, _ = gather_sequences(self.roles.numpy(), self.offsets, indices)
+        return TPDNDataset(torch.from_numpy(fillers), torch.from_numpy(roles), offsets,
+                           self.targets[torch.from_numpy(np.asarray(indices, dtype=np.int64))])
+
+    def is_sorted_by_length(self):
+        return bool(np.all(np.diff(self.lengths()) >= 0))
+
+    # A copy of this data set with the examples stably sorted by length
+    def sorted_by_length(self):
+        return self.take(np.argsort(self.lengths(), kind='stable'))
+
+    # The batch of examples start to end - 1, which must all have the same length, in the
+    # format used by trainIters_tpr: fillers and roles of shape (batch_size, length) and
+    # targets of shape (1, batch_size, vector_dim)
+    def batch(self, start, end):
+        token_start, token_end = int(self.offsets[start]), int(self.offsets[end])
+        length = (token_end - token_start) // (end - start)
+        if self.offsets[start + 1] - token_start != length:
+            raise ValueError('All sequences in a batch must have the same length')
+        return (self.fillers[token_start:token_end].view(end - start, length),
+                self.roles[token_start:token_end].view(end - start, length),
+                self.targets[start:end].unsqueeze(0))
+
+    # The batch of examples start to end - 1, which may have different lengths. Fillers and
+    # roles are padded with index 0 up to the longest sequence of the batch, and the length
+    # of every sequence is returned as a fourth tensor so that the padding can be masked.
+    def padded_batch(self, start, end):
+        offsets = torch.from_numpy(np.asarray(self.offsets[start:end + 1]))
+        lengths = offsets[1:] - offsets[:-1]
+        positions = torch.arange(int(lengths.max()) if len(lengths) else 0)
+        mask = positions.unsqueeze(0) < lengths.unsqueeze(1)
+        indices = (offsets[:-1].unsqueeze(1) + positions) * mask
+        return (self.fillers[indices] * mask,
+                self.roles[indices] * mask,
+                self.targets[start:end].unsqueeze(0),
+                lengths)
+
+    # The (start, end) ranges of padded batches of a data set sorted by length: consecutive
+    # runs of batch_size sequences, with a smaller last batch so that no sequence is dropped
+    def padded_batch_ranges(self, batch_size):
+        return [(start, min(start + batch_size, len(self))) for start in
+                range(0, len(self), batch_size)]
+
+    # The (start, end) ranges of the batches of a data set sorted by length. As in
+    # batchify_tpr, batches hold sequences of one length and the remainder of each length
+    # is dropped.
+    def batch_ranges(self, batch_size):
+        lengths = self.lengths()
+        bucket_starts = np.concatenate([[0], np.nonzero(np.diff(lengths))[0] + 1])
+        bucket_ends = np.append(bucket_starts[1:], len(lengths))
+
+        ranges = []
+        for bucket_start, bucket_end in zip(bucket_starts, bucket_ends):
+            for batch_num in range((bucket_end - bucket_start) // batch_size):
+                start = int(bucket_start + batch_num * batch_size)
+                ranges.append((start, start + batch_size))
+        return ranges
+
+
+# Makes batches of roughly constant cost instead of a constant number of sequences. A batch
+# of n sequences padded to length L costs n * (token_cost * L + sequence_cost), so with the
+# default costs max_cost is a number of filler tokens (padding included), and with FLOP
+# estimates for the costs (see tpr_flop_costs in training.py) it is a FLOP budget.
+#
+# Without pad, a batch holds sequences of one length, and each length gets as many
+# sequences per batch as fit in the budget. With pad, sequences of different lengths share
+# batches: the data set is cut into random mega-buckets of mega_bucket_size sequences, each
+# mega-bucket is sorted by length, and runs of consecutive sequences are packed into a batch
+# while the padded batch fits in the budget. Small mega-buckets give more varied batches and
+# large ones less padding. Without mega_bucket_size the whole data set is one mega-bucket
+# and the batches are the same every epoch.
+#
+# Iterating over the sampler gives one epoch of batches, in a random order and in the
+# format of batchify_tpr. No sequence is dropped; a sequence that is over the budget on its
+# own gets a batch to itself.
+class TokenBudgetSampler(object):
+    def __init__(self, dataset, max_cost, pad=False, mega_bucket_size=None, token_cost=1,
+                 sequence_cost=0, seed=None):
+        if not dataset.is_sorted_by_length():
+            dataset = dataset.sorted_by_length()
+        self.dataset = dataset
+        self.max_cost = max_cost
+        self.pad = pad
+        self.mega_bucket_size = mega_bucket_size if pad else None
+        self.token_cost = token_cost
+        self.sequence_cost = sequence_cost
+        self.random_state = np.random.RandomState(seed)
+        self.ranges = self._batch_ranges(dataset.lengths())
+
+    def __len__(self):
+        return len(self.ranges)
+
+    # The number of sequences of length length that fit in the budget
+    def _sequences_per_batch(self, length):
+        return max(1, int(self.max_cost // (self.token_cost * length + self.sequence_cost)))
+
+    # The (start, end) ranges of the batches over sequences sorted by length. Batches do
+    # not cross the boundaries of mega-buckets, or of lengths without pad.
+    def _batch_ranges(self, lengths, bucket_size=None):
+        if self.pad:
+            bucket_size = bucket_size or len(lengths)
+            bucket_starts = np.arange(0, len(lengths), bucket_size)
+        else:
+            bucket_starts = np.concatenate([[0], np.nonzero(np.diff(lengths))[0] + 1])
+        bucket_ends = np.append(bucket_starts[1:], len(lengths))
+
+        ranges = []
+        for bucket_start, bucket_end in zip(bucket_starts, bucket_ends):
+            start = int(bucket_start)
+            while start < bucket_end:
+                # Lengths only grow within a bucket, so no batch starting here is longer
+                size = min(self._sequences_per_batch(lengths[start]), bucket_end - start)
+                if self.pad:
+                    costs = np.arange(1, size + 1) * (
+                        self.token_cost * lengths[start:start + size] + self.sequence_cost)
+                    size = max(1, int(np.searchsorted(costs, self.max_cost, side='right')))
+                ranges.append((start, start + size))
+                start += size
+        return ranges
+
+    # The order of the sequences for one epoch: random mega-buckets, each sorted by length
+    def _mega_bucket_order(self):
+        order = self.random_state.permutation(len(self.dataset))
+        lengths = self.dataset.lengths()[order]
+        for start in range(0, len(order), self.mega_bucket_size):
+            bucket = slice(start, start + self.mega_bucket_size)
+            order[bucket] = order[bucket][np.argsort(lengths[bucket], kind='stable')]
+        return order
+
+    def __iter__(self):
+        dataset, ranges = self.dataset, self.ranges
+        if self.mega_bucket_size is not None:
+            dataset = dataset.take(self._mega_bucket_order())
+            ranges = self._batch_ranges(dataset.lengths(), self.mega_bucket_size)
+
+        for index in self.random_state.permutation(len(ranges)):
+            start, end = ranges[index]
+            if self.pad:
+                yield dataset.padded_batch(start, end)
+            else:
+                yield dataset.batch(start, end)
+
+
+# A copy of a batch of tensors in page-locked memory, from which it can be copied to the GPU
+# asynchronously. Tensors that are already pinned are not copied again.
+def pin_batch(batch):
+    return tuple(tensor if tensor.is_pinned() else tensor.pin_memory() for tensor in batch)
+
+
+# A copy of a batch of tensors in shared memory, from which other processes can read it
+# without a copy. Tensors that are already shared are not copied again.
+def share_batch(batch):
+    return tuple(tensor if tensor.is_shared() else tensor.clone().share_memory_()
+                 for tensor in batch)
+
+
+# Iterates over batches that a background thread builds ahead of time. While the caller
+# works on one batch, the thread iterates over batches (a list, a TPDNStream, a
+# TokenBudgetSampler...) to assemble up to num_prefetch more, and with pin_memory or
+# share_memory copies them to page-locked or shared memory. The batches come out in the
+# order that batches gives them, and any randomness is in the iterable itself (see the
+# seed of TPDNStream and TokenBudgetSampler), so prefetching does not change results.
+# Errors raised while building a batch are raised again in the caller's thread.
+class BatchPrefetcher(object):
+    def __init__(self, batches, num_prefetch=2, pin_memory=False, share_memory=False):
+        self.batches = batches
+        self.num_prefetch = num_prefetch
+        self.pin_memory = pin_memory
+        self.share_memory = share_memory
+
+    def __len__(self):
+        return len(self.batches)
+
+    # Put an item on the queue, giving up if the consumer has stopped
+    def _put(self, queue, stop, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce(self, queue, stop):
+        try:
+            for batch in self.batches:
+                if self.share_memory:
+                    batch = share_batch(batch)
+                if self.pin_memory:
+                    batch = pin_batch(batch)
+                if not self._put(queue, stop, ('batch', batch)):
+                    return
+        except Exception as exception:
+            self._put(queue, stop, ('error', exception))
+        else:
+            self._put(queue, stop, ('end', None))
+
+    def __iter__(self):
+        queue = Queue(max(1, self.num_prefetch))
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(queue, stop))
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                kind, item = queue.get()
+                if kind == 'end':
+                    return
+                if kind == 'error':
+                    raise item
+                yield item
+        finally:
+            # Also reached when the caller stops iterating early
+            stop.set()
+            producer.join()
+
+
+# Build a TPDNDataset from flat filler and role arrays. As before, examples whose number of
+# roles does not match their number of fillers are reported and left out.
+def build_tpdn_dataset(fillers, filler_offsets, roles, role_offsets, targets):
+    filler_lengths = np.diff(filler_offsets)
+    role_lengths = np.full(len(filler_lengths), -1, dtype=np.int64)
+    num_role_sequences = min(len(filler_lengths), len(role_offsets) - 1)
+    role_lengths[:num_role_sequences] = np.diff(role_offsets)[:num_role_sequences]
+    matches = filler_lengths == role_lengths
+
+    for index in np.nonzero(~matches)[0]:
+        these_roles = []
+        if index < num_role_sequences:
+            these_roles = roles[role_offsets[index]:role_offsets[index + 1]].tolist()
+        print(index, "ERROR!!!",
+              fillers[filler_offsets[index]:filler_offsets[index + 1]].tolist(), these_roles)
+
+    keep = np.nonzero(matches)[0]
+    fillers, offsets = gather_sequences(fillers, filler_offsets, keep)
+    roles, _ = gather_sequences(roles, role_offsets, keep)
+    if len(keep) < len(matches):
+        targets = targets[torch.from_numpy(keep)]
+    return TPDNDataset(torch.from_numpy(fillers), torch.from_numpy(roles), offsets, targets)
+
+
+# Load the train, dev and test files of data_prefix in data_path, and the extra test file
+# extra_test_set if it is given, and index their fillers in the order they are first seen
+# across the files. With digits, the fillers '0' to '9' are indexed by their own values.
+# Returns the SequenceFiles, filler_to_index, index_to_filler, the length of the longest
+# sequence, and the (filler ids, offsets) of every split, or None for the splits in
+# skip_splits (such as a training set that is streamed).
+def load_tpdn_splits(data_path, data_prefix, extra_test_set=None, digits=True, cache_dir=None,
+                     num_workers=1, skip_splits=()):
+    data_files = [
+        os.path.join(data_path, data_prefix + ".data_from_train"),
+        os.path.join(data_path, data_prefix + ".data_from_dev"),
+        os.path.join(data_path, data_prefix + ".data_from_test")
+    ]
+    if extra_test_set is not None:
+        data_files.append(os.path.join(data_path, extra_test_set))
+
+    sequence_files = load_sequence_files(data_files, cache_dir=cache_dir,
+                                         num_workers=num_workers)
+    filler_to_index, index_to_filler = merge_vocabularies([f.vocab for f in sequence_files])
+    max_length = max([int(sequence_lengths(f.offsets).max(initial=0)) for f in sequence_files])
+
+    if digits:
+        for i in range(10):
+            filler_to_index[str(i)] = i
+            index_to_filler[i] = str(i)
+
+    filler_arrays = [None if i in skip_splits else
+                     (index_tokens(f, filler_to_index), np.asarray(f.offsets))
+                     for i, f in enumerate(sequence_files)]
+    return sequence_files, filler_to_index, index_to_filler, max_length, filler_arrays
+
+
+# Build the TPDNDataset of every split from its (filler ids, offsets), its (role ids,
+# offsets) and its targets. Splits without filler arrays have no dataset (None).
+def build_tpdn_datasets(filler_arrays, role_arrays, targets):
+    return [None if fillers is None else
+            build_tpdn_dataset(fillers[0], fillers[1], roles[0], roles[1], split_targets)
+            for fillers, roles, split_targets in zip(filler_arrays, role_arrays, targets)]
@@ -23,13 +23,26 @@ import time
 import math
 
 import pickle
+import copy
 
 from role_assignment_functions import *
 from evaluation import *
+from binding_operations import SumFlattenedOuterProduct, CircularConvolution, \
+    LowRankTensorProductProjection, sequence_mask, tensor_product_projection_costs
+from metrics import EpochMetrics, TrainingProgress
+from async_validation import AsyncValidator
+from checkpointing import CheckpointWriter, TrainingInterrupted, capture_rng_state, \
+    restore_rng_state, install_sigterm_handler, restore_sigterm_handler
+from data_parallel import broadcast_parameters, all_reduce_gradients, shard_batches, \
+    data_parallel_rank, data_parallel_size, barrier
+from tpdn_data import TPDNDataset, TPDNStream, TokenBudgetSampler, BatchPrefetcher, pin_batch
 from rolelearner.role_learning_tensor_product_encoder import RoleLearningTensorProductEncoder
 
 use_cuda = torch.cuda.is_available()
 
+# The number of validation rounds in a time budget, unless the cadence is given
+TIME_BUDGET_ROUNDS = 20
+
 # Train for a single batch
 # Inputs: 
 #   training_set: the batch
@@ -250,8 +263,24 @@ def batchify(data, batch_size):
     return batches
 
 
-# Generate batches suitable for a TPDN from some dataset
-def batchify_tpr(data, batch_size):
+# Generate batches suitable for a TPDN from some dataset. For a TPDNDataset the batches
+# are returned as (fillers, roles, targets) tensors that are views of the dataset. With
+# pad=True, sequences of different lengths share batches: they are padded and a fourth
+# tensor holds their lengths, and no sequence is dropped.
+def batchify_tpr(data, batch_size, pad=False):
+    if isinstance(data, TPDNDataset):
+        if not data.is_sorted_by_length():
+            data = data.sorted_by_length()
+        if pad:
+            batches = [data.padded_batch(start, end) for start, end in
+                       data.padded_batch_ranges(batch_size)]
+        else:
+            batches = [data.batch(start, end) for start, end in data.batch_ranges(batch_size)]
+        shuffle(batches)
+        return batches
+    elif pad:
+        raise ValueError('Padded batches can only be made from a TPDNDataset')
+
     length_sorted_dict = {}
     max_length = 0
 
@@ -339,8 +368,102 @@ def train_iters(encoder, decoder, train_data, dev_data, file_prefix, input_to_ou
 
 
 
+# Batch a TPDN dataset (a TPDNDataset, a TokenBudgetSampler or a list of (fillers, roles,
+# target) tuples) into (fillers, roles, targets) tensors
+def tpr_batches(data, batch_size, pad=False):
+    if isinstance(data, TokenBudgetSampler):
+        return list(data)
+    if isinstance(data, TPDNDataset):
+        return batchify_tpr(data, batch_size, pad)
+
+    return [(Variable(torch.LongTensor([item[0] for item in batch])),
+             Variable(torch.LongTensor([item[1] for item in batch])),
+             torch.cat([item[2].unsqueeze(0).unsqueeze(0) for item in batch], 1))
+            for batch in batchify_tpr(data, batch_size)]
+
+
+# Estimate the floating point operations a TPDN spends on each filler token and on each
+# sequence of a batch, counting two per multiply-add of the binding and of every linear or
+# LSTM layer. Only the final layer is applied once per sequence. These are the costs that
+# a TokenBudgetSampler needs to make batches of a given FLOP budget. With fused_binding, the
+# costs depend on the order tensor_product_projection picks, which depends on the size of
+# the batch, so the batches of max_cost FLOPs of sequences of the given length are costed
+# (see fused_binding_flop_costs).
+def tpr_flop_costs(tpr_encoder, max_cost=None, length=None):
+    last_layer = getattr(tpr_encoder, 'last_layer', None)
+    fused_binding = getattr(tpr_encoder, 'fused_binding', False)
+    sequence_flops = 0
+    if fused_binding:
+        token_flops, sequence_flops = fused_binding_flop_costs(tpr_encoder, max_cost, length)
+    elif isinstance(last_layer, LowRankTensorProductProjection):
+        # The fillers and roles are bound after their projection to the rank
+        projection = last_layer
+        last_layer = projection.output
+        token_flops = 2 * projection.rank * (projection.rank if projection.kind == "tucker" else 1)
+    elif isinstance(tpr_encoder.sum_layer, SumFlattenedOuterProduct):
+        token_flops = 2 * tpr_encoder.filler_dim * tpr_encoder.role_dim
+    elif isinstance(tpr_encoder.sum_layer, CircularConvolution):
+        # Two real FFTs of about 2.5 d log2(d) each, and the product of the spectra
+        token_flops = int(5 * tpr_encoder.filler_dim * math.log2(tpr_encoder.filler_dim)) + \
+            6 * (tpr_encoder.filler_dim // 2 + 1)
+    else:
+        token_flops = 2 * tpr_encoder.filler_dim
+
+    for module in tpr_encoder.modules():
+        if module is last_layer:
+            # Already in the costs of the fused binding
+            if not fused_binding:
+                sequence_flops += 2 * module.weight.numel()
+        elif isinstance(module, nn.Linear):
+            token_flops += 2 * module.weight.numel()
+        elif isinstance(module, nn.LSTM):
+            token_flops += 2 * sum(weight.numel() for name, weight in module.named_parameters()
+                                   if name.startswith('weight'))
+        elif isinstance(module, nn.MultiheadAttention):
+            # The query, key and value projections; the attention itself, which grows with the
+            # length of the sequence, is left out
+            token_flops += 2 * module.in_proj_weight.numel()
+
+    if isinstance(tpr_encoder, RoleLearningTensorProductEncoder) and not fused_binding:
+        # Mixing the role embeddings by the role predictions
+        token_flops += 2 * tpr_encoder.n_roles * tpr_encoder.role_dim
+    return token_flops, sequence_flops
+
+
+# The FLOPs per token and per sequence of tensor_product_projection and the final layer, in
+# the order it picks for a batch of max_cost FLOPs of sequences of the given length:
+#   bind first:    mixing the role embeddings and the tensor product per token, and the
+#                  final layer per sequence
+#   project first: the fillers summed per role per token, and the final layer over the
+#                  roles per sequence. The role embeddings are projected through the final
+#                  layer once per batch, which is shared among the sequences of the batch.
+# Without a budget, the tensor product is charged, as for the unfused binding.
+def fused_binding_flop_costs(tpr_encoder, max_cost=None, length=None):
+    filler_dim, role_dim = tpr_encoder.filler_dim, tpr_encoder.role_dim
+    n_roles, width = tpr_encoder.n_roles, tpr_encoder.last_layer.out_features
+    bind_first = (2 * (n_roles * role_dim + filler_dim * role_dim),
+                  2 * filler_dim * role_dim * width)
+    if max_cost is None or length is None:
+        return bind_first
+
+    token_flops, sequence_flops = bind_first
+    batch_size = max(1, int(max_cost // (token_flops * length + sequence_flops)))
+    bind_first_cost, project_first_cost = tensor_product_projection_costs(
+        batch_size, length, filler_dim, n_roles, role_dim, width)
+    if bind_first_cost <= project_first_cost:
+        return bind_first
+
+    token_flops, sequence_flops = 2 * n_roles * filler_dim, 2 * n_roles * filler_dim * width
+    batch_flops = 2 * n_roles * role_dim * filler_dim * width
+    batch_size = max(1, int((max_cost - batch_flops) // (token_flops * length + sequence_flops)))
+    return token_flops, sequence_flops + batch_flops // batch_size
+
+
 # Training a TPDN for a single batch
-def train_tpr(batch, tpr_encoder, tpr_optimizer, criterion, one_hot_temperature = 1.0):
+# With distributed, the gradients are averaged over the ranks of a data-parallel run before
+# the step.
+def train_tpr(batch, tpr_encoder, tpr_optimizer, criterion, one_hot_temperature = 1.0,
+              distributed=False):
     # Zero the gradient 
     tpr_optimizer.zero_grad()
 
@@ -353,21 +476,23 @@ def train_tpr(batch, tpr_encoder, tpr_optimizer, criterion, one_hot_temperature
     input_fillers = batch[0]  # The list of fillers for the input
     input_roles = batch[1]  # The list of roles hypothesized for the input
     target_variable = batch[2]  # The mystery vector associated with this input
+    lengths = batch[3] if len(batch) > 3 else None  # Sequence lengths of a padded batch
     if use_cuda:
-        input_fillers = input_fillers.cuda()
-        input_roles = input_roles.cuda()
-        target_variable = target_variable.cuda()
+        # Asynchronous when the batch was pinned by the batch pipeline
+        input_fillers = input_fillers.cuda(non_blocking=True)
+        input_roles = input_roles.cuda(non_blocking=True)
+        target_variable = target_variable.cuda(non_blocking=True)
 
     if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
-        tpr_encoder_output, role_predictions = tpr_encoder(input_fillers, input_roles)
+        tpr_encoder_output, role_predictions = tpr_encoder(input_fillers, input_roles, lengths)
         batch_one_hot_loss, batch_l2_loss, batch_unique_loss = \
-            tpr_encoder.get_regularization_loss(role_predictions)
+            tpr_encoder.get_regularization_loss(role_predictions, lengths)
         one_hot_loss += batch_one_hot_loss
         l2_norm_loss += batch_l2_loss
         unique_role_loss += batch_unique_loss
     else:
         # Find the output for this input
-        tpr_encoder_output = tpr_encoder(input_fillers, input_roles)
+        tpr_encoder_output = tpr_encoder(input_fillers, input_roles, lengths)
 
     # Find the loss associated with this output
     # loss += criterion(tpr_encoder_output.unsqueeze(0), target_variable)
@@ -378,47 +503,399 @@ def train_tpr(batch, tpr_encoder, tpr_optimizer, criterion, one_hot_temperature
 
     # Backpropagate the loss
     loss.backward()
+    if distributed:
+        all_reduce_gradients(tpr_encoder)
     tpr_optimizer.step()
 
-    # Return the loss
-    return loss.data.item(), mse_loss, one_hot_loss, unique_role_loss, l2_norm_loss
+    # Return the loss. It is not copied to the host here, which would wait for the GPU
+    # after every batch.
+    return loss.detach(), mse_loss, one_hot_loss, unique_role_loss, l2_norm_loss
+
+
+# Statistics of the role predictions of a batch, as tensors on the batch's device:
+#   elements:             the number of positions (padding excluded)
+#   low_confidence:       the number of positions whose highest role weight is below .98
+#   role_counts:          how often each role has the highest weight
+#   confidence_histogram: the highest role weights counted in num_bins equal bins of [0, 1]
+#                         (weights outside [0, 1] go to the first or last bin)
+def role_prediction_statistics(role_predictions, lengths=None, num_bins=10):
+    confidence, predicted_roles = torch.max(role_predictions, 2)
+    if lengths is not None:
+        mask = sequence_mask(lengths.to(confidence.device), confidence.shape[0]).t().bool()
+        confidence = confidence[mask]
+        predicted_roles = predicted_roles[mask]
+    else:
+        confidence = confidence.reshape(-1)
+        predicted_roles = predicted_roles.reshape(-1)
+
+    bins = (confidence * num_bins).long().clamp(0, num_bins - 1)
+    return {
+        'elements': torch.tensor(confidence.numel(), device=confidence.device),
+        'low_confidence': torch.sum(confidence < .98),
+        'role_counts': torch.bincount(predicted_roles, minlength=role_predictions.shape[2]),
+        'confidence_histogram': torch.bincount(bins, minlength=num_bins)
+    }
+
+
+# Add the validation loss terms of a TPDN on a list of batches to an EpochMetrics, with the
+# role prediction statistics of a RoleLearningTensorProductEncoder
+def validate_tpr(tpr_encoder, dev_batches, dev_metrics):
+    with torch.no_grad():
+        for dev_batch in dev_batches:
+            input_fillers = dev_batch[0]
+            input_roles = dev_batch[1]
+            target_variable = dev_batch[2]
+            lengths = dev_batch[3] if len(dev_batch) > 3 else None
+            if use_cuda:
+                input_fillers = input_fillers.cuda(non_blocking=True)
+                input_roles = input_roles.cuda(non_blocking=True)
+                target_variable = target_variable.cuda(non_blocking=True)
+            if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
+                out, role_predictions = tpr_encoder(input_fillers, input_roles, lengths)
+                batch_one_hot_loss, batch_l2_norm_loss, batch_unique_role_loss = \
+                    tpr_encoder.get_regularization_loss(role_predictions, lengths)
+                terms = role_prediction_statistics(role_predictions, lengths)
+            else:
+                out = tpr_encoder(input_fillers, input_roles, lengths)
+                batch_one_hot_loss, batch_l2_norm_loss, batch_unique_role_loss = 0, 0, 0
+                terms = {}
+            dev_metrics.add(len(input_fillers),
+                            mse=torch.mean(torch.pow(out - target_variable, 2)),
+                            one_hot=batch_one_hot_loss, l2_norm=batch_l2_norm_loss,
+                            unique_role=batch_unique_role_loss, **terms)
+
+    return dev_metrics
+
+
+# The validation loss terms of a TPDN on a list of batches, as an EpochMetrics. Every term
+# stays on the device until the end of the pass. With all_reduce, the terms are summed over
+# the ranks of a data-parallel run.
+def validation_metrics(tpr_encoder, dev_batches, prefetch=0, all_reduce=False):
+    dev_metrics = EpochMetrics()
+
+    #if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
+    #    tpr_encoder.eval()
+
+    if prefetch:
+        dev_batches = BatchPrefetcher(dev_batches, prefetch)
+    validate_tpr(tpr_encoder, dev_batches, dev_metrics)
+
+    # After the all-reduce, every rank has the same totals, and so makes the same early
+    # stopping decisions
+    if all_reduce:
+        dev_metrics.all_reduce()
+    return dev_metrics
+
+
+# The mean validation loss per batch (the MSE plus the regularization terms) from the totals
+# of an EpochMetrics
+def total_validation_loss(val_totals, num_batches):
+    num_dev_batches = max(num_batches, 1)
+    return (val_totals['mse'] + val_totals['one_hot'] + val_totals['l2_norm'] +
+            val_totals['unique_role']) / num_dev_batches
+
+
+# Print the training summary and the validation losses and role statistics of a validation
+# round, labelled as in 'Epoch 3', and return the total validation loss
+def report_validation(label, train_summary, dev_metrics):
+    val_totals = dev_metrics.host_totals()
+    num_dev_batches = max(dev_metrics.num_batches, 1)
+    val_mse = val_totals['mse'] / num_dev_batches
+    val_one_hot_loss = val_totals['one_hot'] / num_dev_batches
+    val_l2_loss = val_totals['l2_norm'] / num_dev_batches
+    val_unique_role_loss = val_totals['unique_role'] / num_dev_batches
+    num_elements = int(val_totals.get('elements', 0))
+
+    total_val_loss = val_mse + val_one_hot_loss + val_l2_loss + val_unique_role_loss
+    print('{}\ttraining: {}'.format(label, train_summary))
+    print('{}\tvalidation loss: {}'.format(label, total_val_loss))
+    print('Val MSE loss: {}'.format(val_mse))
+    print('Val one hot loss: {}'.format(val_one_hot_loss))
+    print('Val unique role loss: {}'.format(val_unique_role_loss))
+    print('Val l2 norm loss: {}'.format(val_l2_loss))
+    print('num elements {}'.format(num_elements))
+    print('number of roles used: {}'.format(
+        sum(1 for count in val_totals.get('role_counts', []) if count > 0)))
+    print('percentage low role prediction: {}'.format(
+        100 * val_totals.get('low_confidence', 0) / max(num_elements, 1)))
+    if 'confidence_histogram' in val_totals:
+        print('role prediction confidence histogram: {}'.format(
+            [int(count) for count in val_totals['confidence_histogram']]))
+    print('')
+    return total_val_loss
+
+
+# A fixed random subset of a list of batches holding about num_sequences sequences. The
+# same batches are chosen on every call (and on every rank of a data-parallel run).
+def subsample_batches(batches, num_sequences):
+    batches = list(batches)
+    random.Random(0).shuffle(batches)
+    subsample = []
+    total = 0
+    for batch in batches:
+        if total >= num_sequences:
+            break
+        subsample.append(batch)
+        total += len(batch[0])
+    return subsample
 
 
 # Training a TPDN for multiple iterations
 def trainIters_tpr(train_data, dev_data, tpr_encoder, n_epochs,
                    learning_rate=0.001, batch_size=5, weight_file=None, patience=3,
-                   use_one_hot_temperature=False, burn_in=0):
+                   use_one_hot_temperature=False, burn_in=0, pad_batches=False, prefetch=0,
+                   pin_memory=False, distributed=False, validate_every_steps=None,
+                   validate_every_seconds=None, dev_subsample=None, confirm_full_dev=False,
+                   time_budget=None, progress_file=None, state_file=None, resume=False,
+                   async_validation=False, max_validation_lag=1):
+    start_time = time.time()
     # The optimization algorithm; could use SGD instead of Adam
     tpr_optimizer = optim.Adam(tpr_encoder.parameters(), lr=learning_rate)
 
     # Using mean squared error as the loss
     criterion = nn.MSELoss()
     prev_loss = 1000000
-    # Keeps track of the number of epochs since improvement for early stopping
-    count_epochs_not_improved = 0
+    # Keeps track of the number of validation rounds since improvement for early stopping
+    count_rounds_not_improved = 0
     count_unhelpful_cuts = 0
     training_done = 0
     best_loss = prev_loss
+    # The best loss on the dev subsample, when it is confirmed on the full dev set
+    best_round_loss = prev_loss
 
     one_hot_temperature = 1.0
     if use_one_hot_temperature:
         one_hot_temperature = 0.0
 
-    # Format the data
-    train_data = batchify_tpr(train_data, batch_size)
-    dev_data = batchify_tpr(dev_data, batch_size)
+    # Format the data. A TPDNStream or a TokenBudgetSampler produces its own shuffled
+    # batches each epoch.
+    streaming = isinstance(train_data, (TPDNStream, TokenBudgetSampler))
+    if streaming:
+        training_sets = train_data
+    else:
+        training_sets = tpr_batches(train_data, batch_size, pad_batches)
+
+    dev_data_sets = tpr_batches(dev_data, batch_size, pad_batches)
+    # Validation rounds use a fixed random subset of the dev batches when dev_subsample is
+    # given, and the full dev set otherwise
+    round_dev_sets = dev_data_sets
+    if dev_subsample is not None:
+        round_dev_sets = subsample_batches(dev_data_sets, dev_subsample)
+        print('Validating on {} of the {} dev batches'.format(len(round_dev_sets),
+                                                             len(dev_data_sets)))
+    if not round_dev_sets:
+        raise ValueError('There are no dev batches to validate on')
+
+    # In a data-parallel run (see data_parallel.py), every rank starts from rank 0's weights
+    # and trains on its share of each epoch's batches. Each rank also validates on a share of
+    # the dev batches, unless there are fewer dev batches than ranks.
+    shard_dev = False
+    if distributed:
+        broadcast_parameters(tpr_encoder)
+        shard_dev = len(round_dev_sets) >= data_parallel_size()
+        if shard_dev:
+            dev_data_sets = shard_batches(dev_data_sets, shuffle=False, pad=False)
+            round_dev_sets = shard_batches(round_dev_sets, shuffle=False, pad=False)
+
+    # With prefetch, the next batches are built (and pinned) by a background thread during
+    # each step. Fixed batch lists only need to be pinned once.
+    pin_memory = pin_memory and use_cuda
+    if pin_memory:
+        dev_data_sets = [pin_batch(batch) for batch in dev_data_sets]
+        round_dev_sets = [pin_batch(batch) for batch in round_dev_sets] \
+            if dev_subsample is not None else dev_data_sets
+        if not streaming:
+            training_sets = [pin_batch(batch) for batch in training_sets]
+
+    # With async_validation, the weights of a round are no longer those of tpr_encoder once
+    # its results arrive, so they are confirmed on the full dev set in a copy of the model
+    confirm_encoder = copy.deepcopy(tpr_encoder) \
+        if async_validation and confirm_full_dev and dev_subsample is not None else None
+
+    # The regularization that the weights of a round are validated with
+    def regularization_settings():
+        return (getattr(tpr_encoder, 'regularize', False),
+                getattr(tpr_encoder, 'regularization_temp', 1))
+
+    # Acts on the validation metrics of a round: reports them, saves model_state (the
+    # weights that were validated, with the given regularization settings) if they improved
+    # and returns whether to stop training
+    def validation_result(label, round_epoch, round_step, train_summary, regularization,
+                          dev_metrics, may_save, model_state):
+        nonlocal best_loss, best_round_loss, count_rounds_not_improved
+        total_val_loss = report_validation(label, train_summary, dev_metrics)
+        round_loss = total_val_loss
 
-    training_sets = [(Variable(torch.LongTensor([item[0] for item in batch])),
-                     Variable(torch.LongTensor([item[1] for item in batch])),
-                     torch.cat([item[2].unsqueeze(0).unsqueeze(0) for item in batch], 1)) for batch in train_data]
+        # When we turn on regularization, we want to start validating from the newest checkpoint
+        stop = False
+        if may_save:
+            improved = total_val_loss < best_round_loss
+            if improved:
+                best_round_loss = total_val_loss
+                if confirm_full_dev and dev_subsample is not None:
+                    full_dev_encoder = tpr_encoder
+                    if confirm_encoder is not None:
+                        full_dev_encoder = confirm_encoder
+                        full_dev_encoder.load_state_dict(model_state)
+                        if isinstance(full_dev_encoder, RoleLearningTensorProductEncoder):
+                            full_dev_encoder.use_regularization(regularization[0])
+                            full_dev_encoder.set_regularization_temp(regularization[1])
+                    full_metrics = validation_metrics(full_dev_encoder, dev_data_sets, prefetch,
+                                                      shard_dev)
+                    total_val_loss = total_validation_loss(full_metrics.host_totals(),
+                                                           full_metrics.num_batches)
+                    print('Full dev set validation loss: {}'.format(total_val_loss))
+                    improved = total_val_loss < best_loss
+
+            if improved:
+                print('Saving model at {}'.format(label.lower()))
+                count_rounds_not_improved = 0
+                best_loss = total_val_loss
+                # The ranks hold the same weights, so only rank 0 writes them
+                if data_parallel_rank() == 0:
+                    checkpoints.save(model_state, weight_file)
+            else:
+                count_rounds_not_improved += 1
+                if count_rounds_not_improved == patience:
+                    print('Finished training early')
+                    stop = True
+
+        if progress is not None:
+            progress.record(round_epoch, round_step, round_loss, best_loss)
+        return stop
+
+    # Validates, saves the model if it improved and returns whether to stop training. The
+    # training summary covers the batches since train_metrics was last reset. With
+    # async_validation, the weights are handed to the validation process instead, and the
+    # rounds whose results have arrived are acted on; training waits for results only when
+    # more than max_validation_lag rounds are outstanding.
+    def validation_round(label, may_save):
+        nonlocal last_round_seconds
+        round_start = time.time()
+        if distributed:
+            train_metrics.all_reduce()
+        train_summary = train_metrics.summary()
+        stop = False
+        if validator is None:
+            stop = validation_result(
+                label, epoch, step, train_summary, regularization_settings(),
+                validation_metrics(tpr_encoder, round_dev_sets, prefetch, shard_dev), may_save,
+                tpr_encoder.state_dict())
+        else:
+            validator.submit(tpr_encoder, (label, epoch, step, train_summary,
+                                           regularization_settings()), may_save)
+            for result in validator.results(wait=validator.num_pending() > max_validation_lag):
+                stop = validation_result(*result)
+                if stop:
+                    break
+        last_round_seconds = time.time() - round_start
+        return stop
+
+    # With a time budget, training stops early enough for a last validation round before the
+    # deadline. Unless a cadence is given, there are about TIME_BUDGET_ROUNDS rounds, spaced
+    # so that validation takes at most a fifth of the time.
+    deadline = None
+    adapt_cadence = False
+    last_round_seconds = 0
+    if time_budget is not None:
+        deadline = start_time + time_budget
+        if validate_every_steps is None and validate_every_seconds is None:
+            adapt_cadence = True
+            validate_every_seconds = time_budget / TIME_BUDGET_ROUNDS
+
+    # The loss of every validation round against time, written to progress_file as it goes
+    progress = None
+    if progress_file is not None:
+        progress = TrainingProgress(progress_file, start_time, deadline)
+
+    # Without validate_every_steps or validate_every_seconds, validation rounds follow the
+    # epochs
+    step_validation = validate_every_steps is not None or validate_every_seconds is not None
+    step = 0
+    epoch = 0
+    last_validation_time = time.time()
+    train_metrics = EpochMetrics()
+    finished = False
+    reached_max_temp = False
 
-    dev_data_sets = [(Variable(torch.LongTensor([item[0] for item in batch])),
-                     Variable(torch.LongTensor([item[1] for item in batch])),
-                     torch.cat([item[2].unsqueeze(0).unsqueeze(0) for item in batch], 1)) for batch in dev_data]
+    # The order of the batches of a fixed batch list in the current epoch
+    order = None if streaming else list(range(len(training_sets)))
+
+    # Checkpoints are written atomically by a background thread. With a state_file, the full
+    # training state is saved after every validation round and on SIGTERM, so that the run
+    # can be resumed from it; the batches already trained on in the current epoch are then
+    # skipped, except for a TPDNStream or TokenBudgetSampler, whose epoch starts over.
+    checkpoints = CheckpointWriter()
+    terminated, previous_handler = install_sigterm_handler() if state_file is not None \
+        else (None, None)
+
+    # The process that validates the weights of each round with async_validation
+    validator = None
+    if async_validation:
+        validator = AsyncValidator(tpr_encoder, round_dev_sets)
+
+    # Wait for the rounds that are still being validated, act on them in order, and stop the
+    # validation process, so that the training state saved next accounts for every round.
+    # Returns whether one of the rounds stopped training.
+    def finish_validation():
+        nonlocal validator
+        stop = False
+        if validator is not None:
+            for result in validator.results(wait_all=True):
+                if validation_result(*result):
+                    stop = True
+                    break
+            validator.close()
+            validator = None
+        return stop
+
+    def save_training_state(next_epoch, next_batch):
+        checkpoints.save({
+            'model': tpr_encoder.state_dict(),
+            'optimizer': tpr_optimizer.state_dict(),
+            'epoch': next_epoch,
+            'batch': next_batch,
+            'order': order,
+            'step': step,
+            'reached_max_temp': reached_max_temp,
+            'regularize': getattr(tpr_encoder, 'regularize', False),
+            'regularization_temp': getattr(tpr_encoder, 'regularization_temp', None),
+            'best_loss': best_loss,
+            'best_round_loss': best_round_loss,
+            'count_rounds_not_improved': count_rounds_not_improved,
+            'finished': finished,
+            'train_metrics': train_metrics.state_dict(),
+            'rng': capture_rng_state()
+        }, state_file)
+
+    start_epoch, start_batch = 0, 0
+    if resume and state_file is not None and os.path.exists(state_file):
+        state = torch.load(state_file, map_location=next(tpr_encoder.parameters()).device,
+                           weights_only=False)
+        tpr_encoder.load_state_dict(state['model'])
+        tpr_optimizer.load_state_dict(state['optimizer'])
+        start_epoch, start_batch = state['epoch'], state['batch']
+        step = state['step']
+        reached_max_temp = state['reached_max_temp']
+        if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
+            tpr_encoder.use_regularization(state['regularize'])
+            tpr_encoder.set_regularization_temp(state['regularization_temp'])
+        best_loss = state['best_loss']
+        best_round_loss = state['best_round_loss']
+        count_rounds_not_improved = state['count_rounds_not_improved']
+        finished = state['finished']
+        train_metrics.load_state_dict(state['train_metrics'])
+        if order is not None and state['order'] is not None:
+            order = state['order']
+        restore_rng_state(state['rng'])
+        print('Resuming training from epoch {}, batch {} (step {})'.format(
+            start_epoch, start_batch, step))
+        if finished:
+            print('The saved training run had already finished')
+            start_epoch = n_epochs
 
-    reached_max_temp = False
     # Conduct the desired number of training examples
-    for epoch in range(n_epochs):
+    for epoch in range(start_epoch, n_epochs):
         if burn_in == epoch:
             print('Burn in is over, turning on regularization')
             if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
@@ -437,94 +914,213 @@ def trainIters_tpr(train_data, dev_data, tpr_encoder, n_epochs,
             else:
                 reached_max_temp = True
 
-        epoch_mse_loss = 0
-        epoch_one_hot_loss = 0
-        epoch_unique_role_loss = 0
-        epoch_l2_norm_loss = 0
-
-        shuffle(training_sets)
+        # A resumed epoch keeps its batch order and skips the batches it has trained on
+        skip_batches = start_batch if epoch == start_epoch else 0
+        if distributed:
+            # Shuffled the same way on every rank, then split between the ranks
+            epoch_batches = shard_batches(training_sets, epoch)[skip_batches:]
+        elif not streaming:
+            if not skip_batches:
+                shuffle(order)
+            epoch_batches = [training_sets[index] for index in order[skip_batches:]]
+        else:
+            skip_batches = 0
+            epoch_batches = training_sets
 
         if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
             tpr_encoder.train()
 
-        for batch in training_sets:
+        if prefetch:
+            epoch_batches = BatchPrefetcher(epoch_batches, prefetch, pin_memory=pin_memory)
+
+        may_save = reached_max_temp or burn_in == epoch
+        for batch_index, batch in enumerate(epoch_batches, skip_batches):
             loss, batch_mse_loss, batch_one_hot_loss, batch_unique_role_loss, batch_l2_norm_loss = \
-                train_tpr(batch, tpr_encoder, tpr_optimizer, criterion, one_hot_temperature)
-            epoch_mse_loss += batch_mse_loss
-            epoch_one_hot_loss += batch_one_hot_loss
-            epoch_unique_role_loss += batch_unique_role_loss
-            epoch_l2_norm_loss += batch_l2_norm_loss
-
-        # Validate after the epoch
-        val_mse = 0
-        val_one_hot_loss = 0
-        val_l2_loss = 0
-        val_unique_role_loss = 0
-
-        #if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
-        #    tpr_encoder.eval()
-
-        num_elements = 1 # Start at 1 to avoid division by 0
-        num_elements_role_low = 0
-        roles_predicted = []
-        for i in range(len(dev_data_sets)):
-            input_fillers = dev_data_sets[i][0]
-            input_roles = dev_data_sets[i][1]
-            target_variable = dev_data_sets[i][2]
-            if use_cuda:
-                input_fillers = input_fillers.cuda()
-                input_roles = input_roles.cuda()
-                target_variable = target_variable.cuda()
-            if isinstance(tpr_encoder, RoleLearningTensorProductEncoder):
-                out, role_predictions = tpr_encoder(input_fillers, input_roles)
-                out = out.data
-                batch_one_hot_loss, batch_l2_norm_loss, batch_unique_role_loss = \
-                    tpr_encoder.get_regularization_loss(role_predictions)
-                val_one_hot_loss += batch_one_hot_loss
-                val_l2_loss += batch_l2_norm_loss
-                val_unique_role_loss += batch_unique_role_loss
-
-                for sequence_index in range(len(role_predictions)):
-                    for batch_index in range(len(role_predictions[sequence_index])):
-                        role_prediction = torch.argmax(role_predictions[sequence_index][batch_index])
-                        if role_predictions[sequence_index][batch_index][role_prediction] < .98:
-                            num_elements_role_low += 1
-                        num_elements += 1
-                        roles_predicted.append(role_prediction)
+                train_tpr(batch, tpr_encoder, tpr_optimizer, criterion, one_hot_temperature,
+                          distributed)
+            train_metrics.add(len(batch[0]), loss=loss, mse=batch_mse_loss,
+                              one_hot=batch_one_hot_loss, unique_role=batch_unique_role_loss,
+                              l2_norm=batch_l2_norm_loss)
+            step += 1
+
+            if terminated is not None and terminated.is_set():
+                finished = finish_validation()
+                save_training_state(epoch, batch_index + 1)
+                checkpoints.close()
+                restore_sigterm_handler(previous_handler)
+                raise TrainingInterrupted('Stopped by SIGTERM at epoch {}, step {}; the '
+                                          'training state is in {}'.format(epoch, step,
+                                                                           state_file))
+
+            if deadline is not None and time.time() + last_round_seconds >= deadline:
+                validation_round('Epoch {} step {}'.format(epoch, step), may_save)
+                finish_validation()
+                print('Reached the time budget of {} seconds'.format(time_budget))
+                finished = True
+                if state_file is not None:
+                    save_training_state(epoch, batch_index + 1)
+                break
+
+            if (validate_every_steps is not None and step % validate_every_steps == 0) or \
+                    (validate_every_seconds is not None and
+                     time.time() - last_validation_time >= validate_every_seconds):
+                finished = validation_round('Epoch {} step {}'.format(epoch, step), may_save)
+                train_metrics.reset()
+                last_validation_time = time.time()
+                if adapt_cadence:
+                    validate_every_seconds = max(time_budget / TIME_BUDGET_ROUNDS,
+                                                 4 * last_round_seconds)
+                if state_file is not None:
+                    save_training_state(epoch, batch_index + 1)
+                if finished:
+                    break
+
+        if not step_validation:
+            finished = validation_round('Epoch {}'.format(epoch), may_save)
+            train_metrics.reset()
+            if state_file is not None:
+                save_training_state(epoch + 1, 0)
+        if finished:
+            break
+
+    # Act on the rounds that are still being validated, unless training stopped early
+    if not finished:
+        finish_validation()
+    if validator is not None:
+        validator.close()
+
+    checkpoints.close()
+    restore_sigterm_handler(previous_handler)
+    if progress is not None:
+        progress.close()
+    # A SIGTERM that came after the last step, during validation
+    if terminated is not None and terminated.is_set():
+        raise TrainingInterrupted('Stopped by SIGTERM after training; the training state is '
+                                  'in {}'.format(state_file))
+    # The other ranks may read the weights once rank 0 has written them
+    if distributed:
+        barrier()
+    return best_loss
+
+
+# Training the members of a RoleLearningEnsemble side by side. Each member is trained on the
+# same batches with its own loss, and stops early on its own: once a member has gone
+# patience epochs without improving its validation loss, its weights stop changing while
+# the other members continue. The best weights of member k are saved to weight_files[k] in
+# the format of template, a RoleLearningTensorProductEncoder with the members' architecture.
+# Returns the best validation loss of every member.
+def trainIters_tpr_ensemble(train_data, dev_data, ensemble, template, n_epochs,
+                            learning_rate=0.001, batch_size=5, weight_files=None, patience=3,
+                            burn_in=0, pad_batches=False):
+    # Adam updates every parameter element on its own, so one optimizer over the stacked
+    # parameters is the same as an optimizer per member
+    tpr_optimizer = optim.Adam([param for param in ensemble.parameters() if param.requires_grad],
+                               lr=learning_rate)
+    num_members = ensemble.num_members
+    device = next(ensemble.parameters()).device
+
+    active = torch.ones(num_members, device=device)
+    # The weights of the members that have stopped, restored after every step
+    stopped_parameters = [param.detach().clone() for param in ensemble.parameters()]
+    count_epochs_not_improved = [0] * num_members
+    best_losses = [1000000] * num_members
+
+    training_sets = tpr_batches(train_data, batch_size, pad_batches)
+    dev_data_sets = tpr_batches(dev_data, batch_size, pad_batches)
+
+    reached_max_temp = False
+    for epoch in range(n_epochs):
+        if burn_in == epoch:
+            print('Burn in is over, turning on regularization')
+            ensemble.use_regularization(True)
+            if burn_in == 0:
+                print('Setting regularization temp to {}'.format(1))
+                ensemble.set_regularization_temp(1)
+                reached_max_temp = True
+
+        if epoch >= burn_in and not reached_max_temp:
+            temp = float(epoch - burn_in + 1) / burn_in
+            if temp <= 1:
+                print('Setting regularization temp to {}'.format(temp))
+                ensemble.set_regularization_temp(temp)
             else:
-                out = tpr_encoder(input_fillers, input_roles).data
-            val_mse += torch.mean(torch.pow(out - target_variable.data, 2))
-        val_mse = val_mse / len(dev_data_sets)
-        val_one_hot_loss = val_one_hot_loss / len(dev_data_sets)
-        val_l2_loss = val_l2_loss / len(dev_data_sets)
-        val_unique_role_loss = val_unique_role_loss / len(dev_data_sets)
-
-        total_val_loss = val_mse + val_one_hot_loss + val_l2_loss + val_unique_role_loss
-        print('Epoch {}\tvalidation loss: {}'.format(epoch, total_val_loss.item()))
-        print('Val MSE loss: {}'.format(val_mse))
-        print('Val one hot loss: {}'.format(val_one_hot_loss))
-        print('Val unique role loss: {}'.format(val_unique_role_loss))
-        print('Val l2 norm loss: {}'.format(val_l2_loss))
-        print('num elements {}'.format(num_elements))
-        print('number of roles used: {}'.format(len(np.unique(roles_predicted))))
-        print('percentage low role prediction: {}'.format(
-            100 * num_elements_role_low / num_elements))
+                reached_max_temp = True
+
+        train_metrics = EpochMetrics()
+        shuffle(training_sets)
+        ensemble.train()
+        for batch in training_sets:
+            tpr_optimizer.zero_grad()
+            input_fillers, input_roles, target_variable = batch[0], batch[1], batch[2]
+            lengths = batch[3] if len(batch) > 3 else None
+            if use_cuda:
+                input_fillers = input_fillers.cuda(non_blocking=True)
+                target_variable = target_variable.cuda(non_blocking=True)
+
+            out, role_predictions = ensemble(input_fillers, input_roles, lengths)
+            one_hot_loss, l2_norm_loss, unique_role_loss = \
+                ensemble.get_regularization_loss(role_predictions, lengths)
+            mse_loss = torch.mean(torch.pow(out - target_variable.unsqueeze(0), 2), (1, 2, 3))
+            member_losses = mse_loss + one_hot_loss + l2_norm_loss + unique_role_loss
+            torch.sum(active * member_losses).backward()
+            tpr_optimizer.step()
+
+            if not bool(active.all()):
+                with torch.no_grad():
+                    for param, stopped in zip(ensemble.parameters(), stopped_parameters):
+                        keep = active.view((-1,) + (1,) * (param.dim() - 1)).bool()
+                        param.copy_(torch.where(keep, param, stopped))
+
+            train_metrics.add(len(input_fillers), loss=member_losses, mse=mse_loss)
+
+        # Validate every member after the epoch
+        dev_metrics = EpochMetrics()
+        with torch.no_grad():
+            for dev_batch in dev_data_sets:
+                input_fillers, input_roles, target_variable = dev_batch[0], dev_batch[1], \
+                    dev_batch[2]
+                lengths = dev_batch[3] if len(dev_batch) > 3 else None
+                if use_cuda:
+                    input_fillers = input_fillers.cuda(non_blocking=True)
+                    target_variable = target_variable.cuda(non_blocking=True)
+                out, role_predictions = ensemble(input_fillers, input_roles, lengths)
+                one_hot_loss, l2_norm_loss, unique_role_loss = \
+                    ensemble.get_regularization_loss(role_predictions, lengths)
+                mse_loss = torch.mean(torch.pow(out - target_variable.unsqueeze(0), 2),
+                                      (1, 2, 3))
+                dev_metrics.add(len(input_fillers), mse=mse_loss,
+                                loss=mse_loss + one_hot_loss + l2_norm_loss + unique_role_loss)
+
+        train_means = train_metrics.means()
+        val_means = dev_metrics.means()
+        print('Epoch {}\ttraining: {:.1f} examples/sec'.format(
+            epoch, train_metrics.examples_per_second()))
+        for k in range(num_members):
+            status = '' if active[k] else ' (stopped)'
+            print('Member {}{}\ttraining loss: {}\tvalidation loss: {}\tVal MSE loss: {}'.format(
+                k, status, train_means['loss'][k], val_means['loss'][k], val_means['mse'][k]))
         print('')
-        #print('Training MSE loss: {}'.format(epoch_mse_loss))
-        #print('Training one hot loss: {}'.format(epoch_one_hot_loss))
-        #print('Training unique role loss: {}'.format(epoch_unique_role_loss))
-        #print('Training l2 norm loss: {}'.format(epoch_l2_norm_loss))
+
         # When we turn on regularization, we want to start validating from the newest checkpoint
         if reached_max_temp or burn_in == epoch:
-            if total_val_loss < best_loss:
-                print('Saving model at epoch {}'.format(epoch))
-                count_epochs_not_improved = 0
-                best_loss = total_val_loss
-                torch.save(tpr_encoder.state_dict(), weight_file)
-            else:
-                count_epochs_not_improved += 1
-                if count_epochs_not_improved == patience:
-                    print('Finished training early')
-                    break
+            for k in range(num_members):
+                if not active[k]:
+                    continue
+                if val_means['loss'][k] < best_losses[k]:
+                    print('Saving member {} at epoch {}'.format(k, epoch))
+                    count_epochs_not_improved[k] = 0
+                    best_losses[k] = val_means['loss'][k]
+                    torch.save(ensemble.load_member(k, template).state_dict(), weight_files[k])
+                else:
+                    count_epochs_not_improved[k] += 1
+                    if count_epochs_not_improved[k] == patience:
+                        print('Member {} finished training early'.format(k))
+                        active[k] = 0
+                        with torch.no_grad():
+                            for param, stopped in zip(ensemble.parameters(), stopped_parameters):
+                                stopped[k] = param[k]
+            if not bool(active.any()):
+                print('Finished training early')
+                break
 
-    return best_loss
+    return best_losses